@@ -9,6 +9,10 @@ from wdfwd.tail import FileTailer, TableTailer, TailThread
 from wdfwd.util import ldebug, linfo, lerror, supress_boto3_log,\
     iter_tail_info, TableTailInfo, FileTailInfo
 from wdfwd.sync import sync_file
+from wdfwd.posstore import close_pos_stores
+from wdfwd.sender import close_senders
+from wdfwd.ratelimit import set_global_limiter
+from wdfwd.watcher import stop_watcher
 
 
 cfg = get_config()
@@ -21,6 +25,7 @@ cit = croniter(schedule, start_dt) if schedule else None
 next_dt = cit.get_next(datetime) if cit else None
 logcnt = 0
 LOG_SYNC_CNT = 30
+TAIL_EXIT_TIMEOUT = 10
 
 force_first_run = appc['service'].get('force_first_run', False)
 
@@ -36,6 +41,8 @@ def start_tailing():
         ldebug("no tailing config. return")
         return
 
+    set_global_limiter(tailc.get('total_rate_bytes'),
+                       tailc.get('total_rate_events'))
     for i, ti in enumerate(iter_tail_info(tailc)):
         if isinstance(ti, TableTailInfo):
             linfo("start table tail - {}".format(ti))
@@ -55,7 +62,24 @@ def start_tailing():
                 millisec_ndigit=ti.millisec_ndigit,
                 key_idx=ti.key_idx,
                 start_key_sp=ti.start_key_sp,
-                latest_rows_sp=ti.latest_rows_sp
+                latest_rows_sp=ti.latest_rows_sp,
+                poll_min=ti.poll_min,
+                poll_max=ti.poll_max,
+                pos_flush_term=ti.pos_flush_term,
+                pos_flush_bytes=ti.pos_flush_bytes,
+                pos_fsync=ti.pos_fsync,
+                pos_store=ti.pos_store,
+                pos_cache_size=ti.pos_cache_size,
+                fluent_mode=ti.fluent_mode,
+                kinesis_encoder=ti.kinesis_encoder,
+                kinesis_partition=ti.kinesis_partition,
+                bulk_events=ti.bulk_events,
+                bulk_bytes=ti.bulk_bytes,
+                spool=ti.spool,
+                spool_max_bytes=ti.spool_max_bytes,
+                spool_segment_bytes=ti.spool_segment_bytes,
+                rate_bytes=ti.rate_bytes,
+                rate_events=ti.rate_events
             )
         elif isinstance(ti, FileTailInfo):
             linfo("start file tail - {}".format(ti))
@@ -75,7 +99,36 @@ def start_tailing():
                 format=ti.format,
                 parser=ti.parser,
                 order_ptrn=ti.order_ptrn,
-                reverse_order=ti.reverse_order)
+                reverse_order=ti.reverse_order,
+                max_read_buffer=ti.max_read_buffer,
+                partial_line_wait=ti.partial_line_wait,
+                drain_time=ti.drain_time,
+                drain_bytes=ti.drain_bytes,
+                use_mmap=ti.use_mmap,
+                mmap_window=ti.mmap_window,
+                watch_changes=ti.watch_changes,
+                watch_poll_term=ti.watch_poll_term,
+                poll_min=ti.poll_min,
+                poll_max=ti.poll_max,
+                line_index=ti.line_index,
+                pos_flush_term=ti.pos_flush_term,
+                pos_flush_bytes=ti.pos_flush_bytes,
+                pos_fsync=ti.pos_fsync,
+                pos_store=ti.pos_store,
+                pos_cache_size=ti.pos_cache_size,
+                fluent_mode=ti.fluent_mode,
+                kinesis_encoder=ti.kinesis_encoder,
+                kinesis_partition=ti.kinesis_partition,
+                async_send=ti.async_send,
+                send_queue_size=ti.send_queue_size,
+                bulk_events=ti.bulk_events,
+                bulk_bytes=ti.bulk_bytes,
+                bulk_linger=ti.bulk_linger,
+                spool=ti.spool,
+                spool_max_bytes=ti.spool_max_bytes,
+                spool_segment_bytes=ti.spool_segment_bytes,
+                rate_bytes=ti.rate_bytes,
+                rate_events=ti.rate_events)
 
         name = ti.tag
         linfo("create & start {} thread".format(name))
@@ -89,6 +142,20 @@ def stop_tailing():
     time.sleep(2)
     for trd in tail_threads:
         trd.exit()
+    # positions are flushed when tail threads end
+    alive = []
+    for trd in tail_threads:
+        trd.join(TAIL_EXIT_TIMEOUT)
+        if trd.is_alive():
+            alive.append(trd.name)
+    if alive:
+        # still flushing into them
+        lerror("tail threads not stopped {}. leave position stores and "
+               "senders open".format(alive))
+        return
+    stop_watcher()
+    close_pos_stores()
+    close_senders()
 
 
 def run_scheduled():
@@ -97,5 +97,47 @@ def format(file_path, cfg_path, cfile_idx, errors_only):
                     sys.exit(-1)
 
 
+@cli.command()
+@click.argument('file_path')
+@click.argument('line', type=int)
+@click.option('--cfg-path', help="Forwarder config file path.")
+@click.option('--cfile-idx', default=0, help="Tailing config file index.")
+def replay(file_path, line, cfg_path, cfile_idx):
+    """Set sent position of a target file to a line, so that it is sent again
+    from the line on next start. The line is found by the line index if
+    `line_index` is set. Unsent data larger than `max_between_data` is still
+    skipped on start."""
+    from wdfwd.util import OpenNoLock, get_fileid
+    from wdfwd.lineindex import LineIndex, find_line_pos
+    from wdfwd.checkpoint import Checkpointer
+    from wdfwd.posstore import get_pos_store, close_pos_stores
+
+    if not cfg_path:
+        assert CONFIG_NAME in os.environ
+        cfg_path = os.environ[CONFIG_NAME]
+
+    cfg = _get_config(cfg_path)
+    assert 'tailing' in cfg
+    tailc = cfg['tailing']
+    targets = list(iter_tail_info(tailc))
+    target = targets[cfile_idx]
+    assert isinstance(target, FileTailInfo)
+
+    with OpenNoLock(file_path) as fh:
+        if target.line_index:
+            lidx = LineIndex(target.pos_dir, target.bdir, get_fileid(fh),
+                             target.line_index)
+            lidx.validate(fh)
+            pos = lidx.line_pos(fh, line)
+        else:
+            pos = find_line_pos(fh, line)
+
+    store = get_pos_store(target.pos_dir, target.pos_store)
+    Checkpointer(store, fsync=target.pos_fsync).put(file_path, pos,
+                                                     force=True)
+    close_pos_stores()
+    print "'{}' will be sent from line {} at {}".format(file_path, line, pos)
+
+
 if __name__ == '__main__':
     cli()
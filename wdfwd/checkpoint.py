@@ -0,0 +1,130 @@
+"""Coalesced checkpointing of sent positions.
+
+Sent positions are kept in memory and written to the position store when
+enough time has passed or enough bytes have been sent since the last flush.
+A pos file is replaced atomically, so a crash never leaves it empty or half
+written.
+"""
+import os
+import time
+import logging
+
+import win32file
+
+
+CHECKPOINT_TERM = 5  # flush positions after this seconds
+CHECKPOINT_BYTES = 1024 * 1024  # or after this bytes have been sent
+
+# fsync policies
+FSYNC_NONE = 'none'  # leave it to the OS
+FSYNC_ROTATION = 'rotation'  # only for flushes on rotation and shutdown
+FSYNC_ALWAYS = 'always'  # every flush
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_ROTATION, FSYNC_ALWAYS)
+
+
+def write_atomic(path, data, fsync=False):
+    """Replace a file with data atomically.
+
+    Data is written to a temp file which then replaces the file.
+
+    Args:
+        path: File path.
+        data: Data to write.
+        fsync(optional): Flush data to disk before replacing.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    flags = win32file.MOVEFILE_REPLACE_EXISTING
+    if fsync:
+        flags |= win32file.MOVEFILE_WRITE_THROUGH
+    win32file.MoveFileEx(tmp, path, flags)
+
+
+class Checkpointer(object):
+    """Buffer sent positions of a tailer and flush them to a store."""
+
+    def __init__(self, store, flush_term=None, flush_bytes=None, fsync=None,
+                 syncs=None):
+        """
+        Args:
+            store: Position store from `posstore.get_pos_store`.
+            flush_term(optional): Flush after this seconds. 0 for every save.
+            flush_bytes(optional): Flush after this bytes have been sent.
+            fsync(optional): One of `FSYNC_POLICIES`.
+            syncs(optional): Functions to flush data the positions depend on,
+                such as spooled payloads, to disk. Called before every flush
+                unless fsync policy is none.
+        """
+        self.flush_term = flush_term if flush_term is not None else\
+            CHECKPOINT_TERM
+        self.flush_bytes = flush_bytes if flush_bytes is not None else\
+            CHECKPOINT_BYTES
+        fsync = fsync if fsync else FSYNC_ROTATION
+        if fsync not in FSYNC_POLICIES:
+            logging.error("invalid fsync policy '{}'. use '{}'".format(
+                          fsync, FSYNC_ROTATION))
+            fsync = FSYNC_ROTATION
+        self.store = store
+        self.fsync = fsync
+        self.syncs = syncs if syncs else []
+        self.pending = {}  # target -> position
+        self.pending_bytes = 0
+        self.last_flush = time.time()
+
+    def read(self, target):
+        """Return latest position string of a target, or None.
+
+        Position not flushed yet precedes the stored one.
+        """
+        if target in self.pending:
+            return str(self.pending[target])
+        return self.store.read(target)
+
+    def put(self, target, pos, nbytes=0, force=False):
+        """Checkpoint a position.
+
+        Args:
+            target: Target file path or table name.
+            pos: Sent position.
+            nbytes(optional): Bytes sent since previous position.
+            force(optional): Flush right away, as on rotation.
+        """
+        self.pending[target] = pos
+        self.pending_bytes += nbytes
+        if force or self.pending_bytes >= self.flush_bytes:
+            self.flush(force)
+        else:
+            self.may_flush()
+
+    def discard(self, targets):
+        """Drop pending positions of targets."""
+        for target in targets:
+            self.pending.pop(target, None)
+
+    def may_flush(self):
+        """Flush if flush term has passed."""
+        if self.pending and time.time() - self.last_flush >= self.flush_term:
+            self.flush()
+
+    def flush(self, force=False):
+        """Write pending positions to the store in a batch.
+
+        Args:
+            force(optional): Flush on rotation or shutdown.
+        """
+        if not self.pending:
+            return
+        fsync = self.fsync == FSYNC_ALWAYS or\
+            (force and self.fsync == FSYNC_ROTATION)
+        if self.fsync != FSYNC_NONE:
+            # data must reach disk before positions past it
+            for sync in self.syncs:
+                sync()
+        # failed ones are retried on next flush
+        self.pending = self.store.write(self.pending, fsync)
+        self.pending_bytes = 0
+        self.last_flush = time.time()
@@ -0,0 +1,278 @@
+"""Sparse line offset index of tailed files.
+
+Byte offset of every `interval`-th line of a file is kept in a sidecar file
+in the position directory, so a line number can be found by a seek and a
+short scan instead of reading the whole file.
+
+The index file is named by the file id, so it stays valid when the file is
+renamed by rotation.
+"""
+import os
+import bisect
+import logging
+
+import win32file
+
+from wdfwd.util import OpenNoLock, get_fileid, escape_path, count_lines
+
+
+LINE_INDEX_EXT = '.lidx'
+SCAN_BUF = 1024 * 1024  # 1MB
+
+
+def get_index_path(pdir, bdir, fid):
+    return os.path.join(pdir, '{}.{}{}'.format(escape_path(bdir), fid,
+                                               LINE_INDEX_EXT))
+
+
+def _read_blocks(fh, start, end=None):
+    """Read a file from `start` to `end` block by block.
+
+    Yields:
+        int: File position of the block.
+        str: Read data.
+    """
+    win32file.SetFilePointer(fh, start, win32file.FILE_BEGIN)
+    pos = start
+    while end is None or pos < end:
+        rsize = SCAN_BUF if end is None else min(SCAN_BUF, end - pos)
+        res, data = win32file.ReadFile(fh, rsize, None)
+        if not data:
+            break
+        yield pos, data
+        pos += len(data)
+        if len(data) < rsize:
+            break
+
+
+def find_line_pos(fh, line, start_pos=0):
+    """Return byte position where a line starts by scanning a file.
+
+    Args:
+        fh: File handle.
+        line: Number of lines to skip from `start_pos`.
+        start_pos(optional): Position of a line start to scan from.
+
+    Returns:
+        int: Line start position. File size if the file has fewer lines.
+    """
+    if line <= 0:
+        return start_pos
+    for bpos, data in _read_blocks(fh, start_pos):
+        idx = 0
+        while line > 0:
+            nl = data.find('\n', idx)
+            if nl < 0:
+                break
+            idx = nl + 1
+            line -= 1
+        if line == 0:
+            return bpos + idx
+    return win32file.GetFileSize(fh)
+
+
+class LineIndex(object):
+    """Sparse line offset index of a file.
+
+    `offsets[k]` is the byte position where the line `k * interval` starts.
+    Lines are numbered from 0 by counting line ends.
+    """
+
+    def __init__(self, pdir, bdir, fid, interval):
+        """Load index of a file, or start a new one.
+
+        Args:
+            pdir: Position file directory to keep the index.
+            bdir: Directory of the file.
+            fid: File id from `get_fileid`.
+            interval: Number of lines between indexed offsets.
+        """
+        self.path = get_index_path(pdir, bdir, fid)
+        self.interval = interval
+        self.offsets = [0]
+        self.saved = 0  # number of offsets in the index file
+        # lines are counted up to scan_pos, indexing continues from there
+        self.scan_pos = 0
+        self.scan_lines = 0
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        offsets = [0]
+        with open(self.path, 'r') as f:
+            head = f.readline().strip()
+            if head != str(self.interval):
+                logging.warning("line index interval changed '{}'. "
+                                "rebuild".format(self.path))
+                return
+            for line in f:
+                try:
+                    off = int(line)
+                except ValueError:
+                    break
+                # stop at broken tail of interrupted append
+                if off <= offsets[-1]:
+                    break
+                offsets.append(off)
+        self.offsets = offsets
+        self.saved = len(offsets)
+        self._reset_scan()
+
+    def _reset_scan(self):
+        self.scan_pos = self.offsets[-1]
+        self.scan_lines = (len(self.offsets) - 1) * self.interval
+
+    def validate(self, fh):
+        """Drop offsets not valid for the file, such as after truncation.
+
+        Args:
+            fh: Handle of the indexed file.
+        """
+        size = win32file.GetFileSize(fh)
+        cnt = len(self.offsets)
+        while len(self.offsets) > 1 and self.offsets[-1] > size:
+            self.offsets.pop()
+        if len(self.offsets) > 1:
+            win32file.SetFilePointer(fh, self.offsets[-1] - 1,
+                                     win32file.FILE_BEGIN)
+            res, data = win32file.ReadFile(fh, 1, None)
+            if data != '\n':
+                self.offsets = [0]
+        if len(self.offsets) != cnt:
+            logging.warning("line index '{}' not valid for the file. "
+                            "{} of {} offsets left".format(self.path,
+                                                           len(self.offsets),
+                                                           cnt))
+            self.saved = 0
+            self._reset_scan()
+
+    def feed(self, data, pos, start=0, end=None):
+        """Index lines of data read from the file.
+
+        Data not continuing from the scanned position is ignored.
+
+        Args:
+            data: `str` or `mmap` object.
+            pos: File position of `data[start]`.
+            start(optional): Start offset of the region in data.
+            end(optional): End offset of the region in data.
+
+        Returns:
+            bool: True if new offsets are indexed.
+        """
+        end = len(data) if end is None else end
+        if pos != self.scan_pos or start >= end:
+            return False
+        added = False
+        need = self.interval - self.scan_lines % self.interval
+        cnt = count_lines(data, start, end, partial=False)
+        idx = start
+        while cnt >= need:
+            for _ in xrange(need):
+                idx = data.find('\n', idx, end) + 1
+            self.offsets.append(pos + idx - start)
+            self.scan_lines += need
+            cnt -= need
+            need = self.interval
+            added = True
+        self.scan_lines += cnt
+        self.scan_pos = pos + end - start
+        return added
+
+    def extend(self, fh, end=None, line=None):
+        """Index the file from the scanned position.
+
+        Args:
+            fh: Handle of the indexed file.
+            end(optional): Scan up to this position. Default is file end.
+            line(optional): Stop when this line has been indexed.
+        """
+        k = line // self.interval if line is not None else None
+        for bpos, data in _read_blocks(fh, self.scan_pos, end):
+            self.feed(data, bpos)
+            if k is not None and k < len(self.offsets):
+                break
+        self.save()
+
+    def line_pos(self, fh, line):
+        """Return byte position where a line starts.
+
+        Args:
+            fh: Handle of the indexed file.
+            line: Line number from 0.
+
+        Returns:
+            int: Line start position. File size if the file has fewer lines.
+        """
+        k = line // self.interval
+        if k >= len(self.offsets):
+            self.extend(fh, line=line)
+        k = min(k, len(self.offsets) - 1)
+        return find_line_pos(fh, line - k * self.interval, self.offsets[k])
+
+    def count_before(self, fh, pos):
+        """Return number of lines before a byte position.
+
+        An unterminated line before the position is counted too.
+
+        Args:
+            fh: Handle of the indexed file.
+            pos: Byte position.
+        """
+        if pos > self.scan_pos:
+            self.extend(fh, pos)
+        k = bisect.bisect_right(self.offsets, pos) - 1
+        cnt = k * self.interval
+        last = ''
+        for bpos, data in _read_blocks(fh, self.offsets[k], pos):
+            cnt += count_lines(data, partial=False)
+            last = data[-1]
+        if last and last != '\n':
+            cnt += 1
+        return cnt
+
+    def save(self):
+        """Append offsets not saved yet to the index file."""
+        if self.saved == len(self.offsets):
+            return
+        mode = 'a' if self.saved else 'w'
+        with open(self.path, mode) as f:
+            if not self.saved:
+                f.write('{}\n'.format(self.interval))
+            for off in self.offsets[max(self.saved, 1):]:
+                f.write('{}\n'.format(off))
+        self.saved = len(self.offsets)
+
+
+def prune_line_index(pdir, bdir):
+    """Remove index files of the directory whose file no longer exists.
+
+    Args:
+        pdir: Position file directory.
+        bdir: Directory of indexed files.
+    """
+    prefix = escape_path(bdir) + '.'
+    names = [n for n in os.listdir(pdir) if n.startswith(prefix) and
+             n.endswith(LINE_INDEX_EXT)]
+    if not names:
+        return
+
+    fids = set()
+    for fname in os.listdir(bdir):
+        path = os.path.join(bdir, fname)
+        if not os.path.isfile(path):
+            continue
+        try:
+            with OpenNoLock(path) as fh:
+                fids.add(str(get_fileid(fh)))
+        except Exception as e:
+            logging.warning("can't get file id of '{}' - {}".format(path, e))
+            # not sure the index is stale
+            return
+
+    for name in names:
+        fid = name[len(prefix):-len(LINE_INDEX_EXT)]
+        if fid.isdigit() and fid not in fids:
+            logging.info("remove stale line index '{}'".format(name))
+            os.remove(os.path.join(pdir, name))
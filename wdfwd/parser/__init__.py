@@ -135,7 +135,6 @@ class Token(RegexObj):
 
 def apply_tfunc(taken, token, tname):
     """apply token transform, save into target"""
-    ldebug("apply_tfunc")
     tvar = taken[tname]
     if tvar is None:
         ret = ''
@@ -263,7 +262,7 @@ class Parser(object):
         return regex
 
     def parse_line(self, line):
-        ldebug("parse_line")
+        # called per line, no logging
         if self.encoding:
             line = decode(line, self.encoding)
 
@@ -281,7 +280,7 @@ class Parser(object):
 
 
 def create_parser(cfg, encoding=None):
-    ldebug("create_parser {}".format(cfg))
+    ldebug("create_parser {}", cfg)
     if 'custom' in cfg:
         ldebug("custom parser '{}'".format(cfg['custom']))
         from wdfwd.parser import custom
@@ -0,0 +1,222 @@
+"""Stores of sent positions.
+
+`FilePosStore` keeps a `.pos` file per target in the position directory.
+`DBPosStore` keeps positions of all tailers in a single sqlite3 file, which
+is loaded once and written in batches.
+"""
+import os
+import glob
+import time
+import logging
+import sqlite3
+import threading
+
+from wdfwd.util import escape_path
+from wdfwd.checkpoint import write_atomic
+
+
+POS_STORE_FILE = 'file'
+POS_STORE_DB = 'db'
+POS_DB_NAME = '_positions.db'
+POS_GC_TERM = 60 * 60  # collect garbage positions every hour
+
+
+class FilePosStore(object):
+    """A pos file per target."""
+
+    def __init__(self, pdir):
+        self.pdir = pdir
+
+    def get_path(self, target):
+        return os.path.join(self.pdir, escape_path(target) + '.pos')
+
+    def read(self, target):
+        """Return saved position string of a target, or None."""
+        path = self.get_path(target)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as f:
+            return f.readline().strip()
+
+    def keys(self):
+        """Return escaped target paths of saved positions."""
+        return [n[:-len('.pos')] for n in os.listdir(self.pdir) if
+                n.endswith('.pos')]
+
+    def delete(self, targets):
+        for target in targets:
+            path = self.get_path(target)
+            if os.path.isfile(path):
+                logging.info("remove pos file '{}'".format(path))
+                os.remove(path)
+
+    def write(self, poss, fsync=False):
+        """Save positions.
+
+        Args:
+            poss(dict): Target -> position.
+            fsync(optional): Flush to disk.
+
+        Returns:
+            dict: Positions failed to save.
+        """
+        failed = {}
+        for target, pos in poss.iteritems():
+            path = self.get_path(target)
+            try:
+                write_atomic(path, "{}\n".format(pos), fsync)
+            except Exception as e:
+                logging.error("Fail to write pos file: {} {}".format(e, path))
+                failed[target] = pos
+        return failed
+
+
+class DBPosStore(object):
+    """Positions of all targets in a sqlite3 file.
+
+    Positions are keyed by the escaped target path, as pos files are named.
+    Existing pos files in the directory are migrated on first run.
+    """
+
+    def __init__(self, pdir):
+        self.pdir = pdir
+        self.path = os.path.join(pdir, POS_DB_NAME)
+        self.lock = threading.Lock()
+        new = not os.path.isfile(self.path)
+        # shared by tail threads under the lock
+        self.con = sqlite3.connect(self.path, check_same_thread=False)
+        # a crash may lose last writes without fsync, but never corrupts
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("CREATE TABLE IF NOT EXISTS pos (key TEXT PRIMARY "
+                         "KEY, target TEXT, pos TEXT, updated REAL)")
+        self.con.commit()
+        if new:
+            self.migrate()
+        self.cache = dict(self.con.execute("SELECT key, pos FROM pos"))
+        logging.info("loaded {} positions from '{}'".format(len(self.cache),
+                                                           self.path))
+        self.last_gc = 0
+        self.may_gc()
+
+    def migrate(self):
+        """Import pos files, and remove them."""
+        ppaths = glob.glob(os.path.join(self.pdir, '*.pos'))
+        if not ppaths:
+            return
+        rows = []
+        for ppath in ppaths:
+            with open(ppath, 'r') as f:
+                pos = f.readline().strip()
+            key = os.path.basename(ppath)[:-len('.pos')]
+            # original target path can't be restored from the key
+            rows.append((key, None, pos, os.path.getmtime(ppath)))
+        self.con.executemany("INSERT OR REPLACE INTO pos VALUES (?, ?, ?, ?)",
+                             rows)
+        self.con.commit()
+        for ppath in ppaths:
+            os.remove(ppath)
+        logging.warning("migrated {} pos files into '{}'".format(len(rows),
+                                                                 self.path))
+
+    def read(self, target):
+        with self.lock:
+            return self.cache.get(escape_path(target))
+
+    def keys(self):
+        with self.lock:
+            return self.cache.keys()
+
+    def delete(self, targets):
+        keys = [escape_path(t) for t in targets]
+        with self.lock:
+            self.con.executemany("DELETE FROM pos WHERE key = ?",
+                                 [(k,) for k in keys])
+            self.con.commit()
+            for key in keys:
+                self.cache.pop(key, None)
+
+    def write(self, poss, fsync=False):
+        cur = time.time()
+        rows = [(escape_path(target), target, str(pos), cur) for target, pos
+                in poss.iteritems()]
+        with self.lock:
+            try:
+                self.con.execute("PRAGMA synchronous={}".format(
+                                 'FULL' if fsync else 'NORMAL'))
+                self.con.executemany("INSERT OR REPLACE INTO pos VALUES "
+                                     "(?, ?, ?, ?)", rows)
+                self.con.commit()
+            except Exception as e:
+                logging.error("Fail to write positions: {} {}".format(
+                              e, self.path))
+                self.con.rollback()
+                return dict(poss)
+            for key, _, pos, _ in rows:
+                self.cache[key] = pos
+        self.may_gc()
+        return {}
+
+    def may_gc(self):
+        """Remove positions of deleted files timely.
+
+        Only absolute target paths are checked for existence, others such as
+        table names are kept. Positions of unknown target, as migrated ones,
+        are kept until their tailer sweeps them.
+        """
+        cur = time.time()
+        if cur - self.last_gc < POS_GC_TERM:
+            return
+        self.last_gc = cur
+        with self.lock:
+            rows = self.con.execute("SELECT key, target FROM pos WHERE "
+                                    "target IS NOT NULL").fetchall()
+            keys = [key for key, target in rows if os.path.isabs(target) and
+                    not os.path.exists(target)]
+            if not keys:
+                return
+            self.con.executemany("DELETE FROM pos WHERE key = ?",
+                                 [(k,) for k in keys])
+            self.con.commit()
+            for key in keys:
+                self.cache.pop(key, None)
+        logging.info("removed {} positions of deleted files".format(
+                     len(keys)))
+
+    def close(self):
+        with self.lock:
+            self.con.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_pos_store(pdir, kind=None):
+    """Return the process-wide position store of a directory.
+
+    Args:
+        pdir: Position directory.
+        kind(optional): `POS_STORE_FILE` (default) or `POS_STORE_DB`.
+    """
+    kind = kind if kind else POS_STORE_FILE
+    if kind not in (POS_STORE_FILE, POS_STORE_DB):
+        logging.error("invalid pos store '{}'. use '{}'".format(
+                      kind, POS_STORE_FILE))
+        kind = POS_STORE_FILE
+    with _stores_lock:
+        key = (pdir, kind)
+        if key not in _stores:
+            if kind == POS_STORE_DB:
+                _stores[key] = DBPosStore(pdir)
+            else:
+                _stores[key] = FilePosStore(pdir)
+        return _stores[key]
+
+
+def close_pos_stores():
+    """Close all position stores, as on shutdown."""
+    with _stores_lock:
+        for store in _stores.values():
+            if isinstance(store, DBPosStore):
+                store.close()
+        _stores.clear()
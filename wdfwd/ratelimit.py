@@ -0,0 +1,142 @@
+"""Token bucket rate limits of the tailing path.
+
+A limiter holds byte and event buckets, which are refilled at their rates
+up to a burst of `RATE_BURST_TERM` seconds. Sending reserves tokens for a
+payload and pauses for the returned seconds. Reservation may run the bucket
+into debt, so a payload larger than the burst is delayed but never
+rejected, and reservations of threads sharing a limiter are served in
+order.
+
+A limiter is made per tailer, and the process wide one is shared by all
+tailers.
+"""
+import time
+import threading
+
+
+RATE_BURST_TERM = 1  # seconds of rate allowed as a burst
+
+_global_limiter = None
+
+
+class TokenBucket(object):
+    """Tokens refilled at a rate."""
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate: Tokens per second.
+            burst(optional): Max tokens. Default is `RATE_BURST_TERM` seconds
+                of rate.
+        """
+        self.rate = float(rate)
+        self.burst = burst if burst else self.rate * RATE_BURST_TERM
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, n):
+        """Take tokens.
+
+        Args:
+            n: Number of tokens.
+
+        Returns:
+            float: Seconds to wait for the tokens.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.last) * self.rate,
+                              self.burst)
+            self.last = now
+            self.tokens -= n
+            return max(-self.tokens / self.rate, 0)
+
+
+class RateLimiter(object):
+    """Byte and event rate limits with their statistics."""
+
+    def __init__(self, bytes_rate=None, events_rate=None, name=None):
+        """
+        Args:
+            bytes_rate(optional): Max bytes per second. No limit if not given.
+            events_rate(optional): Max events per second. No limit if not
+                given.
+            name(optional): Name for logging.
+        """
+        self.name = name
+        self.bytes_rate = bytes_rate
+        self.events_rate = events_rate
+        self.bbucket = TokenBucket(bytes_rate) if bytes_rate else None
+        self.ebucket = TokenBucket(events_rate) if events_rate else None
+        self.lock = threading.Lock()
+        self.since = time.time()
+        self.nbytes = 0
+        self.nevents = 0
+        self.throttled = 0.0  # seconds to wait reserved so far
+        self.npause = 0
+
+    def reserve(self, nbytes, nevents=0):
+        """Take tokens for a payload.
+
+        Args:
+            nbytes: Payload size in bytes.
+            nevents(optional): Events of the payload.
+
+        Returns:
+            float: Seconds to wait before sending the payload.
+        """
+        wait = 0
+        if self.bbucket is not None and nbytes:
+            wait = self.bbucket.reserve(nbytes)
+        if self.ebucket is not None and nevents:
+            wait = max(wait, self.ebucket.reserve(nevents))
+        with self.lock:
+            self.nbytes += nbytes
+            self.nevents += nevents
+            if wait > 0:
+                self.throttled += wait
+                self.npause += 1
+        return wait
+
+    def stats(self):
+        """Return statistics since the limiter has been made.
+
+        Returns:
+            dict: Limits, sent bytes and events, their rates per second,
+                count of pauses and their total seconds.
+        """
+        with self.lock:
+            elapsed = max(time.time() - self.since, 1e-6)
+            return dict(bytes_rate=self.bytes_rate,
+                        events_rate=self.events_rate, nbytes=self.nbytes,
+                        nevents=self.nevents,
+                        bytes_per_sec=self.nbytes / elapsed,
+                        events_per_sec=self.nevents / elapsed,
+                        npause=self.npause, throttled=self.throttled)
+
+
+def make_rate_limiter(bytes_rate=None, events_rate=None, name=None):
+    """Return a limiter, or None if there is no limit."""
+    if not bytes_rate and not events_rate:
+        return None
+    return RateLimiter(bytes_rate, events_rate, name)
+
+
+def set_global_limiter(bytes_rate=None, events_rate=None):
+    """Set the limiter shared by all tailers made after.
+
+    Args:
+        bytes_rate(optional): Max bytes per second of the process.
+        events_rate(optional): Max events per second of the process.
+
+    Returns:
+        RateLimiter: The limiter, or None if there is no limit.
+    """
+    global _global_limiter
+    _global_limiter = make_rate_limiter(bytes_rate, events_rate, 'global')
+    return _global_limiter
+
+
+def get_global_limiter():
+    return _global_limiter
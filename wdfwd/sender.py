@@ -0,0 +1,661 @@
+"""Process-wide senders shared by tailers.
+
+Tailers sending to the same fluentd get handles of a small pool of
+connections instead of a connection each, or of a `FluentBalancer` of the
+pools to several fluentds. Tailers sending to the same
+Kinesis region share a boto3 client. `KinesisSink` puts records of a tailer
+by batches, which are encoded and partitioned by `make_kinesis_encoder` and
+`KinesisPartitioner`. Tailers sending to the same destination share a
+`CircuitBreaker` of it, so they back off together while it is down.
+"""
+import time
+import json
+import Queue
+import random
+import logging
+import threading
+from collections import OrderedDict
+
+import msgpack
+from fluent.sender import FluentSender, MAX_SEND_FAIL
+
+from wdfwd.util import query_aws_client
+
+
+FLUENT_POOL_SIZE = 2  # connections per fluentd
+KINESIS_MAX_BATCH = 500  # records per put_records
+KINESIS_MAX_BATCH_BYTES = 5 * 1024 * 1024
+KINESIS_MAX_INFLIGHT = 4  # concurrent put_records of a sink
+KINESIS_PUT_RETRY = 3  # retries of failed entries
+KINESIS_RETRY_WAIT = 0.1  # doubled on each retry
+
+# kinesis record encoders
+KINESIS_JSON = 'json'
+KINESIS_MSGPACK = 'msgpack'
+KINESIS_ENCODERS = (KINESIS_JSON, KINESIS_MSGPACK)
+
+# kinesis partition key strategies
+KINESIS_ROUNDROBIN = 'roundrobin'  # rotate explicit hash keys per bulk
+KINESIS_TAILER = 'tailer'  # hash of the tailer tag
+KINESIS_FIELD = 'field:'  # value of a record field, ex) 'field:user_id'
+KINESIS_HASH_KEYS = 64  # explicit hash keys to rotate
+KINESIS_MAX_PK = 256  # max length of partition key
+CIRCUIT_BACKOFF_MIN = 1  # seconds to wait after the first failure
+CIRCUIT_BACKOFF_MAX = 60  # backoff is doubled up to this
+CIRCUIT_JITTER = 0.5  # backoff is shortened randomly up to this ratio
+
+
+class KinesisPutError(Exception):
+    """Some records of a put have not been put.
+
+    Attributes:
+        unsent: Sorted indexes of records not put.
+    """
+
+    def __init__(self, msg, unsent=()):
+        super(KinesisPutError, self).__init__(msg)
+        self.unsent = list(unsent)
+
+
+def iter_kinesis_batches(records, max_batch=None, max_bytes=None):
+    """Group records by put_records limits.
+
+    Args:
+        records: List of (partition key, explicit hash key, data).
+        max_batch(optional): Max records of a batch.
+        max_bytes(optional): Max bytes of data and partition keys of a
+            batch.
+
+    Yields:
+        list: Records of a batch.
+    """
+    max_batch = max_batch if max_batch else KINESIS_MAX_BATCH
+    max_bytes = max_bytes if max_bytes else KINESIS_MAX_BATCH_BYTES
+    batch = []
+    size = 0
+    for rec in records:
+        rsize = len(rec[0]) + len(rec[2])
+        if batch and (len(batch) >= max_batch or size + rsize > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(rec)
+        size += rsize
+    if batch:
+        yield batch
+
+
+class JSONRecordEncoder(object):
+    """Encode a message as compact JSON object with `tag_` and `ts_`.
+
+    The record is dumped as is and spliced after the tag and time, instead
+    of being copied into a new dict. A text message goes to `value_`.
+    """
+
+    def __init__(self, tag):
+        self.head = '{{"tag_":{},"ts_":'.format(json.dumps(tag))
+        self.dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+    def encode(self, ts, rec):
+        if not isinstance(rec, dict):
+            return '{}{},"value_":{}}}'.format(self.head, ts, self.dumps(rec))
+        if not rec:
+            return '{}{}}}'.format(self.head, ts)
+        return '{}{},{}'.format(self.head, ts, self.dumps(rec)[1:])
+
+
+class MsgpackRecordEncoder(object):
+    """Encode a message as msgpack map with `tag_` and `ts_`.
+
+    The record is packed as is, and its map header is replaced with one
+    counting the tag and time.
+    """
+
+    def __init__(self, tag):
+        self.packer = msgpack.Packer()
+        pack = self.packer.pack
+        self.tag_pair = pack('tag_') + pack(tag)
+        self.ts_key = pack('ts_')
+        self.value_key = pack('value_')
+
+    def encode(self, ts, rec):
+        pack = self.packer.pack
+        if not isinstance(rec, dict):
+            return ''.join((self.packer.pack_map_header(3), self.tag_pair,
+                            self.ts_key, pack(ts), self.value_key,
+                            pack(rec)))
+        body = pack(rec)
+        # fixmap, map16 or map32 header
+        first = ord(body[0])
+        hlen = 1 if first & 0xf0 == 0x80 else 3 if first == 0xde else 5
+        return ''.join((self.packer.pack_map_header(len(rec) + 2),
+                        self.tag_pair, self.ts_key, pack(ts),
+                        body[hlen:]))
+
+
+def make_kinesis_encoder(kind, tag):
+    """Return record encoder of a kind.
+
+    Args:
+        kind: One of `KINESIS_ENCODERS`. Default is `KINESIS_JSON`.
+        tag: Tag of records.
+    """
+    kind = kind if kind else KINESIS_JSON
+    if kind not in KINESIS_ENCODERS:
+        logging.error("invalid kinesis encoder '{}'. use '{}'".format(
+                      kind, KINESIS_JSON))
+        kind = KINESIS_JSON
+    if kind == KINESIS_MSGPACK:
+        return MsgpackRecordEncoder(tag)
+    return JSONRecordEncoder(tag)
+
+
+class KinesisPartitioner(object):
+    """Choose partition keys of messages by a strategy.
+
+    Records are aggregated per partition key, so a key costs nothing per
+    message. With `KINESIS_ROUNDROBIN`, bulks are spread evenly over shards
+    by rotating explicit hash keys. With `KINESIS_TAILER`, all records of a
+    tailer go to a shard in order. With `KINESIS_FIELD`, records of the same
+    field value go to a shard in order.
+    """
+
+    def __init__(self, strategy, tag, nkeys=None):
+        """
+        Args:
+            strategy: Partition key strategy. Default is `KINESIS_ROUNDROBIN`.
+            tag: Tag of the tailer.
+            nkeys(optional): Number of explicit hash keys to rotate.
+        """
+        strategy = strategy if strategy else KINESIS_ROUNDROBIN
+        self.field = None
+        if strategy.startswith(KINESIS_FIELD):
+            self.field = strategy[len(KINESIS_FIELD):]
+        elif strategy not in (KINESIS_ROUNDROBIN, KINESIS_TAILER):
+            logging.error("invalid kinesis partition '{}'. use '{}'".format(
+                          strategy, KINESIS_ROUNDROBIN))
+            strategy = KINESIS_ROUNDROBIN
+        self.strategy = strategy
+        self.tag = tag[:KINESIS_MAX_PK]
+        nkeys = nkeys if nkeys else KINESIS_HASH_KEYS
+        # middle of evenly divided hash key ranges
+        self.hash_keys = [str((2 ** 128 * (2 * i + 1)) // (2 * nkeys)) for i
+                          in xrange(nkeys)]
+        self.cnt = 0
+
+    def _field_key(self, rec):
+        val = rec.get(self.field) if isinstance(rec, dict) else None
+        if val is None or val == '':
+            return self.tag
+        if isinstance(val, unicode):
+            val = val.encode('utf8')
+        elif not isinstance(val, str):
+            val = str(val)
+        return val[:KINESIS_MAX_PK]
+
+    def group(self, msgs):
+        """Group messages by partition key.
+
+        Args:
+            msgs: List of (time, record, ...).
+
+        Yields:
+            tuple: (partition key, explicit hash key, messages)
+        """
+        if self.field is None:
+            ehk = None
+            if self.strategy == KINESIS_ROUNDROBIN:
+                ehk = self.hash_keys[self.cnt % len(self.hash_keys)]
+                self.cnt += 1
+            yield self.tag, ehk, msgs
+            return
+
+        groups = OrderedDict()
+        for msg in msgs:
+            groups.setdefault(self._field_key(msg[1]), []).append(msg)
+        for pk, gmsgs in groups.iteritems():
+            yield pk, None, gmsgs
+
+
+class KinesisSink(object):
+    """Put records to a Kinesis stream by batches.
+
+    Batches of a put are sent concurrently up to `max_inflight`, but a batch
+    waits for earlier ones having records of the same partition key, so
+    records of a key are put in order. Only the failed entries of a batch
+    are retried, before the next batch of the key.
+
+    Note:
+        A retried entry is put after the later entries of its batch.
+    """
+
+    def __init__(self, client, stream_name, max_inflight=None,
+                 max_retry=None):
+        """
+        Args:
+            client: Kinesis client from `get_kinesis_client`.
+            stream_name: Kinesis stream name.
+            max_inflight(optional): Max concurrent put_records.
+            max_retry(optional): Max retries of failed entries.
+        """
+        self.client = client
+        self.stream_name = stream_name
+        self.max_inflight = max_inflight if max_inflight else\
+            KINESIS_MAX_INFLIGHT
+        self.max_retry = max_retry if max_retry is not None else\
+            KINESIS_PUT_RETRY
+
+    def put(self, records):
+        """Put records.
+
+        When a batch fails, later batches of its partition keys are not put,
+        and the others are.
+
+        Args:
+            records: List of (partition key, explicit hash key, data).
+
+        Returns:
+            tuple: Shard id and sequence number of the last put record.
+
+        Raises:
+            KinesisPutError: Some records failed after retries. Its `unsent`
+                tells which ones, so only they shall be retried.
+        """
+        batches = list(iter_kinesis_batches(records))
+        if not batches:
+            return None, None
+
+        # a batch waits for the last earlier batch of each of its keys
+        deps = []
+        starts = []
+        last = {}
+        start = 0
+        for i, batch in enumerate(batches):
+            keys = set(ehk if ehk else pk for pk, ehk, _ in batch)
+            deps.append(set(last[key] for key in keys if key in last))
+            for key in keys:
+                last[key] = i
+            starts.append(start)
+            start += len(batch)
+
+        cond = threading.Condition()
+        todo = range(len(batches))
+        done = set()
+        stopped = set()  # failed, or waiting for a failed one
+        results = [None] * len(batches)
+        unsent = []
+        errors = []
+
+        def next_batch():
+            with cond:
+                while todo:
+                    for i in list(todo):
+                        if deps[i] & stopped:
+                            todo.remove(i)
+                            stopped.add(i)
+                            unsent.extend(xrange(starts[i], starts[i] +
+                                                 len(batches[i])))
+                        elif deps[i] <= done:
+                            todo.remove(i)
+                            return i
+                    if todo:
+                        cond.wait()
+                return None
+
+        def work():
+            while True:
+                i = next_batch()
+                if i is None:
+                    return
+                try:
+                    res, failed = self._put_batch(batches[i])
+                except Exception as e:
+                    res, failed = None, range(len(batches[i]))
+                    errors.append(e)
+                with cond:
+                    results[i] = res
+                    if failed:
+                        stopped.add(i)
+                        unsent.extend(starts[i] + j for j in failed)
+                    else:
+                        done.add(i)
+                    cond.notify_all()
+
+        # current thread works too
+        nthread = min(self.max_inflight, len(batches)) - 1
+        threads = [threading.Thread(target=work) for _ in xrange(nthread)]
+        for trd in threads:
+            trd.daemon = True
+            trd.start()
+        work()
+        for trd in threads:
+            trd.join()
+        if unsent:
+            raise KinesisPutError("{} of {} kinesis records not put{}".format(
+                                  len(unsent), len(records),
+                                  " - {}".format(errors[0]) if errors else
+                                  ''), sorted(unsent))
+        return results[-1]
+
+    def _put_batch(self, batch):
+        """Put a batch, and retry failed entries.
+
+        Returns:
+            tuple: Shard id and sequence number of the last put record.
+            list: Indexes of entries failed after retries.
+        """
+        entries = []
+        for pk, ehk, data in batch:
+            entry = dict(Data=data, PartitionKey=pk)
+            if ehk:
+                entry['ExplicitHashKey'] = ehk
+            entries.append(entry)
+
+        idxs = range(len(entries))
+        last = None, None
+        for retry in xrange(self.max_retry + 1):
+            if retry:
+                time.sleep(KINESIS_RETRY_WAIT * 2 ** (retry - 1))
+            ret = self.client.put_records(StreamName=self.stream_name,
+                                          Records=[entries[i] for i in idxs])
+            failed = []
+            error = None
+            for i, res in zip(idxs, ret['Records']):
+                if 'ErrorCode' in res:
+                    failed.append(i)
+                    error = res['ErrorCode']
+                else:
+                    last = res['ShardId'], res['SequenceNumber']
+            if not failed:
+                return last, []
+            logging.warning("{} of {} kinesis records failed - {}".format(
+                            len(failed), len(idxs), error))
+            idxs = failed
+        logging.error("{} kinesis records failed after {} retries".format(
+                      len(idxs), self.max_retry))
+        return last, idxs
+
+
+class FluentPool(object):
+    """Pooled connections to a fluentd.
+
+    A payload is sent through an idle connection, so tailers send
+    concurrently up to the pool size. Each `FluentSender` reconnects by
+    itself on the next send after a failure.
+    """
+
+    def __init__(self, host, port, max_send_fail, size=None):
+        self.host = host
+        self.port = port
+        self.size = size if size else FLUENT_POOL_SIZE
+        self.senders = [FluentSender(None, host, port,
+                                     max_send_fail=max_send_fail)
+                        for _ in xrange(self.size)]
+        self.idle = Queue.Queue()
+        for sender in self.senders:
+            self.idle.put(sender)
+
+    def send(self, bytes_):
+        """Send a payload through an idle connection.
+
+        Raises:
+            Send exception of the connection.
+        """
+        sender = self.idle.get()
+        try:
+            sender._send(bytes_)
+        finally:
+            self.idle.put(sender)
+
+    def close(self):
+        for sender in self.senders:
+            with sender.lock:
+                sender._close()
+
+
+class FluentEndpoint(object):
+    """A fluentd of a balancer with its load."""
+
+    def __init__(self, pool, circuit, weight):
+        self.pool = pool
+        self.circuit = circuit
+        self.weight = weight if weight > 0 else 1
+        self.inflight = 0  # sends in progress
+        self.current = 0  # smooth weighted round-robin credit
+
+    def load(self):
+        return float(self.inflight) / self.weight, -self.current
+
+
+class FluentBalancer(object):
+    """Pools to fluentds with load balancing and failover.
+
+    A payload goes to the healthy endpoint of the least sends in flight
+    divided by the endpoint weight, so concurrent sends go to less busy
+    endpoints. Ties are broken by smooth weighted round-robin, so sequential
+    sends are spread by weights and interleaved. An endpoint back from a
+    failure gets its share from then on, not the sends it missed.
+
+    An endpoint whose circuit is open after a failure is dropped, and the
+    payload fails over to the next endpoint. When the backoff of the circuit
+    has passed, the endpoint is tried again, and added back on success.
+    """
+
+    def __init__(self, endpoints):
+        """
+        Args:
+            endpoints: List of `FluentEndpoint`.
+        """
+        self.endpoints = endpoints
+        self.lock = threading.Lock()
+
+    def _pick(self, tried):
+        """Return the healthy endpoint of the least load not tried yet."""
+        with self.lock:
+            cands = [ep for ep in self.endpoints if ep not in tried and
+                     ep.circuit.ready()]
+            if not cands:
+                return None
+            for ep in cands:
+                ep.current += ep.weight
+            ep = min(cands, key=FluentEndpoint.load)
+            ep.current -= sum(cand.weight for cand in cands)
+            ep.inflight += 1
+            return ep
+
+    def send(self, bytes_):
+        """Send a payload to an endpoint, failing over to the others.
+
+        Raises:
+            CircuitOpen: All endpoints are down.
+            Send exception of the last endpoint tried.
+        """
+        tried = []
+        error = None
+        while True:
+            ep = self._pick(tried)
+            if ep is None:
+                break
+            tried.append(ep)
+            try:
+                ep.pool.send(bytes_)
+            except Exception as e:
+                ep.circuit.failure()
+                logging.warning("send to '{}' fail '{}'. fail over".format(
+                                ep.circuit.name, e))
+                error = e
+                continue
+            finally:
+                with self.lock:
+                    ep.inflight -= 1
+            ep.circuit.success()
+            return
+        if error is None:
+            raise CircuitOpen("all fluentds are down")
+        raise error
+
+
+class FluentHandle(object):
+    """A tailer's view of a pooled fluentd connection with its own tag.
+
+    The pool may be a `FluentBalancer` of fluentds.
+    """
+
+    def __init__(self, pool, tag):
+        self.pool = pool
+        self.tag = tag
+
+    def send(self, bytes_):
+        self.pool.send(bytes_)
+
+    def emit_with_time(self, label, timestamp, data):
+        tag = '.'.join((self.tag, label)) if label else self.tag
+        self.pool.send(msgpack.packb((tag, timestamp, data)))
+
+
+class CircuitOpen(IOError):
+    pass
+
+
+class CircuitBreaker(object):
+    """Failure state of a destination.
+
+    The circuit opens on a send failure, and sending is not tried until the
+    backoff has passed. Backoff is doubled on each consecutive failure, and
+    shortened by random jitter so that tailers do not retry in lockstep. A
+    successful send closes the circuit.
+    """
+
+    def __init__(self, name, backoff_min=None, backoff_max=None):
+        """
+        Args:
+            name: Destination name for logging.
+            backoff_min(optional): Seconds to wait after the first failure.
+            backoff_max(optional): Max seconds to wait.
+        """
+        self.name = name
+        self.backoff_min = backoff_min if backoff_min else CIRCUIT_BACKOFF_MIN
+        self.backoff_max = backoff_max if backoff_max else CIRCUIT_BACKOFF_MAX
+        self.lock = threading.Lock()
+        self.fails = 0  # consecutive failures
+        self.retry_at = 0
+
+    @property
+    def is_open(self):
+        return self.fails > 0
+
+    def ready(self):
+        """Return True if sending may be tried."""
+        return time.time() >= self.retry_at
+
+    def wait_left(self):
+        """Return seconds until sending may be tried."""
+        return max(self.retry_at - time.time(), 0)
+
+    def success(self):
+        with self.lock:
+            if self.fails:
+                logging.warning("'{}' is back after {} failures".format(
+                                self.name, self.fails))
+            self.fails = 0
+            self.retry_at = 0
+
+    def failure(self):
+        with self.lock:
+            self.fails += 1
+            backoff = min(self.backoff_min * 2 ** min(self.fails - 1, 30),
+                          self.backoff_max)
+            backoff *= 1 - CIRCUIT_JITTER * random.random()
+            self.retry_at = max(self.retry_at, time.time() + backoff)
+            logging.warning("'{}' failed {} times. retry after {:.1f} "
+                            "secs".format(self.name, self.fails, backoff))
+
+
+_fluent_pools = {}
+_fluent_balancers = {}
+_kinesis_clients = {}
+_circuits = {}
+_senders_lock = threading.Lock()
+
+
+def get_fluent_sender(tag, host, port, max_send_fail=None):
+    """Return a handle of the shared connection pool to a fluentd.
+
+    Args:
+        tag: Tag of messages emitted through the handle.
+        host: Fluentd host.
+        port: Fluentd port.
+        max_send_fail(optional): Max send failure of a connection.
+    """
+    max_send_fail = max_send_fail if max_send_fail else MAX_SEND_FAIL
+    with _senders_lock:
+        return FluentHandle(_get_fluent_pool(host, port, max_send_fail), tag)
+
+
+def get_fluent_cluster_sender(tag, endpoints, max_send_fail=None):
+    """Return a handle of the shared balancer to fluentds.
+
+    Pools and circuits of the fluentds are shared with single fluentd
+    senders.
+
+    Args:
+        tag: Tag of messages emitted through the handle.
+        endpoints: List of (host, port, weight) of fluentds.
+        max_send_fail(optional): Max send failure of a connection.
+    """
+    max_send_fail = max_send_fail if max_send_fail else MAX_SEND_FAIL
+    key = (tuple(endpoints), max_send_fail)
+    with _senders_lock:
+        if key not in _fluent_balancers:
+            logging.info("create fluent balancer to {}".format(endpoints))
+            _fluent_balancers[key] = FluentBalancer([
+                FluentEndpoint(_get_fluent_pool(host, port, max_send_fail),
+                               _get_circuit(('fluent', host, port)), weight)
+                for host, port, weight in endpoints])
+        return FluentHandle(_fluent_balancers[key], tag)
+
+
+def _get_fluent_pool(host, port, max_send_fail):
+    key = (host, port, max_send_fail)
+    if key not in _fluent_pools:
+        logging.info("create fluent pool to {}:{}".format(host, port))
+        _fluent_pools[key] = FluentPool(host, port, max_send_fail)
+    return _fluent_pools[key]
+
+
+def get_kinesis_client(region, access_key, secret_key):
+    """Return the shared Kinesis client of a region and credential."""
+    key = (region, access_key, secret_key)
+    with _senders_lock:
+        if key not in _kinesis_clients:
+            logging.info("create kinesis client for {}".format(region))
+            _kinesis_clients[key] = query_aws_client('kinesis', region,
+                                                     access_key, secret_key)
+        return _kinesis_clients[key]
+
+
+def get_circuit(*dest):
+    """Return the shared circuit breaker of a destination.
+
+    Args:
+        dest: Values to identify the destination, ex) 'fluent', host, port
+    """
+    with _senders_lock:
+        return _get_circuit(dest)
+
+
+def _get_circuit(dest):
+    if dest not in _circuits:
+        _circuits[dest] = CircuitBreaker(':'.join(str(v) for v in dest))
+    return _circuits[dest]
+
+
+def close_senders():
+    """Close all shared connections, as on shutdown."""
+    with _senders_lock:
+        for pool in _fluent_pools.values():
+            pool.close()
+        _fluent_pools.clear()
+        _fluent_balancers.clear()
+        _kinesis_clients.clear()
+        _circuits.clear()
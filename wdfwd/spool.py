@@ -0,0 +1,233 @@
+"""On-disk spool of payloads which could not be sent.
+
+Payloads are appended as frames to segment files in the position directory,
+and replayed in order from the oldest segment. A frame head holds payload
+size and events of the payload, so replay counts for event rate limits. A
+segment is removed when all of its frames have been replayed. Replay
+position is saved, so a restart resumes from it.
+
+A segment starts with a head line of the spool version and the payload
+format. Segments of another format, as left before a config change, are set
+aside and not replayed.
+"""
+import os
+import glob
+import time
+import struct
+import logging
+import threading
+
+from wdfwd.util import escape_path
+from wdfwd.checkpoint import write_atomic
+
+
+SPOOL_EXT = '.spool'
+SPOOL_POS_EXT = '.spoolpos'
+SPOOL_ASIDE_EXT = '.aside'  # segments of another format
+SPOOL_VERSION = 1  # version of segment and frame layout
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024  # 1GB
+SPOOL_SEGMENT_BYTES = 1024 * 1024 * 16  # 16MB
+FRAME_HEAD = struct.Struct('<II')  # payload size, events of the payload
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class Spool(object):
+    """Segment files of spooled payloads of a tailer."""
+
+    def __init__(self, sdir, name, fmt, max_bytes=None, segment_bytes=None):
+        """
+        Args:
+            sdir: Directory of segment files.
+            name: Spool name, such as tailer tag and destination.
+            fmt: Payload format, such as 'fluent-forward'.
+            max_bytes(optional): Max bytes of payloads not replayed.
+            segment_bytes(optional): Start a new segment after this bytes.
+        """
+        self.sdir = sdir
+        self.prefix = os.path.join(sdir, escape_path(name))
+        self.fmt = fmt
+        self.head = 'wdfwd-spool {} {}\n'.format(SPOOL_VERSION, fmt)
+        self.max_bytes = max_bytes if max_bytes else SPOOL_MAX_BYTES
+        self.segment_bytes = segment_bytes if segment_bytes else\
+            SPOOL_SEGMENT_BYTES
+        self.lock = threading.Lock()
+        self.wfile = None
+        self.wsize = 0
+        self.unsynced = False  # written frames not flushed to disk yet
+        self.rfile = None
+        self.peeked = 0  # frame size of last peek
+        self.load()
+
+    def get_path(self, seq):
+        return '{}.{:08d}{}'.format(self.prefix, seq, SPOOL_EXT)
+
+    def load(self):
+        """Find segments and replay position left from previous run."""
+        segs = []
+        for path in glob.glob('{}.*{}'.format(self.prefix, SPOOL_EXT)):
+            seq = path[len(self.prefix) + 1:-len(SPOOL_EXT)]
+            if seq.isdigit():
+                segs.append(int(seq))
+        segs.sort()
+
+        read_seq = read_off = 0
+        ppath = self.prefix + SPOOL_POS_EXT
+        if os.path.isfile(ppath):
+            with open(ppath, 'r') as f:
+                elm = f.readline().split(',')
+            try:
+                read_seq, read_off = int(elm[0]), int(elm[1])
+            except (ValueError, IndexError):
+                logging.error("invalid spool pos '{}'".format(ppath))
+
+        # segments replayed before an interrupted removal
+        while segs and segs[0] < read_seq:
+            os.remove(self.get_path(segs.pop(0)))
+        segs = [seq for seq in segs if self._check_head(seq)]
+        if not segs or segs[0] != read_seq:
+            read_off = 0
+        self.segs = segs
+        self.read_off = read_off
+        self.last_seq = segs[-1] if segs else read_seq
+        self.size = sum(os.path.getsize(self.get_path(seq)) for seq in
+                        segs) - read_off
+        if self.size:
+            logging.warning("found {} bytes of spool in {} segments "
+                            "'{}'".format(self.size, len(segs), self.prefix))
+
+    def _check_head(self, seq):
+        """Return True if a segment is of the format, or set it aside."""
+        path = self.get_path(seq)
+        with open(path, 'rb') as f:
+            head = f.read(len(self.head))
+        if head == self.head:
+            return True
+        if self.head.startswith(head):
+            # head of an interrupted write, no frame
+            os.remove(path)
+            return False
+        aside = '{}.{}{}'.format(path, int(time.time()), SPOOL_ASIDE_EXT)
+        os.rename(path, aside)
+        logging.error("spool segment '{}' is not of '{}'. set aside as "
+                      "'{}'".format(path, self.fmt, aside))
+        return False
+
+    def put(self, data, nevents=0):
+        """Append a payload.
+
+        Args:
+            data: Payload bytes.
+            nevents(optional): Events of the payload, for rate limit on
+                replay.
+
+        Raises:
+            SpoolFull: No room for the payload.
+        """
+        with self.lock:
+            fsize = FRAME_HEAD.size + len(data)
+            if self.size + fsize > self.max_bytes:
+                raise SpoolFull("spool '{}' full. {} + {} > {} "
+                                "bytes".format(self.prefix, self.size, fsize,
+                                               self.max_bytes))
+            if self.wfile is None or self.wsize >= self.segment_bytes:
+                self._new_segment()
+            self.wfile.write(FRAME_HEAD.pack(len(data), nevents))
+            self.wfile.write(data)
+            self.wfile.flush()
+            self.unsynced = True
+            self.wsize += fsize
+            self.size += fsize
+
+    def sync(self):
+        """Flush written payloads to disk.
+
+        Call before checkpointing positions past them, not to lose payloads
+        whose lines would not be read again.
+        """
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.wfile is not None and self.unsynced:
+            os.fsync(self.wfile.fileno())
+            self.unsynced = False
+
+    def _new_segment(self):
+        if self.wfile is not None:
+            self._sync()
+            self.wfile.close()
+        # a new segment on start, not to append after a broken frame
+        self.last_seq += 1
+        self.segs.append(self.last_seq)
+        self.wfile = open(self.get_path(self.last_seq), 'wb')
+        self.wfile.write(self.head)
+        self.wfile.flush()
+        self.unsynced = True
+        self.wsize = len(self.head)
+        self.size += self.wsize
+
+    def peek(self):
+        """Return the oldest payload not replayed and its events, or None.
+
+        Returns:
+            tuple: Payload bytes and events of the payload.
+        """
+        with self.lock:
+            while self.segs:
+                seq = self.segs[0]
+                if self.rfile is None:
+                    self.rfile = open(self.get_path(seq), 'rb')
+                    if self.read_off < len(self.head):
+                        # skip the segment head
+                        self.size -= len(self.head) - self.read_off
+                        self.read_off = len(self.head)
+                self.rfile.seek(self.read_off)
+                head = self.rfile.read(FRAME_HEAD.size)
+                if len(head) == FRAME_HEAD.size:
+                    dsize, nevents = FRAME_HEAD.unpack(head)
+                    data = self.rfile.read(dsize)
+                    if len(data) == dsize:
+                        self.peeked = FRAME_HEAD.size + dsize
+                        return data, nevents
+                if self.wfile is not None and seq == self.last_seq:
+                    # being written
+                    return None
+                # end of segment, or a broken frame of interrupted write
+                self._remove_head()
+            return None
+
+    def pop(self):
+        """Mark the peeked payload as replayed."""
+        with self.lock:
+            self.read_off += self.peeked
+            self.size -= self.peeked
+            self.peeked = 0
+
+    def _remove_head(self):
+        seq = self.segs.pop(0)
+        path = self.get_path(seq)
+        self.rfile.close()
+        self.rfile = None
+        self.size -= os.path.getsize(path) - self.read_off
+        os.remove(path)
+        self.read_off = 0
+        logging.info("replayed spool segment '{}'".format(path))
+
+    def save(self):
+        """Save replay position."""
+        with self.lock:
+            seq = self.segs[0] if self.segs else self.last_seq + 1
+            write_atomic(self.prefix + SPOOL_POS_EXT, "{},{}\n".format(
+                         seq, self.read_off))
+
+    def close(self):
+        self.save()
+        with self.lock:
+            self._sync()
+            for f in (self.wfile, self.rfile):
+                if f is not None:
+                    f.close()
+            self.wfile = self.rfile = None
@@ -12,19 +12,32 @@ from StringIO import StringIO
 import traceback
 import json
 import uuid
+import zlib
+import Queue
 import msgpack
-from collections import namedtuple
+from fnmatch import fnmatch
+from collections import namedtuple, deque
 from datetime import datetime
 
 import win32file
 import pywintypes
-from fluent.sender import FluentSender, MAX_SEND_FAIL
+from fluent.sender import MAX_SEND_FAIL
 from aws_kinesis_agg import aggregator
 import pyodbc  # NOQA
 
-from wdfwd.util import OpenNoLock, get_fileid, escape_path, validate_format as\
-    _validate_format, validate_order_ptrn as _validate_order_ptrn,\
-    query_aws_client, decode, is_file
+from wdfwd.util import OpenNoLock, get_fileid, escape_path,\
+    validate_format as _validate_format, validate_order_ptrn as\
+    _validate_order_ptrn, decode, is_file,\
+    map_file_region, iter_lines, count_lines, LRUCache, LOG_LEVELS
+from wdfwd.watcher import get_watcher
+from wdfwd.lineindex import LineIndex, prune_line_index
+from wdfwd.checkpoint import Checkpointer
+from wdfwd.posstore import get_pos_store
+from wdfwd.spool import Spool, SpoolFull
+from wdfwd.ratelimit import make_rate_limiter, get_global_limiter
+from wdfwd.sender import get_fluent_sender, get_fluent_cluster_sender,\
+    get_kinesis_client, KinesisSink, KinesisPartitioner, make_kinesis_encoder,\
+    get_circuit, CircuitOpen, KinesisPutError
 
 pyodbc.pooling = False
 
@@ -38,9 +51,36 @@ FMT_NO_BODY = 0
 FMT_JSON_BODY = 1
 FMT_TEXT_BODY = 2
 BULK_SEND_SIZE = 200
+BULK_SEND_BYTES = 1024 * 1024  # 1MB
+BULK_LINGER = 0  # flush partial bulk at the end of a chunk
 GET_HINFO_TERM = 5
+PARTIAL_LINE_WAIT = 5    # 5 seconds
+MAX_DRAIN_TIME = 5       # 5 seconds
+MAX_DRAIN_BYTES = 1024 * 1024 * 256  # 256MB
+MMAP_WINDOW = 1024 * 1024 * 64  # 64MB
+# max bytes to index before the read position at a read
+LINE_INDEX_GAP_BYTES = 1024 * 1024 * 8  # 8MB
+TAIL_SCAN_BLOCK = 1024 * 64  # 64KB
+WATCH_POLL_TERM = 5  # max poll term when watching changes
+MIN_POLL_STEP = 0.1
+POS_CACHE_SIZE = 64  # max targets of cached sent position
+POS_SWEEP_TERM = 60 * 10  # sweep positions of stale targets
+
+# fluentd forward protocol modes for bulk
+FLUENT_MESSAGE = 'message'  # [tag, time, record] per event
+FLUENT_FORWARD = 'forward'  # [tag, [[time, record], ...]]
+FLUENT_PACKED = 'packed'  # [tag, packed events, option]
+FLUENT_COMPRESSED = 'compressed'  # packed events in gzip
+FLUENT_MODES = (FLUENT_MESSAGE, FLUENT_FORWARD, FLUENT_PACKED,
+                FLUENT_COMPRESSED)
+SEND_QUEUE_SIZE = 16  # max bulks queued to async sender
+SPOOL_RETRY_TERM = 5  # try to replay spool after this seconds of failure
+SPOOL_REPLAY_TIME = 5  # max seconds to replay spool at once
+RATE_LOG_TERM = 60  # log sending rate after this seconds while throttled
 
 FluentCfg = namedtuple('FluentCfg', ['host', 'port'])
+# endpoints: (host, port, weight) of fluentds to balance
+FluentClusterCfg = namedtuple('FluentClusterCfg', ['endpoints'])
 KinesisCfg = namedtuple('KinesisCfg', ['stream_name', 'region', 'access_key',
                                        'secret_key'])
 
@@ -64,85 +104,346 @@ class TailThread(threading.Thread):
         self.linfo("TailThread::__init__ - {}".format(self.name))
         self._exit = False
 
-    def ldebug(self, tabfunc, msg=""):
-        _log(self.tailer, 'debug', tabfunc, msg)
+    def ldebug(self, tabfunc, msg="", *args):
+        _log(self.tailer, 'debug', tabfunc, msg, args)
 
-    def lwarning(self, tabfunc, msg=""):
-        _log(self.tailer, 'warning', tabfunc, msg)
+    def lwarning(self, tabfunc, msg="", *args):
+        _log(self.tailer, 'warning', tabfunc, msg, args)
 
-    def lerror(self, tabfunc, msg=""):
-        _log(self.tailer, 'error', tabfunc, msg)
+    def lerror(self, tabfunc, msg="", *args):
+        _log(self.tailer, 'error', tabfunc, msg, args)
 
-    def linfo(self, tabfunc, msg=""):
-        _log(self.tailer, 'info', tabfunc, msg)
+    def linfo(self, tabfunc, msg="", *args):
+        _log(self.tailer, 'info', tabfunc, msg, args)
 
     def run(self):
         self.linfo("start run")
         self.tailer.update_target(True)
 
-        sltime = 1
-        while True:
+        sltime = self.tailer.poll_min
+        # checked on failures too, so the tailer is closed during a streak
+        while not self._exit:
             try:
-                time.sleep(sltime)
+                self.tailer.wait(sltime)
 
                 st = time.time()
                 self.linfo("TAIL START: sltime {}".format(sltime))
                 self.tailer.tmain()
                 elapsed = time.time() - st
                 self.linfo("TAIL END IN {}".format(elapsed))
-                sltime = 0 if elapsed > 1 else 1
+                sltime = 0 if elapsed > 1 else self.tailer.next_poll_term()
 
                 if self._exit:
                     break
             except NoTarget:
                 self.lwarning("run", "NoTarget")
+                sltime = self.tailer.next_poll_term()
             except Exception as e:
                 self.linfo("run", str(e))
                 tb = traceback.format_exc()
                 for line in tb.splitlines():
                     self.lerror(line)
+                # back off while the destination is down
+                sltime = self.tailer.next_poll_term()
+        self.tailer.close()
 
     def exit(self):
         self.linfo("exit")
         self._exit = True
+        self.tailer.exit_event.set()
+        self.tailer.wakeup()
 
 
-def get_file_lineinfo(path, max_read_buf, post_lines=None):
-    pos_tot = 0
-    line_tot = 0
-    if post_lines:
+class Bulk(list):
+    """Messages of a bulk with their packed entries.
+
+    A message is packed as it is added, so the bulk size is known without
+    packing the bulk again, and the entries are reused to make the payload.
+    The position to resume from after each message is kept if known, so that
+    a partially sent bulk is retried from the first unsent message.
+    """
+
+    def __init__(self, msgs=()):
+        super(Bulk, self).__init__(msgs)
+        self.packed = []
+        self.ends = [None] * len(self)
+        self.nbytes = 0
+        self.since = None  # time of the first message
+
+    def add(self, msg, entry, end=None):
+        """Add a message.
+
+        Args:
+            msg: (time, record)
+            entry: Packed message.
+            end(optional): (target, pos) to resume from after the message.
+        """
+        if not self:
+            self.since = time.time()
+        self.append(msg)
+        self.packed.append(entry)
+        self.ends.append(end)
+        self.nbytes += len(entry)
+
+    def take(self):
+        """Return a new bulk of the messages, and clear this."""
+        bulk = Bulk(self)
+        bulk.packed = self.packed
+        bulk.ends = self.ends
+        bulk.nbytes = self.nbytes
+        bulk.since = self.since
+        self.clear()
+        return bulk
+
+    def clear(self):
+        self[:] = []
+        self.packed = []
+        self.ends = []
+        self.nbytes = 0
+        self.since = None
+
+    def sent_end(self, nsent):
+        """Return (target, pos) to resume from when the first messages have
+        been sent, or None if unknown.
+
+        Args:
+            nsent: Number of the first messages sent.
+        """
+        for end in reversed(self.ends[:nsent]):
+            if end is not None:
+                return end
+        return None
+
+    def after(self, tpos, packed=True):
+        """Return a bulk of the messages after a position.
+
+        Messages up to the last one ending at or before the position have
+        been sent, as messages are read in order.
+
+        Args:
+            tpos: (target, pos) sent so far, or None.
+            packed(optional): Keep packed entries. A destination packing by
+                itself shall not get them.
+        """
+        start = 0
+        if tpos is not None:
+            for i, end in enumerate(self.ends):
+                if end is not None and end[0] == tpos[0] and\
+                        end[1] <= tpos[1]:
+                    start = i + 1
+        if not start and packed:
+            return self
+        bulk = Bulk(self[start:])
+        if packed and len(self.packed) == len(self):
+            bulk.packed = self.packed[start:]
+            bulk.nbytes = sum(len(entry) for entry in bulk.packed)
+        bulk.ends = self.ends[start:]
+        bulk.since = self.since
+        return bulk
+
+
+class SendWorker(threading.Thread):
+    """Send bulks of a tailer from a bounded queue.
+
+    The tailer queues bulks of a chunk followed by an acknowledge marker of
+    the chunk end position. A position is acknowledged only after all bulks
+    before it have been sent. Acknowledged markers are counted, so that the
+    tailer knows how far all of its workers have sent. After a send failure,
+    the rest of the queue is skipped until the tailer resets the worker, and
+    `sent` tells how far this worker has sent.
+    """
+
+    def __init__(self, tailer, maxsize):
+        threading.Thread.__init__(self)
+        self.name = "{}-sender".format(tailer.tag)
+        self.daemon = True
+        self.tailer = tailer
+        self.queue = Queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.nacked = 0  # acknowledged markers not taken by the tailer
+        self.error = None  # [exception, (target, pos) of failed chunk]
+        self.sent = None  # (target, pos) sent so far, if known
+        self.failed = False
+
+    def put(self, msgs, ack=None):
+        """Queue a bulk. Block while the queue is full.
+
+        Args:
+            msgs: List of (time, record) to send.
+            ack(optional): (target, pos) to acknowledge after sending.
+        """
+        self.queue.put((msgs, ack))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                msgs, ack = item
+                if self.failed:
+                    with self.lock:
+                        if ack and self.error[1] is None:
+                            self.error[1] = ack
+                    continue
+                try:
+                    if msgs:
+                        self.tailer._send_bulk(msgs)
+                except Exception as e:
+                    with self.lock:
+                        self._sent(msgs, getattr(e, 'nsent', 0))
+                        self.failed = True
+                        self.error = [e, ack]
+                    continue
+                with self.lock:
+                    self._sent(msgs, len(msgs))
+                    if ack:
+                        self.sent = ack
+                        self.nacked += 1
+            finally:
+                self.queue.task_done()
+
+    def _sent(self, msgs, nsent):
+        if isinstance(msgs, Bulk):
+            end = msgs.sent_end(nsent)
+            if end is not None:
+                self.sent = end
+
+    def wait(self):
+        """Wait until queued bulks are processed."""
+        self.queue.join()
+
+    def take_acked(self, n):
+        """Take acknowledged markers."""
+        with self.lock:
+            self.nacked -= n
+
+    def reset(self):
+        """Resume sending after a failure has been handled."""
+        with self.lock:
+            self.nacked = 0
+            self.failed = False
+            self.error = None
+
+    def stop(self):
+        self.queue.put(None)
+
+
+def get_file_lineinfo(path, max_read_buf, post_lines=None, line_index=None):
+    """Return line count and byte position in a file.
+
+    Lines are only counted, no line strings are made.
+
+    Note:
+        To find the position of the last lines only, use `get_file_tailpos`
+        which does not read the whole file.
+
+    Args:
+        path: File path.
+        max_read_buf: Read buffer size.
+        post_lines(optional): Number of last lines to leave after the
+            position.
+        line_index(optional): LineIndex of the file to count lines with.
+
+    Returns:
+        int: Number of lines before the position.
+        int: Byte position.
+    """
+    end = get_file_tailpos(path, post_lines)[1] if post_lines else None
+    if line_index is not None:
         with OpenNoLock(path) as fh:
-            while True:
-                res, data = win32file.ReadFile(fh, max_read_buf, None)
-                nbyte = len(data)
-                pos_tot += nbyte
-                line_tot += len(data.splitlines())
-                if nbyte < max_read_buf:
-                    break
+            if end is None:
+                end = win32file.GetFileSize(fh)
+            return line_index.count_before(fh, end), end
 
     pos = 0
-    nlines = 0
+    line_tot = 0
+    last = ''
     with OpenNoLock(path) as fh:
-        while True:
-            res, data = win32file.ReadFile(fh, max_read_buf, None)
+        while end is None or pos < end:
+            rsize = max_read_buf if end is None else min(max_read_buf,
+                                                         end - pos)
+            res, data = win32file.ReadFile(fh, rsize, None)
             nbyte = len(data)
-            for line in data.splitlines():
-                if post_lines and line_tot - nlines <= post_lines:
-                    break
-                pos += len(line) + 2  # for \r\n
-                if pos_tot and pos > pos_tot:
-                    pos = pos_tot
-                nlines += 1
-            if nbyte < max_read_buf:
+            pos += nbyte
+            line_tot += count_lines(data, partial=False)
+            if nbyte > 0:
+                last = data[-1]
+            if nbyte < rsize:
                 break
-    return nlines, pos
+    # unterminated last line
+    if last and last != '\n':
+        line_tot += 1
+    return line_tot, pos
+
+
+def get_file_tailpos(path, post_lines, block_size=TAIL_SCAN_BLOCK):
+    """Return byte position from which the last lines of a file start.
+
+    The file is scanned backward from the end block by block, so only the
+    blocks holding the last lines are read.
+
+    Args:
+        path: File path.
+        post_lines: Number of last lines to find.
+        block_size(optional): Size of a block to read at once.
+
+    Returns:
+        int: Number of lines after the position. It is smaller than
+            `post_lines` when the file has fewer lines.
+        int: Byte position.
+    """
+    found = 0
+    with OpenNoLock(path) as fh:
+        size = win32file.GetFileSize(fh)
+        if size == 0 or post_lines <= 0:
+            return 0, size
+
+        # line end of the last line is not a line start
+        end = size - 1
+        while end > 0:
+            start = max(0, end - block_size)
+            win32file.SetFilePointer(fh, start, win32file.FILE_BEGIN)
+            res, data = win32file.ReadFile(fh, end - start, None)
+            idx = len(data)
+            while True:
+                idx = data.rfind('\n', 0, idx)
+                if idx < 0:
+                    break
+                found += 1
+                if found == post_lines:
+                    return found, start + idx + 1
+            end = start
+    # the first line
+    return found + 1, 0
+
 
+def _packed_entries(msgs):
+    """Return packed entries of a bulk, or None if not packed."""
+    if isinstance(msgs, Bulk) and len(msgs.packed) == len(msgs):
+        return msgs.packed
+    return None
 
-def _log(tail, level, tabfunc, _msg):
-    if logging.getLogger().getEffectiveLevel() > getattr(logging,
-                                                         level.upper()):
+
+def _log(tail, level, tabfunc, _msg, args=()):
+    """Log a message of a tailer, and send it to fluentd.
+
+    Formatting is deferred until the level is known to be enabled, so
+    `tail.ldebug(1, "parsed: {}", parsed)` costs only a level check if
+    disabled.
+
+    Args:
+        tail: Tailer of the message.
+        level: Level name.
+        tabfunc: Indent level, or function name.
+        _msg: Message, or its format string if `args` given.
+        args(optional): Arguments to format the message lazily.
+    """
+    if not logging.root.isEnabledFor(LOG_LEVELS[level]):
         return
 
+    if args:
+        _msg = _msg.format(*args)
     lfun = getattr(logging, level)
     if isinstance(tabfunc, int):
         msg = "  " * tabfunc + "{}".format(_msg)
@@ -153,7 +454,8 @@ def _log(tail, level, tabfunc, _msg):
 
     lfun(msg)
     ts = int(time.time())
-    if tail.fsender:
+    # don't wait for a down destination to log
+    if tail.fsender and (tail.circuit is None or tail.circuit.ready()):
         try:
             tail.fsender.emit_with_time("{}".format(level), ts, {"message":
                                                                  msg})
@@ -161,10 +463,365 @@ def _log(tail, level, tabfunc, _msg):
             logging.warning("send fail '{}'".format(e))
 
 
-class BaseTailer(object):
+class Sink(object):
+    """Sending part of a tailer to a destination.
+
+    A tailer sends to its first destination by itself, and to the others by
+    sinks, with messages read and parsed once. A sink has its own sender,
+    circuit, spool and rate limit.
+    """
+
+    def __init__(self, tag, pdir, stream_cfg, max_send_fail, fluent_mode=None,
+                 kinesis_encoder=None, kinesis_partition=None, spool=False,
+                 spool_max_bytes=None, spool_segment_bytes=None,
+                 rate_bytes=None, rate_events=None, exit_event=None):
+        """
+        Args:
+            tag: Tag of messages, with host name.
+            pdir: Directory of spool files.
+            stream_cfg: Log streaming service config (Fluentd / Kinesis)
+            max_send_fail: Maximum number of retries in case of transmission
+                failure
+            exit_event(optional): Event to stop pausing on exit.
+            Others are the same as `BaseTailer`.
+        """
+        self.tag = tag
+        self.fsender = self.kclient = self.circuit = None
+        self.ksent_seqn = self.ksent_shid = None
+        self.sender = None  # SendWorker if sending asynchronously
+        # (target, pos) sent to this destination beyond the saved position,
+        # not to be sent again on retry
+        self.sent_to = None
+
+        max_send_fail = max_send_fail if max_send_fail else MAX_SEND_FAIL
+        tstc = type(stream_cfg)
+        if tstc in (FluentCfg, FluentClusterCfg):
+            if tstc == FluentCfg:
+                host, port = stream_cfg
+                self.fsender = get_fluent_sender(tag, host, port,
+                                                 max_send_fail)
+                self.circuit = get_circuit('fluent', host, port)
+            else:
+                endpoints = stream_cfg.endpoints
+                self.fsender = get_fluent_cluster_sender(tag, endpoints,
+                                                         max_send_fail)
+                # opens only when all endpoints are down
+                self.circuit = get_circuit('fluent', *['{}:{}'.format(
+                                           host, port) for host, port, _ in
+                                           endpoints])
+            fluent_mode = fluent_mode if fluent_mode else FLUENT_FORWARD
+            if fluent_mode not in FLUENT_MODES:
+                self.lerror("invalid fluent_mode '{}'. use '{}'".format(
+                            fluent_mode, FLUENT_FORWARD))
+                fluent_mode = FLUENT_FORWARD
+            self.fluent_mode = fluent_mode
+            self.fluent_tag = '.'.join((tag, "data"))
+            self.packer = msgpack.Packer()
+            # the sender thread makes payloads while messages are packed
+            self.bulk_packer = msgpack.Packer()
+        elif tstc == KinesisCfg:
+            stream_name, region, access_key, secret_key = stream_cfg
+            self.kstream_name = stream_name
+            self.ldebug('get_kinesis_client', '{}', region)
+            self.kclient = get_kinesis_client(region, access_key, secret_key)
+            self.ksink = KinesisSink(self.kclient, stream_name)
+            self.kencoder = make_kinesis_encoder(kinesis_encoder,
+                                                 tag + '.data')
+            self.kpartition = KinesisPartitioner(kinesis_partition, tag)
+            self.kagg = aggregator.RecordAggregator()
+            self.circuit = get_circuit('kinesis', region, stream_name)
+
+        self.spool = None
+        if spool and self.circuit is not None:
+            # named after the destination, and set aside if the payload
+            # format has changed
+            fmt = 'fluent-' + self.fluent_mode if self.fsender else 'kinesis'
+            self.spool = Spool(pdir, '{}.{}'.format(tag, self.circuit.name),
+                               fmt, spool_max_bytes, spool_segment_bytes)
+        self.spool_retry_at = 0
+        self.spool_rest = None  # records of the spool head not put yet
+        self.spool_rest_events = 0  # events of them
+        # serialize sending of the sender thread and spool replay
+        self.send_lock = threading.Lock()
+        # sending pauses on the tailer and process wide limits
+        self.limiter = make_rate_limiter(rate_bytes, rate_events, tag)
+        self.limiters = [lmt for lmt in (self.limiter, get_global_limiter())
+                         if lmt is not None]
+        self.rate_logged = time.time()
+        # stop pausing on exit
+        self.exit_event = exit_event if exit_event else threading.Event()
+
+    def ldebug(self, tabfunc, msg="", *args):
+        _log(self, 'debug', tabfunc, msg, args)
+
+    def linfo(self, tabfunc, msg="", *args):
+        _log(self, 'info', tabfunc, msg, args)
+
+    def lwarning(self, tabfunc, msg="", *args):
+        _log(self, 'warning', tabfunc, msg, args)
+
+    def lerror(self, tabfunc, msg="", *args):
+        _log(self, 'error', tabfunc, msg, args)
+
+    def close(self):
+        """Close the spool of the sink."""
+        if self.spool is not None:
+            self.spool.close()
+
+    def _pack_msg(self, ts, msg):
+        """Return a message packed as an entry of the payload."""
+        if self.fsender:
+            if self.fluent_mode == FLUENT_MESSAGE:
+                return self.packer.pack((self.fluent_tag, ts, msg))
+            return self.packer.pack((ts, msg))
+        elif self.kclient:
+            return self.kencoder.encode(ts, msg)
+        return ''
+
+    def _send_bulk(self, msgs):
+        """Send a bulk.
+
+        Raises:
+            KinesisPutError: Some records have not been put. Its `nsent` is
+                the number of the first messages which have been put.
+        """
+        firsts = None
+        if self.fsender:
+            payload = self._make_fluent_bulk(msgs)
+        elif self.kclient:
+            payload = []
+            firsts = []  # index of the first message of each record
+            for aggd, first in self._iter_kinesis_aggrec(msgs):
+                payload.append(aggd.get_contents())
+                firsts.append(first)
+        else:
+            return
+
+        if self.spool is None:
+            try:
+                self._send_payload(payload, len(msgs))
+            except KinesisPutError as e:
+                # messages before the first one of unsent records are put
+                e.nsent = min(firsts[i] for i in e.unsent) if e.unsent else 0
+                raise
+            return
+        nevents = len(msgs)
+        with self.send_lock:
+            if self.spool.size and (time.time() < self.spool_retry_at or
+                                    not self._replay_spool()):
+                # behind spooled ones
+                self._spool_payload(payload, nevents)
+                return
+            try:
+                self._send_payload(payload, len(msgs))
+            except SpoolFull:
+                raise
+            except Exception as e:
+                self.lwarning("_send_bulk", "send fail '{}'. spool "
+                              "it".format(e))
+                self.spool_retry_at = time.time() + SPOOL_RETRY_TERM
+                if isinstance(e, KinesisPutError):
+                    payload = [payload[i] for i in e.unsent]
+                    ends = firsts[1:] + [nevents]
+                    nevents = sum(ends[i] - firsts[i] for i in e.unsent)
+                self._spool_payload(payload, nevents)
+
+    def _send_payload(self, payload, nevents=0):
+        """Send a payload made from a bulk.
+
+        Args:
+            payload: Fluentd payload, or list of Kinesis records.
+            nevents(optional): Events of the payload, for rate limit.
+
+        Raises:
+            CircuitOpen: The destination is down, and it is not time to retry.
+        """
+        if self.circuit is not None and not self.circuit.ready():
+            raise CircuitOpen("'{}' is down. retry after {:.1f} secs".format(
+                              self.circuit.name, self.circuit.wait_left()))
+        if self.limiters:
+            if self.fsender:
+                nbytes = len(payload)
+            else:
+                nbytes = sum(len(data) for _, _, data in payload)
+            self._throttle(nbytes, nevents)
+        try:
+            if self.fsender:
+                self.fsender.send(payload)
+            elif self.kclient:
+                self._kinesis_put(payload)
+        except Exception:
+            if self.circuit is not None:
+                self.circuit.failure()
+            raise
+        if self.circuit is not None:
+            self.circuit.success()
+
+    def _throttle(self, nbytes, nevents):
+        """Pause until sending is allowed by the rate limits.
+
+        The pause ends early on exit request.
+
+        Args:
+            nbytes: Payload size in bytes.
+            nevents: Events of the payload.
+        """
+        wait = max(lmt.reserve(nbytes, nevents) for lmt in self.limiters)
+        if wait > 0:
+            self.ldebug("_throttle", "pause {:.3f} sec for {} bytes, {} "
+                        "events".format(wait, nbytes, nevents))
+            self.exit_event.wait(wait)
+            if time.time() - self.rate_logged >= RATE_LOG_TERM:
+                self.rate_logged = time.time()
+                for lmt in self.limiters:
+                    self.linfo("_throttle", "rate limit '{}' - {}".format(
+                               lmt.name, lmt.stats()))
+
+    def _spool_payload(self, payload, nevents):
+        data = payload if self.fsender else msgpack.packb(payload)
+        self.spool.put(data, nevents)
+
+    def _replay_spool(self):
+        """Send spooled payloads in order.
+
+        Returns:
+            bool: True if the spool has been drained.
+        """
+        self.linfo("_replay_spool", "{} bytes".format(self.spool.size))
+        st = time.time()
+        try:
+            while time.time() - st < SPOOL_REPLAY_TIME:
+                frame = self.spool.peek()
+                if frame is None:
+                    return True
+                data, nevents = frame
+                if self.fsender:
+                    self._send_payload(data, nevents)
+                else:
+                    if self.spool_rest is None:
+                        self.spool_rest = [tuple(rec) for rec in
+                                           msgpack.unpackb(data)]
+                        self.spool_rest_events = nevents
+                    try:
+                        self._send_payload(self.spool_rest,
+                                           self.spool_rest_events)
+                    except KinesisPutError as e:
+                        # put the rest of the payload only on next replay.
+                        # its events are estimated by share of records.
+                        self.spool_rest_events = self.spool_rest_events *\
+                            len(e.unsent) // len(self.spool_rest)
+                        self.spool_rest = [self.spool_rest[i] for i in
+                                           e.unsent]
+                        raise
+                self.spool.pop()
+                self.spool_rest = None
+        except Exception as e:
+            self.lwarning("_replay_spool", "send fail '{}'".format(e))
+            self.spool_retry_at = time.time() + SPOOL_RETRY_TERM
+            return False
+        finally:
+            self.spool.save()
+        return False
+
+    def may_replay_spool(self):
+        """Replay spool if it is time to retry."""
+        if self.spool is None or not self.spool.size or\
+                time.time() < self.spool_retry_at:
+            return
+        with self.send_lock:
+            self._replay_spool()
+
+    def _make_fluent_bulk(self, msgs):
+        """Make bulk payload for fluentd
+
+        Args:
+            msgs: `Bulk` or list of (time, record).
+
+        Returns:
+            str: Payload in `fluent_mode`.
+        """
+        tag = self.fluent_tag
+        packer = self.bulk_packer
+        pack = packer.pack
+        entries = _packed_entries(msgs)
+        if self.fluent_mode == FLUENT_MESSAGE:
+            if entries is None:
+                entries = [pack((tag, ts, data)) for ts, data in msgs]
+            return ''.join(entries)
+
+        if entries is None:
+            entries = [pack(msg) for msg in msgs]
+        if self.fluent_mode == FLUENT_FORWARD:
+            return ''.join([packer.pack_array_header(2), pack(tag),
+                            packer.pack_array_header(len(entries))] +
+                           entries)
+
+        entries = ''.join(entries)
+        option = {'size': len(msgs)}
+        if self.fluent_mode == FLUENT_COMPRESSED:
+            gz = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+            entries = gz.compress(entries) + gz.flush()
+            option['compressed'] = 'gzip'
+        return pack((tag, entries, option))
+
+    def _kinesis_put(self, records):
+        """Send to AWS Kinesis
+
+        Put aggregated records by batches.
+
+        Args:
+            records: List of (partition key, explicit hash key, data) of
+                aggregated records.
+        """
+        self.linfo('_kinesis_put {} aggregated records'.format(len(records)))
+        st = time.time()
+        shid, seqn = self.ksink.put(records)
+        self.ksent_shid = shid
+        self.ksent_seqn = seqn
+        self.linfo("Kinesis put {} aggregated records in {}: ShardId: {}, "
+                   "SequenceNumber: {}".format(len(records), time.time() - st,
+                                               shid, seqn))
+
+    def _iter_kinesis_aggrec(self, msgs):
+        """Iterate aggregated records of messages.
+
+        Yields:
+            tuple: Aggregated record, and index of its first message.
+        """
+        entries = _packed_entries(msgs)
+        if entries is None:
+            encode = self.kencoder.encode
+            entries = [encode(ts, rec) for ts, rec in msgs]
+        items = [(ts, rec, data, i) for i, ((ts, rec), data) in
+                 enumerate(zip(msgs, entries))]
+        for pk, ehk, gitems in self.kpartition.group(items):
+            # indexes of messages being aggregated
+            idxs = []
+            for _, _, data, i in gitems:
+                idxs.append(i)
+                res = self.kagg.add_user_record(pk, data, ehk)
+                # full aggregated record is returned, send it
+                if res:
+                    yield res, idxs[0]
+                    idxs = idxs[res.get_num_user_records():]
+
+            # an aggregated record is routed by its first partition key
+            aggd = self.kagg.clear_and_get()
+            if aggd:
+                yield aggd, idxs[0]
+
+
+class BaseTailer(Sink):
     def __init__(self, tag, pdir, stream_cfg, send_term,
                  max_send_fail, echo, encoding, lines_on_start,
-                 max_between_data):
+                 max_between_data, poll_min=None, poll_max=None,
+                 pos_flush_term=None, pos_flush_bytes=None, pos_fsync=None,
+                 pos_store=None, pos_cache_size=None, fluent_mode=None,
+                 kinesis_encoder=None, kinesis_partition=None,
+                 bulk_events=None, bulk_bytes=None, spool=False,
+                 spool_max_bytes=None, spool_segment_bytes=None,
+                 rate_bytes=None, rate_events=None):
         """
         Trailer common class initialization
 
@@ -181,45 +838,84 @@ class BaseTailer(object):
                 at startup (for debugging)
             max_between_data: When the service is restarted, unsent logs
                 smaller than this amount are sent.
+            poll_min: Poll term while new data is found. Defaults to
+                send_term.
+            poll_max: Poll term is doubled up to this while idle. Defaults to
+                poll_min, no backoff.
+            pos_flush_term: Flush sent positions after this seconds.
+            pos_flush_bytes: Flush sent positions after this bytes sent.
+            pos_fsync: fsync policy of pos files. See `checkpoint`.
+            pos_store: Kind of position store. See `posstore`.
+            pos_cache_size: Max targets of cached sent position.
+            fluent_mode: Fluentd forward protocol mode for bulk. One of
+                `FLUENT_MODES`.
+            kinesis_encoder: Kinesis record encoder. See `sender`.
+            kinesis_partition: Kinesis partition key strategy. See `sender`.
+            bulk_events: Send a bulk when it has this messages.
+            bulk_bytes: Send a bulk when its packed size reaches this.
+            spool: Spool payloads failed to send in pdir, and replay them
+                later.
+            spool_max_bytes: Max bytes of spool.
+            spool_segment_bytes: Size of spool segment files.
+            rate_bytes: Max bytes per second to send.
+            rate_events: Max events per second to send.
+
+        Note:
+            `stream_cfg` may be a list of configs to send messages of a
+            single read and parse to. Messages are sent to the first one by
+            the tailer, and to the others by `Sink`.
         """
-        super(BaseTailer, self).__init__()
-        self.fsender = self.kclient = None
-        self.ksent_seqn = self.ksent_shid = None
-        self.linfo("__init__", "max_send_fail: '{}'".format(max_send_fail))
+        sink_cfgs = []
+        if type(stream_cfg) is list:
+            stream_cfg, sink_cfgs = stream_cfg[0], stream_cfg[1:]
+        # nothing to log to before the sink is set up
+        self.fsender = self.circuit = None
 
         self.last_get_hinfo = 0
         self.sname, self.saddr = self.get_host_info()
         tag = "{}.{}".format(self.sname.lower() if self.sname is not None else
                              None, tag)
+        super(BaseTailer, self).__init__(tag, pdir, stream_cfg, max_send_fail,
+                                         fluent_mode, kinesis_encoder,
+                                         kinesis_partition, spool,
+                                         spool_max_bytes, spool_segment_bytes,
+                                         rate_bytes, rate_events)
+        self.linfo("__init__", "max_send_fail: '{}'".format(max_send_fail))
         self.linfo(1, "tag: '{}'".format(tag))
-        self.tag = tag
-        self.send_term = send_term
         self.last_send_try = 0
+        self.poll_min = poll_min if poll_min is not None else send_term
+        # faster polling than send term shall also send faster
+        self.send_term = min(send_term, self.poll_min)
+        self.poll_max = max(poll_max, self.poll_min) if poll_max else\
+            self.poll_min
+        self.poll_term = self.poll_min
+        self.turn_sent = 0  # lines sent in last turn
         self.last_update = 0
-        self.kpk_cnt = 0  # count for kinesis partition key
+        self.bulk_events = bulk_events if bulk_events else BULK_SEND_SIZE
+        self.bulk_bytes = bulk_bytes if bulk_bytes else BULK_SEND_BYTES
         self.pdir = pdir
-
-        max_send_fail = max_send_fail if max_send_fail else MAX_SEND_FAIL
-        tstc = type(stream_cfg)
-        if tstc == FluentCfg:
-            host, port = stream_cfg
-            self.fsender = FluentSender(tag, host, port,
-                                        max_send_fail=max_send_fail)
-        elif tstc == KinesisCfg:
-            stream_name, region, access_key, secret_key = stream_cfg
-            self.kstream_name = stream_name
-            self.ldebug('query_aws_client kinesis {}'.format(region))
-            self.kclient = query_aws_client('kinesis', region, access_key,
-                                            secret_key)
-            self.kagg = aggregator.RecordAggregator()
-
         self.send_retry = 0
+        self.fanout = [Sink(tag, pdir, scfg, max_send_fail, fluent_mode,
+                            kinesis_encoder, kinesis_partition, spool,
+                            spool_max_bytes, spool_segment_bytes, rate_bytes,
+                            rate_events, self.exit_event)
+                       for scfg in sink_cfgs]
         self.echo_file = StringIO() if echo else None
-        self.cache_sent_pos = {}
+        self.cache_sent_pos = LRUCache(pos_cache_size if pos_cache_size
+                                       else POS_CACHE_SIZE)
+        spools = [sink.spool for sink in [self] + self.fanout
+                  if sink.spool is not None]
+        self.checkpoint = Checkpointer(get_pos_store(pdir, pos_store),
+                                       pos_flush_term, pos_flush_bytes,
+                                       pos_fsync,
+                                       [spool.sync for spool in spools])
         self.encoding = encoding
         self.lines_on_start = lines_on_start if lines_on_start else 0
         self.max_between_data = max_between_data if max_between_data else\
             MAX_BETWEEN_DATA
+        # set by change notification or exit request
+        self.wake_event = threading.Event()
+        self.notified = False
 
     def get_host_info(self):
         sname = saddr = None
@@ -243,23 +939,77 @@ class BaseTailer(object):
 
         return self.sname, self.saddr
 
-    def ldebug(self, tabfunc, msg=""):
-        _log(self, 'debug', tabfunc, msg)
-
-    def linfo(self, tabfunc, msg=""):
-        _log(self, 'info', tabfunc, msg)
-
-    def lwarning(self, tabfunc, msg=""):
-        _log(self, 'warning', tabfunc, msg)
-
-    def lerror(self, tabfunc, msg=""):
-        _log(self, 'error', tabfunc, msg)
-
     def tmain(self):
         cur = time.time()
         self.ldebug("tmain {}".format(cur))
+        self.turn_sent = 0
+        self.checkpoint.may_flush()
+        self.may_replay_spool()
+        for sink in self.fanout:
+            sink.may_replay_spool()
         return cur
 
+    def next_poll_term(self):
+        """Return seconds to wait before next turn.
+
+        Poll term snaps back to `poll_min` if the last turn has sent new data,
+        otherwise it is doubled up to `poll_max`.
+        """
+        if self.turn_sent:
+            self.poll_term = self.poll_min
+        else:
+            self.poll_term = min(max(self.poll_term * 2, MIN_POLL_STEP),
+                                 self.poll_max)
+        self.ldebug("next_poll_term {}".format(self.poll_term))
+        circuit = self.down_circuit()
+        if circuit is not None:
+            # nothing to do until the destination may be tried
+            return max(circuit.wait_left(), MIN_POLL_STEP)
+        if any(sink.spool is not None and sink.spool.size for sink in
+               [self] + self.fanout):
+            return min(self.poll_term, SPOOL_RETRY_TERM)
+        return self.poll_term
+
+    def down_circuit(self):
+        """Return the circuit of a down destination, or None.
+
+        Reading goes on into the spool if it is used, as always with several
+        destinations, so a down one does not hold back the others.
+        """
+        for sink in [self] + self.fanout:
+            if sink.circuit is not None and sink.spool is None and\
+                    not sink.circuit.ready():
+                return sink.circuit
+        return None
+
+    def sink_down(self):
+        """Return True if reading shall be skipped as a destination is down."""
+        return self.down_circuit() is not None
+
+    def close(self):
+        """Release resources held by the tailer."""
+        self.checkpoint.flush(True)
+        super(BaseTailer, self).close()
+        for sink in self.fanout:
+            sink.close()
+
+    def wait(self, timeout):
+        """Wait for next turn.
+
+        Args:
+            timeout: Seconds to wait if not woken up.
+
+        Returns:
+            bool: True if woken up before timeout.
+        """
+        self.wake_event.wait(timeout)
+        self.notified = self.wake_event.is_set()
+        self.wake_event.clear()
+        return self.notified
+
+    def wakeup(self):
+        self.wake_event.set()
+
     def read_sent_pos(self, target, con):
         """Update the sent position of the target so far.
 
@@ -273,14 +1023,10 @@ class BaseTailer(object):
                 `datetime` for TableTailer.
         """
         self.linfo("read_sent_pos", "updating for '{}'..".format(target))
-        tname = escape_path(target)
-        ppath = os.path.join(self.pdir, tname + '.pos')
-        pos = None
-
-        if os.path.isfile(ppath):
-            with open(ppath, 'r') as f:
-                pos = f.readline()
-            self.linfo(1, "found pos file - {}: {}".format(ppath, pos))
+        pos = self.checkpoint.read(target)
+
+        if pos is not None:
+            self.linfo(1, "found pos - {}: {}".format(target, pos))
             parsed_pos = self.parse_sent_pos(pos)
             if parsed_pos is None:
                 self.lerror("Invalid pos file: '{}'".format(pos))
@@ -292,28 +1038,30 @@ class BaseTailer(object):
             pos = self.get_initial_pos(con)
             self.linfo(1, "can't find valid pos for {}, save as "
                           "initial value {}".format(target, pos))
-            self._save_sent_pos(target, pos)
+            self._save_sent_pos(target, pos, True)
             pos = self.parse_sent_pos(pos)
         return pos
 
-    def _save_sent_pos(self, target, pos):
+    def _save_sent_pos(self, target, pos, force=False):
         """Save sent position for a target flie.
 
+        The position is checkpointed, and written to the pos file when
+        the checkpoint is flushed.
+
         Args:
             target: A target file for which position will be saved.
             pos: Sent position to save.
+            force(optional): Flush right away, as on rotation.
         """
         self.linfo(1, "_save_sent_pos for {} - {}".format(target, pos))
-        tname = escape_path(target)
-        path = os.path.join(self.pdir, tname + '.pos')
-        try:
-            with open(path, 'w') as f:
-                f.write("{}\n".format(pos))
-        except Exception as e:
-            self.lerror("Fail to write pos file: {} {}".format(e, path))
+        prev = self.cache_sent_pos.get(target)
+        nbytes = 0
+        if isinstance(pos, (int, long)) and isinstance(prev, (int, long)):
+            nbytes = max(pos - prev, 0)
+        self.checkpoint.put(target, pos, nbytes, force)
         self.cache_sent_pos[target] = pos
 
-    def _send_newline(self, msg, msgs):
+    def _send_newline(self, msg, msgs, end=None):
         """Send new lines
 
         This does not send right away, but waits for a certain number of
@@ -322,28 +1070,61 @@ class BaseTailer(object):
         Args:
             msg: A message to send
             msgs: Bulk message buffer
+            end(optional): (target, pos) to resume from after the message.
         """
         # self.ldebug("_send_newline {}".format(msg))
         ts = int(time.time())
         self.may_echo(msg)
 
-        msgs.append((ts, msg))
-        if len(msgs) >= BULK_SEND_SIZE:
-            if self.fsender:
-                bytes_ = self._make_fluent_bulk(msgs)
-                self.fsender._send(bytes_)
-            elif self.kclient:
-                self._kinesis_put(msgs)
-            msgs[:] = []
+        msgs.add((ts, msg), self._pack_msg(ts, msg), end)
+        if len(msgs) >= self.bulk_events or msgs.nbytes >= self.bulk_bytes:
+            self._flush_msgs(msgs)
 
     def _send_remain_msgs(self, msgs):
         """Send bulk remain messages."""
         if len(msgs) > 0:
-            if self.fsender:
-                bytes_ = self._make_fluent_bulk(msgs)
-                self.fsender._send(bytes_)
-            elif self.kclient:
-                self._kinesis_put(msgs)
+            self._flush_msgs(msgs)
+
+    def _flush_msgs(self, msgs):
+        """Send a bulk, or queue it to the sender, and clear the buffer.
+
+        A destination gets only the messages it has not sent yet.
+        """
+        # entries are packed for the first destination, sinks pack by
+        # themselves
+        if self.sender is not None:
+            bulk = msgs.take()
+            for sink in [self] + self.fanout:
+                sink.sender.put(bulk.after(sink.sent_to, sink is self))
+        elif self.fanout:
+            self._fanout_bulk(msgs)
+        else:
+            self._send_bulk(msgs)
+            msgs.clear()
+
+    def _fanout_bulk(self, msgs):
+        """Send a bulk to all destinations, and clear the buffer.
+
+        Raises:
+            The first send exception, after all destinations have been tried.
+        """
+        error = None
+        for sink in [self] + self.fanout:
+            bulk = msgs.after(sink.sent_to, sink is self)
+            nsent = len(bulk)
+            try:
+                if bulk:
+                    sink._send_bulk(bulk)
+            except Exception as e:
+                nsent = getattr(e, 'nsent', 0)
+                if error is None:
+                    error = e
+            end = bulk.sent_end(nsent)
+            if end is not None:
+                sink.sent_to = end
+        msgs.clear()
+        if error is not None:
+            raise error
 
     def _handle_send_fail(self, e, rbytes):
         """Handle send exception.
@@ -353,25 +1134,23 @@ class BaseTailer(object):
             rbytes: Size of send message in bytes.
 
         Raises:
-            Re-raise send exception
+            The send exception if it shall be retried.
         """
         self.lwarning(1, "send fail '{}'".format(e))
+        if isinstance(e, (SpoolFull, CircuitOpen)):
+            # never give up, wait for the spool to be replayed or the
+            # destination to be back
+            raise e
         self.send_retry += 1
         if self.send_retry < MAX_SEND_RETRY:
             self.lerror(1, "Not exceed max retry({} < {}), will try "
                         "again".format(self.send_retry,
                                        MAX_SEND_RETRY))
-            raise
+            raise e
         else:
             self.lerror(1, "Exceed max retry, Giving up this change({}"
                         " Bytes)!!".format(rbytes))
 
-    def _make_fluent_bulk(self, msgs):
-        """Make bulk payload for fluentd"""
-        tag = '.'.join((self.tag, "data"))
-        bulk = [msgpack.packb((tag, ts, data)) for ts, data in msgs]
-        return ''.join(bulk)
-
     def may_echo(self, line):
         """Echo sent message for debugging
 
@@ -382,57 +1161,6 @@ class BaseTailer(object):
             self.echo_file.write('{}\n'.format(line))
             self.echo_file.flush()
 
-    def _kinesis_put(self, msgs):
-        """Send to AWS Kinesis
-
-        Make aggregated message and send it.
-
-        Args:
-            msgs: Messages to send
-        """
-        self.linfo('_kinesis_put {} messages'.format(len(msgs)))
-        self.kpk_cnt += 1  # round robin shards
-        for aggd in self._iter_kinesis_aggrec(msgs):
-            pk, ehk, data = aggd.get_contents()
-            self.linfo("  kinesis aggregated put_record: {} "
-                       "bytes".format(len(data)))
-            st = time.time()
-            ret = self.kclient.put_record(
-                StreamName=self.kstream_name,
-                Data=data,
-                PartitionKey=pk,
-                ExplicitHashKey=ehk
-            )
-            stat = ret['ResponseMetadata']['HTTPStatusCode']
-            shid = ret['ShardId']
-            seqn = ret['SequenceNumber']
-            self.ksent_seqn = seqn
-            self.ksent_shid = shid
-            elp = time.time() - st
-            if stat == 200:
-                self.linfo("Kinesis put success in {}: ShardId: {}, "
-                           "SequenceNumber: {}".format(elp, shid, seqn))
-            else:
-                self.error("Kineis put failed in {}!: "
-                           "{}".format(elp, ret['ResponseMetadata']))
-
-    def _iter_kinesis_aggrec(self, msgs):
-        for msg in msgs:
-            data = {'tag_': self.tag + '.data', 'ts_': msg[0]}
-            if isinstance(msg[1], dict):
-                data.update(msg[1])
-            else:
-                data['value_'] = msg[1]
-
-            pk = str(uuid.uuid4())
-            res = self.kagg.add_user_record(pk, str(data))
-            # if payload fits max send size, send it
-            if res:
-                yield self.kagg.clear_and_get()
-
-        # send remain payload
-        yield self.kagg.clear_and_get()
-
 
 class TableTailer(BaseTailer):
 
@@ -441,12 +1169,26 @@ class TableTailer(BaseTailer):
                  send_term=DB_SEND_TERM, max_send_fail=None, echo=False,
                  encoding=None, lines_on_start=None, max_between_data=None,
                  millisec_ndigit=None,
-                 start_key_sp=None, latest_rows_sp=None):
+                 start_key_sp=None, latest_rows_sp=None, poll_min=None,
+                 poll_max=None, pos_flush_term=None, pos_flush_bytes=None,
+                 pos_fsync=None, pos_store=None, pos_cache_size=None,
+                 fluent_mode=None, kinesis_encoder=None,
+                 kinesis_partition=None, bulk_events=None, bulk_bytes=None,
+                 spool=False, spool_max_bytes=None, spool_segment_bytes=None,
+                 rate_bytes=None, rate_events=None):
         """init TableTailer"""
         super(TableTailer, self).__init__(tag, pdir, stream_cfg,
                                           send_term,
                                           max_send_fail, echo, encoding,
-                                          lines_on_start, max_between_data)
+                                          lines_on_start, max_between_data,
+                                          poll_min, poll_max, pos_flush_term,
+                                          pos_flush_bytes, pos_fsync,
+                                          pos_store, pos_cache_size,
+                                          fluent_mode, kinesis_encoder,
+                                          kinesis_partition, bulk_events,
+                                          bulk_bytes, spool, spool_max_bytes,
+                                          spool_segment_bytes, rate_bytes,
+                                          rate_events)
         self.linfo(0, "TableTailer - init")
         self.dbcfg = dbcfg
         self.table = table
@@ -504,6 +1246,7 @@ class TableTailer(BaseTailer):
         cur = super(TableTailer, self).tmain()
 
         sent_line, _ = self.may_send_newlines(cur)
+        self.turn_sent = sent_line
         return sent_line
 
     def get_sent_pos(self, con):
@@ -525,6 +1268,9 @@ class TableTailer(BaseTailer):
             pos: Position to be saved.
         """
         self._save_sent_pos(self.table, pos)
+        # sent by all destinations
+        for sink in [self] + self.fanout:
+            sink.sent_to = None
 
     def select_lines_to_send(self, con, pos):
         """Select lines to send from position
@@ -564,6 +1310,9 @@ class TableTailer(BaseTailer):
             netok: True if sending causes no network problem.
         """
         # self.ldebug("may_send_newlines")
+        if self.sink_down():
+            self.ldebug(1, "destination is down. skip")
+            return 0, False
 
         if cur - self.last_send_try >= self.send_term:
             self.ldebug(1, "{} >= {}".format(cur - self.last_send_try,
@@ -681,8 +1430,10 @@ class TableTailer(BaseTailer):
             self.queue_lines.append(msg)
         elif self.queue_lines_dt != dt:
             scnt = len(self.queue_lines)
-            for ql in self.queue_lines:
-                self._send_newline(ql, msgs)
+            # sending resumes after the last message of a key value
+            end = (self.table, self.queue_lines_dt)
+            for i, ql in enumerate(self.queue_lines):
+                self._send_newline(ql, msgs, end if i == scnt - 1 else None)
             sent_info = scnt, self.queue_lines_dt
             self.queue_lines = [msg]
             self.queue_lines_dt = dt
@@ -709,8 +1460,10 @@ class TableTailer(BaseTailer):
         self.ldebug("send_new_lines")
         scnt = 0
         last_kv = None
+        # lines queued before a send failure are selected again
+        self._clear_queue_lines()
         try:
-            msgs = []
+            msgs = Bulk()
 
             for cols in cursor:
                 kv, msg = self.make_json(cols)
@@ -811,22 +1564,88 @@ class FileTailer(BaseTailer):
                  max_send_fail=None, elatest=None, echo=False, encoding=None,
                  lines_on_start=None, max_between_data=None, format=None,
                  parser=None, order_ptrn=None, reverse_order=False,
-                 max_read_buffer=None):
+                 max_read_buffer=None, partial_line_wait=None,
+                 drain_time=None, drain_bytes=None, use_mmap=False,
+                 mmap_window=None, watch_changes=False,
+                 watch_poll_term=None, poll_min=None, poll_max=None,
+                 line_index=None, pos_flush_term=None, pos_flush_bytes=None,
+                 pos_fsync=None, pos_store=None, pos_cache_size=None,
+                 fluent_mode=None, kinesis_encoder=None,
+                 kinesis_partition=None, async_send=False,
+                 send_queue_size=None, bulk_events=None, bulk_bytes=None,
+                 bulk_linger=None, spool=False, spool_max_bytes=None,
+                 spool_segment_bytes=None, rate_bytes=None, rate_events=None):
 
         super(FileTailer, self).__init__(tag, pdir, stream_cfg, send_term,
                                          max_send_fail, echo,
                                          encoding, lines_on_start,
-                                         max_between_data)
+                                         max_between_data, poll_min,
+                                         poll_max, pos_flush_term,
+                                         pos_flush_bytes, pos_fsync,
+                                         pos_store, pos_cache_size,
+                                         fluent_mode, kinesis_encoder,
+                                         kinesis_partition, bulk_events,
+                                         bulk_bytes, spool, spool_max_bytes,
+                                         spool_segment_bytes, rate_bytes,
+                                         rate_events)
+        self.last_sweep = time.time()
         self.bdir = bdir
         self.ptrn = ptrn
         self.update_term = update_term
+        # identity of target paths is checked every update term
+        self.last_path_check = 0
         self.target_path = self.target_fid = None
+        # cached read handle of the target, kept open across ticks
+        self.target_fh = None
         self.reverse_order = reverse_order
 
         self.elatest = elatest
         self.elatest_fid = None
         self.max_read_buffer = max_read_buffer if max_read_buffer else\
             MAX_READ_BUF
+        # an unterminated last line is held back for this seconds
+        self.partial_line_wait = partial_line_wait if partial_line_wait is\
+            not None else PARTIAL_LINE_WAIT
+        self.partial_line = None
+        self.partial_since = 0
+        # budget for reading a backlog larger than buffer in a tick
+        self.drain_time = drain_time if drain_time is not None else\
+            MAX_DRAIN_TIME
+        self.drain_bytes = drain_bytes if drain_bytes is not None else\
+            MAX_DRAIN_BYTES
+        # read backlog larger than buffer by memory map
+        self.use_mmap = use_mmap
+        self.mmap_window = mmap_window if mmap_window else MMAP_WINDOW
+        # wake up by directory change notification, and poll no less often
+        # than this as fallback
+        self.watch_poll_term = watch_poll_term if watch_poll_term else\
+            WATCH_POLL_TERM
+        # partial bulk is held across chunks for this seconds
+        self.bulk_linger = bulk_linger if bulk_linger is not None else\
+            BULK_LINGER
+        self.bulk = Bulk()
+        self.held_pos = None  # (target, pos) read into the held bulk
+        # (target, pos) to resume from after the last message of the bulk
+        self.bulk_end = None
+        self.msg_end = None  # offset to resume from after a message
+        # read and parse while a worker sends
+        self.queued_pos = None  # (target, pos) queued to the sender
+        self.senders = []  # workers of the tailer and fan-out sinks
+        self.acks = deque()  # (target, pos) queued to workers
+        if async_send or self.fanout:
+            # each sink sends from its own queue
+            qsize = send_queue_size if send_queue_size else SEND_QUEUE_SIZE
+            for sink in [self] + self.fanout:
+                sink.sender = SendWorker(sink, qsize)
+                sink.sender.start()
+                self.senders.append(sink.sender)
+        # index every this lines of targets, 0 for no index
+        self.line_index_interval = line_index if line_index else 0
+        self.line_index = None
+        self.watcher = None
+        if watch_changes:
+            self.watcher = get_watcher()
+            self.watcher.subscribe(bdir, self.wake_event, [ptrn, elatest])
         self.linfo("effective format: '{}'".format(format))
         self.format = self.validate_format(format)
         self.fmt_body = self.format_body_type(format)
@@ -834,6 +1653,7 @@ class FileTailer(BaseTailer):
         self.order_ptrn = self.validate_order_ptrn(order_ptrn)
         self.parser_compl = 0
         self.no_format = False
+        self.hot_debug = False  # debug level, checked once per chunk
 
     def format_body_type(self, format):
         if format:
@@ -857,7 +1677,10 @@ class FileTailer(BaseTailer):
 
     def _tmain_may_send_newlines(self, cur, scnt, netok):
         self.ldebug("_tmain_may_send_newlines")
-        if cur - self.last_send_try >= self.send_term:
+        if self.sink_down():
+            self.ldebug(1, "destination is down. skip reading")
+            return scnt, False
+        if self.notified or cur - self.last_send_try >= self.send_term:
             self.ldebug(1, "{} >= {}".format(cur - self.last_send_try,
                                              self.send_term))
             try:
@@ -887,16 +1710,20 @@ class FileTailer(BaseTailer):
         netok = True
         # handle if elatest file has been rotated
         latest_rot = False
-        if not self.elatest:
-            latest_rot = self.handle_file_recreate(cur)
-        else:
-            try:
-                epath = os.path.join(self.bdir, self.elatest)
-                latest_rot = self.handle_elatest_rotation(epath, cur)
-            except pywintypes.error as e:
-                self.lerror("File '{}' open error - {}".format(epath, e))
-                self.lwarning("Skip to next turn")
-                return
+        # opening a path costs idle tailers, check it every update term or
+        # when woken by change notification
+        if self.notified or cur - self.last_path_check >= self.update_term:
+            self.last_path_check = cur
+            if not self.elatest:
+                latest_rot = self.handle_file_recreate(cur)
+            else:
+                try:
+                    epath = os.path.join(self.bdir, self.elatest)
+                    latest_rot = self.handle_elatest_rotation(epath, cur)
+                except pywintypes.error as e:
+                    self.lerror("File '{}' open error - {}".format(epath, e))
+                    self.lwarning("Skip to next turn")
+                    return
 
         psent_pos = self.get_sent_pos() if self.target_path else None
 
@@ -913,24 +1740,119 @@ class FileTailer(BaseTailer):
         # if nothing sent with net ok, try update target timely
         if not latest_rot and (sent_line == 0 and netok):
             self._tmain_may_update_target(cur)
+        if cur - self.last_sweep >= POS_SWEEP_TERM:
+            self.last_sweep = cur
+            self.sweep_sent_pos()
+            if self.line_index_interval:
+                # opens files of the directory, so not on every rotation
+                prune_line_index(self.pdir, self.bdir)
+        self.turn_sent = sent_line
         return latest_rot, psent_pos, sent_line
 
+    def close(self):
+        try:
+            self.flush_sender()
+        except Exception as e:
+            self.lerror("close", "send fail '{}'".format(e))
+        for sink in [self] + self.fanout:
+            if sink.sender is not None:
+                sink.sender.stop()
+                sink.sender = None
+        self.senders = []
+        super(FileTailer, self).close()
+        self.close_target_handle()
+        if self.watcher is not None:
+            self.watcher.unsubscribe(self.bdir, self.wake_event)
+            self.watcher = None
+
+    def wait(self, timeout):
+        if self.watcher is not None:
+            # notification may be deferred for a file being written, so an
+            # idle tailer still polls within the watch poll term
+            timeout = min(timeout, self.watch_poll_term)
+        return super(FileTailer, self).wait(timeout)
+
+    def next_poll_term(self):
+        term = super(FileTailer, self).next_poll_term()
+        if self.bulk and not self.sink_down():
+            # wake up to flush the lingering bulk
+            left = self.bulk.since + self.bulk_linger - time.time()
+            term = min(term, max(left, MIN_POLL_STEP))
+        return term
+
+    def get_target_handle(self):
+        """Return read handle of current target.
+
+        The handle is opened once and kept open across ticks. It is closed
+        only when the target is changed, rotated or recreated.
+
+        Returns:
+            PyHANDLE: Shared-read handle of the target file.
+        """
+        self.raise_if_notarget()
+        if self.target_fh is None:
+            self.ldebug("get_target_handle", "open '{}'".format(
+                        self.target_path))
+            ofh = OpenNoLock(self.target_path)
+            ofh.open()
+            self.target_fh = ofh
+        return self.target_fh.handle
+
+    def close_target_handle(self):
+        if self.target_fh is not None:
+            self.ldebug("close_target_handle")
+            self.target_fh.close()
+            self.target_fh = None
+
+    def _target_drained(self):
+        """Return True if all data of the cached target handle is sent."""
+        if self.target_fh is None:
+            return True
+        size = win32file.GetFileSize(self.target_fh.handle)
+        return size <= self.get_sent_pos()
+
     def set_target(self, target):
         changed = self.target_path != target
         if changed:
             self.linfo("set_target from '{}' to '{}'".format(self.target_path,
                                                              target))
+            self.flush_sender()
+            self.close_target_handle()
+            # positions of the previous target are final
+            self.checkpoint.flush(True)
             self.target_path = target
             self.target_fid = None
+            self.line_index = None
             if target:
                 if os.path.isfile(target):
-                    with OpenNoLock(target) as fh:
-                        self.target_fid = get_fileid(fh)
+                    self.target_fid = get_fileid(self.get_target_handle())
+                    self.open_line_index()
                 else:
                     self.lerror("set_target", "target file '{}' not "
                                 "exists".format(target))
         return changed
 
+    def open_line_index(self):
+        """Load line index of the target."""
+        if not self.line_index_interval:
+            return
+        self.line_index = LineIndex(self.pdir, self.bdir, self.target_fid,
+                                    self.line_index_interval)
+        self.line_index.validate(self.get_target_handle())
+        self.line_index.save()
+
+    def _index_lines(self, data, pos, start, end):
+        lidx = self.line_index
+        if lidx is None:
+            return
+        if lidx.scan_pos < pos:
+            # started from a saved position, index lines before it little by
+            # little not to hold back sending. lookups index on demand too
+            lidx.extend(self.get_target_handle(),
+                        min(pos, lidx.scan_pos + LINE_INDEX_GAP_BYTES))
+        if lidx.feed(data, pos, start, end):
+            lidx.save()
+
     def _update_elatest_target(self, files):
         self.linfo("_update_elatest_target")
         epath, efid = self.get_elatest_info()
@@ -945,6 +1867,12 @@ class FileTailer(BaseTailer):
     def handle_file_recreate(self, cur=None):
         ret = 0
         if self.target_path:
+            if not self._target_drained():
+                # The cached handle keeps reading the original file even if
+                # it has been removed or recreated. Check the path only after
+                # the remaining data has been sent.
+                return ret
+
             if not os.path.isfile(self.target_path):
                 self.lwarning("handle_file_recreate",
                               "target file '{}' has been removed, but new"
@@ -961,13 +1889,204 @@ class FileTailer(BaseTailer):
 
         if ret > 0:
             self.linfo(1, "reset target to delegate update_target")
-            self.save_sent_pos(self.get_initial_pos(None))
+            self.save_sent_pos(self.get_initial_pos(None), True)
             self.set_target(None)
         return ret
 
     def get_initial_pos(self, con):
         return 0
 
+    def get_read_pos(self):
+        """Return position of the target to read from.
+
+        It is ahead of the sent position while a bulk lingers, or queued data
+        is being sent.
+        """
+        for tpos in (self.held_pos, self.queued_pos):
+            if tpos is not None and tpos[0] == self.target_path:
+                return tpos[1]
+        return self.get_sent_pos()
+
+    def _commit_sent_pos(self, pos):
+        """Save sent position, or queue it to be acknowledged by the sender.
+
+        The position is held while the bulk lingers, and committed when the
+        bulk is flushed.
+
+        Returns:
+            bool: True if the sender has failed, and reading shall restart
+                from the sent position.
+        """
+        if self.bulk:
+            self.held_pos = (self.target_path, pos)
+            return False
+        self.held_pos = None
+        return self._commit_pos((self.target_path, pos))
+
+    def _commit_pos(self, tpos, collect=True):
+        if self.sender is None:
+            self._save_sent_pos(*tpos)
+            return False
+        self.queued_pos = tpos
+        self.acks.append(tpos)
+        for sender in self.senders:
+            sender.put([], tpos)
+        return self.collect_sent() if collect else False
+
+    def _flush_msgs(self, msgs):
+        super(FileTailer, self)._flush_msgs(msgs)
+        if msgs is not self.bulk:
+            return
+        # data of previous chunks, and the chunk up to the bulk end has been
+        # sent, retry shall resend only the rest
+        tposs = [tpos for tpos in (self.held_pos, self.bulk_end) if tpos is
+                 not None]
+        self.held_pos = self.bulk_end = None
+        if tposs:
+            self._commit_pos(max(tposs, key=lambda tpos: tpos[1]), False)
+
+    def may_flush_bulk(self, force=False):
+        """Send the bulk if linger time has passed.
+
+        Args:
+            force(optional): Send regardless of linger time.
+        """
+        if not self.bulk:
+            return
+        if force or time.time() - self.bulk.since >= self.bulk_linger:
+            try:
+                self._flush_msgs(self.bulk)
+            except Exception as e:
+                self._drop_bulk(e)
+
+    def _drop_bulk(self, e):
+        """Handle send failure of the bulk.
+
+        Held data is read again from the sent position on retry. If the first
+        messages of the bulk have been sent, retry starts after them.
+        """
+        nbytes = self.bulk.nbytes
+        progress = self.bulk.sent_end(getattr(e, 'nsent', 0))
+        self.bulk.clear()
+        self.held_pos = self.bulk_end = None
+        if progress is not None and self.sender is None:
+            self._save_sent_pos(*progress)
+        self._handle_send_fail(e, nbytes)
+
+    def collect_sent(self):
+        """Save positions acknowledged by the sender, and handle its failure.
+
+        Returns:
+            bool: True if the sender has failed.
+
+        Raises:
+            Send exception if it shall be retried.
+        """
+        if self.sender is None:
+            return False
+        failed = [sender for sender in self.senders if sender.failed]
+        if failed:
+            # let the rest of queues be skipped to know the failed chunk
+            for sender in self.senders:
+                sender.wait()
+        acked = self._take_acked()
+        if acked:
+            self._save_sent_pos(*acked)
+            self.send_retry = 0
+            for sink in [self] + self.fanout:
+                if sink.sent_to is not None and sink.sent_to[0] ==\
+                        acked[0] and sink.sent_to[1] <= acked[1]:
+                    sink.sent_to = None
+        if not failed:
+            return False
+
+        # data is read again from the saved position, and each destination
+        # skips what it has sent
+        e, ack = failed[0].error
+        for sink in [self] + self.fanout:
+            sink.sent_to = sink.sender.sent
+        progs = [sender.sent for sender in failed]
+        self.queued_pos = None
+        self.acks.clear()
+        for sender in self.senders:
+            sender.reset()
+        if None not in progs and len(set(tpos[0] for tpos in progs)) == 1:
+            # sent by all up to the least sent by failed ones
+            prog = min(progs, key=lambda tpos: tpos[1])
+            if prog[1] > self.get_sent_pos(prog[0]):
+                self._save_sent_pos(*prog)
+        self._handle_send_fail(e, ack[1] - self.get_sent_pos(ack[0]))
+        # gave up the failed chunk
+        self._save_sent_pos(*ack)
+        self.send_retry = 0
+        for sink in [self] + self.fanout:
+            sink.sent_to = None
+        return True
+
+    def _take_acked(self):
+        """Return the last position acknowledged by all workers, or None."""
+        n = min(sender.nacked for sender in self.senders)
+        if not n:
+            return None
+        for sender in self.senders:
+            sender.take_acked(n)
+        for _ in xrange(n - 1):
+            self.acks.popleft()
+        return self.acks.popleft()
+
+    def flush_sender(self):
+        """Send the bulk, wait for queued data to be sent, and save
+        positions."""
+        self.may_flush_bulk(True)
+        if self.sender is not None:
+            for sender in self.senders:
+                sender.wait()
+            self.collect_sent()
+            self.queued_pos = None
+
+    def _is_own_target(self, fname):
+        return fnmatch(fname, self.ptrn) or (self.elatest is not None and
+                                             fname == self.elatest)
+
+    def sweep_sent_pos(self):
+        """Drop sent positions of stale targets.
+
+        Cached targets which no longer exist or match the pattern, and saved
+        positions of matching targets which no longer exist are removed
+        from cache and position store.
+
+        Returns:
+            list: Removed targets.
+        """
+        stale = set()
+        for target in self.cache_sent_pos.keys():
+            if target == self.target_path:
+                continue
+            if not self._is_own_target(os.path.basename(target)) or\
+                    not os.path.isfile(target):
+                stale.add(target)
+
+        # saved ones of this tailer are keyed by escaped path in bdir
+        prefix = escape_path(os.path.join(self.bdir, ''))
+        for key in self.checkpoint.store.keys():
+            if not key.startswith(prefix):
+                continue
+            fname = key[len(prefix):]
+            if not self._is_own_target(fname):
+                continue
+            target = os.path.join(self.bdir, fname)
+            if target != self.target_path and not os.path.isfile(target):
+                stale.add(target)
+
+        if stale:
+            self.linfo("sweep_sent_pos", "{} stale targets".format(
+                       len(stale)))
+            for target in stale:
+                self.cache_sent_pos.pop(target)
+            self.checkpoint.discard(stale)
+            self.checkpoint.store.delete(stale)
+        return list(stale)
+
     def handle_elatest_rotation(self, epath=None, cur=None):
         cur = cur if cur else int(time.time())
         if not epath:
@@ -989,6 +2108,7 @@ class FileTailer(BaseTailer):
                               " update_target "
                               "immediately.".format(self.elatest_fid, efid))
 
+            self.flush_sender()
             self.elatest_fid = None
             # get pre-elatest, which should exist
             files = self.get_sorted_target_files()
@@ -1000,9 +2120,9 @@ class FileTailer(BaseTailer):
 
             self.linfo(1, "move sent pos & clear elatest sent pos")
             # even elatest file not exist, there might be pos file
-            self._save_sent_pos(pre_elatest, self.get_sent_pos(epath))
+            self._save_sent_pos(pre_elatest, self.get_sent_pos(epath), True)
             # reset elatest sent_pos
-            self._save_sent_pos(epath, self.get_initial_pos(None))
+            self._save_sent_pos(epath, self.get_initial_pos(None), True)
             self.last_update = cur
             # pre-elatest is target for now
             self.set_target(pre_elatest)
@@ -1086,6 +2206,8 @@ class FileTailer(BaseTailer):
             tpath = path
         self.ldebug("get_file_pos", "for {}".format(tpath))
         try:
+            if tpath == self.target_path:
+                return win32file.GetFileSize(self.get_target_handle())
             with OpenNoLock(tpath) as fh:
                 return win32file.GetFileSize(fh)
         except pywintypes.error as e:
@@ -1107,7 +2229,8 @@ class FileTailer(BaseTailer):
 
         if self.fmt_body == FMT_JSON_BODY:
             if '_json_' in gd:
-                self.linfo(1, "json data found")
+                if self.hot_debug:
+                    self.ldebug(1, "json data found")
                 has_body = True
                 try:
                     msg = json.loads(gd['_json_'])
@@ -1119,7 +2242,8 @@ class FileTailer(BaseTailer):
                 self.lwarning(1, "no json body found: {}'".format(msg[:50]))
         elif self.fmt_body == FMT_TEXT_BODY:
             if '_text_' in gd:
-                self.linfo(1, "text data found")
+                if self.hot_debug:
+                    self.ldebug(1, "text data found")
                 has_body = True
                 msg = {}
                 msg['message'] = gd['_text_']
@@ -1139,40 +2263,94 @@ class FileTailer(BaseTailer):
         return msg
 
     def convert_msg(self, msg):
-        self.ldebug("convert_msg")
+        # called per line, debug logs are guarded by the level checked once
+        # per chunk
+        debug = self.hot_debug
         if self.encoding:
             try:
                 msg = decode(msg, self.encoding).encode('utf8')
             except Exception:
-                self.lwarning(1, "fail to decode '{}'".format(msg))
+                self.lwarning(1, "fail to decode '{}'", msg)
                 return None
 
-        parsed = None
-        self.ldebug(1, "try match format {}".format(msg))
-        self.ldebug(1, "search start")
+        if debug:
+            self.ldebug(1, "try match format {}", msg)
         match = self.format.search(msg)
-        self.ldebug(1, "search end")
         if match:
             parsed = self._convert_matched_msg(match)
-            self.ldebug(1, "parsed: {}".format(parsed))
+            if debug:
+                self.ldebug(1, "parsed: {}", parsed)
             return parsed
         else:
-            self.lwarning(1, "can't parse line '{}'".format(msg[:50]))
+            self.lwarning(1, "can't parse line '{}'", msg[:50])
             return None
 
-    def _read_target_to_end(self, fh):
+    def _read_target_to_end(self, fh, pos):
+        """Read complete lines from the target.
+
+        Only data up to the last line end is returned. An unterminated tail
+        is left unsent, and read again from its start on the next read.
+
+        Args:
+            fh: Target file handle, whose pointer is at `pos`.
+            pos: File position from which to read.
+
+        Returns:
+            str: Read data, which may have a partial line after the lines.
+            int: Size of the complete lines in bytes.
+        """
         self.raise_if_notarget()
 
         res, lines = win32file.ReadFile(fh, self.max_read_buffer, None)
-        nbyte = len(lines)
         if res != 0:
             self.lerror(1, "ReadFile Error! {}".format(res))
             return '', 0
-        if nbyte == self.max_read_buffer:
-            self.lwarning(1, "Read Buffer Full! Possibly corrupted last line.")
 
+        nbyte = self._complete_line_bytes(lines, pos, 0, len(lines),
+                                          self.max_read_buffer)
         return lines, nbyte
 
+    def _complete_line_bytes(self, data, pos, start, end, bufsize):
+        """Return size of the data up to the last complete line.
+
+        Note:
+            A partial line is regarded as complete when there is no line end
+            in a full read buffer, or it has not been completed for
+            `partial_line_wait` seconds.
+
+        Args:
+            data: Data read from the target. `str` or `mmap`.
+            pos: File position from which the data has been read.
+            start: Start offset of the read data in `data`.
+            end: End offset of the read data in `data`.
+            bufsize: Size of the buffer used for reading.
+        """
+        nbyte = end - start
+        end = data.rfind('\n', start, end) + 1
+        end = end - start if end > 0 else 0
+        if end == nbyte:
+            self.partial_line = None
+            return end
+
+        if end == 0 and nbyte == bufsize:
+            self.lwarning(1, "Read Buffer Full! No line end in {} "
+                          "bytes.".format(nbyte))
+            return nbyte
+
+        partial = (self.target_path, pos + nbyte)
+        cur = time.time()
+        if partial != self.partial_line:
+            self.partial_line = partial
+            self.partial_since = cur
+        if cur - self.partial_since >= self.partial_line_wait:
+            self.lwarning(1, "partial line not completed for {} seconds. "
+                          "send as it is.".format(cur - self.partial_since))
+            self.partial_line = None
+            return nbyte
+
+        self.ldebug(1, "hold {} bytes of partial line".format(nbyte - end))
+        return end
+
     def get_elatest_info(self):
         self.linfo("get_elatst_info")
         if self.elatest:
@@ -1194,9 +2372,11 @@ class FileTailer(BaseTailer):
 
         self.ldebug("may_send_newlines")
 
+        self.collect_sent()
+        self.may_flush_bulk()
         # skip if no newlines
         file_pos = self.get_file_pos()
-        sent_pos = self.get_sent_pos()
+        sent_pos = self.get_read_pos()
         self.ldebug("file_pos {}, sent_pos {}".format(file_pos, sent_pos))
         if sent_pos >= file_pos:
             if sent_pos > file_pos:
@@ -1206,21 +2386,92 @@ class FileTailer(BaseTailer):
                     raise LatestFileChanged()
             return 0
 
+        # drain backlog chunk by chunk within the budget
+        st = time.time()
+        scnt = dbytes = 0
+        while sent_pos < file_pos:
+            rbytes, scnt = self._send_chunk(sent_pos, file_pos, scnt)
+            if rbytes == 0:
+                break
+            sent_pos += rbytes
+            dbytes += rbytes
+            if sent_pos >= file_pos:
+                break
+            elapsed = time.time() - st
+            if elapsed >= self.drain_time or dbytes >= self.drain_bytes:
+                self.linfo(1, "drain budget exhausted. {} bytes in {} secs, "
+                           "{} bytes remain".format(dbytes, elapsed,
+                                                    file_pos - sent_pos))
+                break
+            self.ldebug(1, "drain backlog {} bytes".format(file_pos -
+                                                          sent_pos))
+        return scnt
+
+    def _send_chunk(self, sent_pos, file_pos, scnt):
+        """Read a chunk from sent position, send and save position.
+
+        Args:
+            sent_pos: Sent position so far.
+            file_pos: Current file size.
+            scnt: Sent line count so far.
+
+        Returns:
+            int: Size of the sent chunk in bytes.
+            int: Sent line count including this chunk.
+        """
+        if self.use_mmap and file_pos - sent_pos > self.max_read_buffer:
+            return self._send_mmap_chunk(sent_pos, file_pos, scnt)
+
         # move to last sent pos
-        with OpenNoLock(self.target_path) as fh:
-            win32file.SetFilePointer(fh, sent_pos, win32file.FILE_BEGIN)
-            # read file to the end
-            lines, rbytes = self._read_target_to_end(fh)
+        fh = self.get_target_handle()
+        win32file.SetFilePointer(fh, sent_pos, win32file.FILE_BEGIN)
+        # read file to the end
+        lines, rbytes = self._read_target_to_end(fh, sent_pos)
 
-        scnt = 0
         self.ldebug(1, "sent_pos {} file_pos {} rbytes "
                        "{}".format(sent_pos, file_pos, rbytes))
         if rbytes > 0:
+            self._index_lines(lines, sent_pos, 0, rbytes)
             scnt = self._may_send_newlines(lines, rbytes, scnt,
-                                           file_path=self.target_path)
+                                           file_path=self.target_path,
+                                           base=sent_pos)
+            if self._commit_sent_pos(sent_pos + rbytes):
+                return 0, scnt
+        return rbytes, scnt
 
-        self.save_sent_pos(sent_pos + rbytes)
-        return scnt
+    def _send_mmap_chunk(self, sent_pos, file_pos, scnt):
+        """Send a chunk of backlog by memory mapping it.
+
+        Lines are sliced from the mapped region one by one, so large backlog
+        is not copied into a read buffer and split at once.
+
+        Args:
+            sent_pos: Sent position so far.
+            file_pos: Current file size.
+            scnt: Sent line count so far.
+
+        Returns:
+            int: Size of the sent chunk in bytes.
+            int: Sent line count including this chunk.
+        """
+        size = min(file_pos - sent_pos, self.mmap_window)
+        mm, start = map_file_region(self.get_target_handle(), sent_pos, size)
+        try:
+            rbytes = self._complete_line_bytes(mm, sent_pos, start,
+                                               start + size, self.mmap_window)
+            self.ldebug(1, "mmap sent_pos {} file_pos {} rbytes "
+                           "{}".format(sent_pos, file_pos, rbytes))
+            if rbytes > 0:
+                self._index_lines(mm, sent_pos, start, start + rbytes)
+                lines = iter_lines(mm, start, start + rbytes, True)
+                scnt = self._may_send_newlines(lines, rbytes, scnt,
+                                               file_path=self.target_path,
+                                               base=sent_pos - start)
+                if self._commit_sent_pos(sent_pos + rbytes):
+                    return 0, scnt
+        finally:
+            mm.close()
+        return rbytes, scnt
 
     def attach_msg_extra(self, msg):
         if isinstance(msg, dict):
@@ -1232,54 +2483,95 @@ class FileTailer(BaseTailer):
             return msg
 
     def _iterate_lines(self, lines, file_path):
+        """Iterate messages of lines.
+
+        `msg_end` is set to the offset to resume from after a yielded
+        message, or None if unknown.
+
+        Args:
+            lines: `str`, or iterable of (line, offset of the next line).
+            file_path: Path of the file the lines are from.
+        """
         self.linfo("_iterate_lines")
+        self.hot_debug = logging.root.isEnabledFor(logging.DEBUG)
         if self.parser:
             self.parser.set_file_path(file_path)
+        warn_raw = True
 
-        for line in lines.splitlines():
+        if isinstance(lines, basestring):
+            lines = iter_lines(lines, ends=True)
+        line_start = None
+        for line, nxt in lines:
+            start, line_start = line_start, nxt
             if len(line) == 0:
                 continue
 
+            # a parser may complete a message by the start of next one
+            self.msg_end = start if self.parser else nxt
+
             parsed = None
             if self.format:
                 parsed = self.convert_msg(line)
                 if not parsed:
-                    self.lwarning("can't convert '{}'".format(line))
+                    self.lwarning(0, "can't convert '{}'", line)
             elif self.parser:
                 if self.parser.parse_line(line):
                     if self.parser.completed > self.parser_compl:
                         parsed = self.parser.parsed
                         self.parser_compl = self.parser.completed
                 else:
-                    self.lwarning("can't parse '{}'".format(line))
+                    self.lwarning(0, "can't parse '{}'", line)
             else:
-                self.lwarning("no format / parser exists. send raw "
-                              "message")
+                if warn_raw:
+                    warn_raw = False
+                    self.lwarning("no format / parser exists. send raw "
+                                  "message")
                 yield line
 
             if parsed:
                 yield self.attach_msg_extra(parsed)
 
-    def _may_send_newlines(self, lines, rbytes=None, scnt=0, file_path=None):
-        self.ldebug("_may_send_newlines", "sending {} bytes..".format(rbytes))
+    def _may_send_newlines(self, lines, rbytes=None, scnt=0, file_path=None,
+                           base=None):
+        """Send messages of lines by bulks.
+
+        Args:
+            lines: `str`, or iterable of (line, offset of the next line).
+            rbytes(optional): Size of lines in bytes.
+            scnt(optional): Sent line count so far.
+            file_path(optional): Path of the file the lines are from.
+            base(optional): File position of offset 0 of lines. Progress of
+                each sent bulk is committed if given.
+
+        Returns:
+            int: Sent line count including the lines.
+        """
+        self.ldebug("_may_send_newlines", "sending {} bytes..", rbytes)
         if not rbytes:
             rbytes = len(lines)
+        if isinstance(lines, basestring):
+            lines = iter_lines(lines, 0, rbytes, True)
         try:
             itr = self._iterate_lines(lines, file_path)
-            msgs = []
             for msg in itr:
                 if not msg:
                     # skip bad form message (can't parse)
                     self.linfo("skip bad form message")
                     continue
-                self._send_newline(msg, msgs)
+                end = None
+                if base is not None and self.msg_end is not None:
+                    end = self.bulk_end = (self.target_path,
+                                           base + self.msg_end)
+                self._send_newline(msg, self.bulk, end)
                 scnt += 1
-
-            self._send_remain_msgs(msgs)
         except Exception as e:
-            self._handle_send_fail(e, rbytes)
+            self._drop_bulk(e)
+        else:
+            self.may_flush_bulk()
 
-        self.send_retry = 0
+        if self.sender is None:
+            # reset when acknowledged if sending asynchronously
+            self.send_retry = 0
         return scnt
 
     def get_sent_pos(self, epath=None):
@@ -1294,17 +2586,14 @@ class FileTailer(BaseTailer):
     def start_sent_pos(self, tpath):
         """Calculate sent pos for new service start"""
         self.ldebug("start_sent_pos", "for '{}'..".format(tpath))
-        tname = escape_path(tpath)
-        ppath = os.path.join(self.pdir, tname + '.pos')
         file_pos = self.get_file_pos(tpath)
-        if os.path.isfile(ppath):
+        line = self.checkpoint.read(tpath)
+        if line is not None:
             # between data
-            # previous pos file means continuation after restart
-            with open(ppath, 'r') as f:
-                line = f.readline()
-                elm = line.split(',')
-                spos = int(elm[0])
-            self.ldebug(1, "found pos file - {}: {}".format(ppath, spos))
+            # previous pos means continuation after restart
+            elm = line.split(',')
+            spos = int(elm[0])
+            self.ldebug(1, "found pos - {}: {}".format(tpath, spos))
             if spos > file_pos:
                 self.lwarning(1, "sent pos ({}) > file pos ({}). possible file"
                               " change. trim..".format(spos, file_pos))
@@ -1320,25 +2609,28 @@ class FileTailer(BaseTailer):
             spos = file_pos
 
         if self.lines_on_start:
-            lines, pos = get_file_lineinfo(tpath, self.max_read_buffer,
-                                           self.lines_on_start)
-            self.lwarning("get_file_lineinfo for lines_on_start "
+            lines, pos = get_file_tailpos(tpath, self.lines_on_start)
+            self.lwarning("get_file_tailpos for lines_on_start "
                           "{} - {} {}".format(self.lines_on_start, lines, pos))
             spos = pos
 
-        self._save_sent_pos(tpath, spos)
+        self._save_sent_pos(tpath, spos, True)
 
-    def save_sent_pos(self, pos):
+    def save_sent_pos(self, pos, force=False):
         """Save sent position for current target.
 
         Args:
             pos: Position to be saved.
+            force(optional): Flush right away.
         """
         self.linfo("save_sent_pos")
         self.raise_if_notarget()
+        if self.held_pos is not None and self.held_pos[0] == self.target_path:
+            # overrides position of the lingering bulk
+            self.held_pos = None
 
         # save pos file
-        self._save_sent_pos(self.target_path, pos)
+        self._save_sent_pos(self.target_path, pos, force)
 
 
 def db_execute(con, cmd, *args):
@@ -1,3 +1,8 @@
+import time
+import random
+import threading
+
+
 def write_eloa_cfg(dcfg):
     import copy
     dcfg2 = copy.deepcopy(dcfg)
@@ -9,3 +14,69 @@ def write_eloa_cfg(dcfg):
     del dbct['date_pattern']
     del dbct['date_format']
     return dcfg2
+
+
+class FakeKinesisClient(object):
+    """Local stand-in of boto3 Kinesis client for tests and benchmarks.
+
+    Put records are kept in `records`. Entries of `put_records` fail
+    randomly by `fail_rate` as when shard throughput is exceeded, or by
+    their partition key in `fail_pks`. Starts and ends of `put_records`
+    calls are kept in `events` as ('start' or 'end', call number, partition
+    keys).
+    """
+
+    def __init__(self, latency=0, fail_rate=0, seed=None, fail_pks=None):
+        """
+        Args:
+            latency(optional): Seconds of a round trip.
+            fail_rate(optional): Ratio of failing entries.
+            seed(optional): Random seed for failures.
+            fail_pks(optional): Partition keys of failing entries.
+        """
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.fail_pks = set(fail_pks) if fail_pks else set()
+        self.records = []
+        self.calls = 0
+        self.events = []
+
+    def _put(self, data, pk):
+        with self.lock:
+            self.records.append((pk, data))
+            return dict(ShardId='shardId-000000000000',
+                        SequenceNumber=str(len(self.records)))
+
+    def put_record(self, StreamName, Data, PartitionKey, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        ret = self._put(Data, PartitionKey)
+        ret['ResponseMetadata'] = dict(HTTPStatusCode=200)
+        return ret
+
+    def put_records(self, StreamName, Records):
+        pks = set(rec['PartitionKey'] for rec in Records)
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+            self.events.append(('start', call, pks))
+        time.sleep(self.latency)
+        results = []
+        failed = 0
+        for rec in Records:
+            with self.lock:
+                fail = self.random.random() < self.fail_rate or\
+                    rec['PartitionKey'] in self.fail_pks
+            if fail:
+                failed += 1
+                results.append(dict(
+                    ErrorCode='ProvisionedThroughputExceededException',
+                    ErrorMessage='Rate exceeded for shard'))
+            else:
+                results.append(self._put(rec['Data'], rec['PartitionKey']))
+        with self.lock:
+            self.events.append(('end', call, pks))
+        return dict(FailedRecordCount=failed, Records=results,
+                    ResponseMetadata=dict(HTTPStatusCode=200))
@@ -7,6 +7,9 @@ import pytest
 from aws_kinesis_agg import aggregator
 
 from wdfwd.util import prepare_kinesis_test, KN_TEST_STREAM
+from wdfwd.sender import KinesisSink, KinesisPutError, iter_kinesis_batches,\
+    KinesisPartitioner, make_kinesis_encoder
+from wdfwd.tests import FakeKinesisClient
 
 
 DEL_STREAM_AFTER = False
@@ -193,3 +196,159 @@ def test_kinesis_agg(knc):
         #shdit = ret['NextShardIterator']
 
     #assert rcnt == n_records
+
+
+def make_sink_records(cnt, size=10):
+    return [(str(i), None, 'x' * size) for i in range(cnt)]
+
+
+def test_kinesis_batches():
+    records = make_sink_records(1200)
+    batches = list(iter_kinesis_batches(records))
+    assert [len(b) for b in batches] == [500, 500, 200]
+
+    # limited by bytes of data and partition key
+    records = make_sink_records(10, 99)
+    batches = list(iter_kinesis_batches(records, max_bytes=300))
+    assert [len(b) for b in batches] == [3, 3, 3, 1]
+    assert list(iter_kinesis_batches([])) == []
+
+
+def test_kinesis_sink():
+    records = make_sink_records(1200)
+
+    # only failed entries are retried
+    knc = FakeKinesisClient(fail_rate=0.1, seed=1)
+    sink = KinesisSink(knc, KN_TEST_STREAM, max_inflight=1)
+    shid, seqn = sink.put(records)
+    assert shid == 'shardId-000000000000'
+    assert sorted(pk for pk, _ in knc.records) ==\
+        sorted(pk for pk, _, _ in records)
+    assert 3 < knc.calls < 3 * 4
+
+    # batches are put concurrently
+    knc = FakeKinesisClient(latency=0.2)
+    sink = KinesisSink(knc, KN_TEST_STREAM)
+    st = time.time()
+    sink.put(records)
+    assert time.time() - st < 0.2 * 3
+    assert knc.calls == 3
+    assert len(knc.records) == 1200
+
+    knc = FakeKinesisClient(fail_rate=1)
+    sink = KinesisSink(knc, KN_TEST_STREAM, max_retry=1)
+    with pytest.raises(KinesisPutError):
+        sink.put(records[:10])
+    assert knc.calls == 2
+
+
+def test_kinesis_sink_key_order():
+    records = [('a', None, str(i)) for i in range(500)] +\
+        [('b', None, str(i)) for i in range(500, 1000)] +\
+        [('a', None, str(i)) for i in range(1000, 1200)]
+
+    # batches of a key are put one after another
+    knc = FakeKinesisClient(latency=0.1)
+    sink = KinesisSink(knc, KN_TEST_STREAM)
+    sink.put(records)
+    assert knc.calls == 3
+    inflight = {}
+    for kind, call, pks in knc.events:
+        if kind == 'end':
+            del inflight[call]
+            continue
+        # a batch of 'a' never starts while another one is in flight
+        assert 'a' not in pks or\
+            all('a' not in ipks for ipks in inflight.values())
+        inflight[call] = pks
+    assert [data for _, data in knc.records if _ == 'a'] ==\
+        [data for pk, _, data in records if pk == 'a']
+
+    # failed key stops later batches of it only
+    knc = FakeKinesisClient(fail_pks=['a'])
+    sink = KinesisSink(knc, KN_TEST_STREAM, max_retry=1)
+    with pytest.raises(KinesisPutError) as e:
+        sink.put(records)
+    assert e.value.unsent == range(500) + range(1000, 1200)
+    assert [data for _, data in knc.records] == [str(i) for i in
+                                                 range(500, 1000)]
+    # first batch and its retry, and the batch of 'b'
+    assert knc.calls == 3
+
+
+def test_kinesis_sink_speed():
+    n_records = 2000
+    records = make_sink_records(n_records, 100)
+    latency = 0.005
+
+    knc = FakeKinesisClient(latency=latency)
+    st = time.time()
+    for pk, ehk, data in records[:200]:
+        knc.put_record(StreamName=KN_TEST_STREAM, Data=data, PartitionKey=pk)
+    one_speed = 200 / (time.time() - st)
+
+    knc = FakeKinesisClient(latency=latency)
+    sink = KinesisSink(knc, KN_TEST_STREAM)
+    st = time.time()
+    sink.put(records)
+    sink_speed = n_records / (time.time() - st)
+    print("---------------- put_record: {} records/sec, sink: {} records/sec"
+          " ----------------".format(one_speed, sink_speed))
+    # a round trip per batch instead of per record
+    assert knc.calls == 4
+    assert sink_speed > one_speed * 10
+
+
+def test_kinesis_encoder():
+    import json
+    import msgpack
+
+    rec = {'level': 'INFO', 'n': 1, 'msg': u'\ud55c'}
+    expect = dict(rec, tag_='wdfwd.data', ts_=10)
+
+    enc = make_kinesis_encoder(None, 'wdfwd.data')
+    data = enc.encode(10, rec)
+    assert ' ' not in data
+    assert json.loads(data) == expect
+    assert json.loads(enc.encode(10, {})) == {'tag_': 'wdfwd.data',
+                                              'ts_': 10}
+    assert json.loads(enc.encode(10, 'text')) ==\
+        {'tag_': 'wdfwd.data', 'ts_': 10, 'value_': 'text'}
+    # record is not copied nor changed
+    assert 'tag_' not in rec
+
+    enc = make_kinesis_encoder('msgpack', 'wdfwd.data')
+    assert msgpack.unpackb(enc.encode(10, rec), encoding='utf8') == expect
+    assert msgpack.unpackb(enc.encode(10, 'text')) ==\
+        {'tag_': 'wdfwd.data', 'ts_': 10, 'value_': 'text'}
+    # map16 header of a big record
+    big = dict(('k{}'.format(i), i) for i in range(20))
+    assert msgpack.unpackb(enc.encode(10, big)) ==\
+        dict(big, tag_='wdfwd.data', ts_=10)
+
+
+def test_kinesis_partition():
+    msgs = [(1, {'user': 'a'}), (2, {'user': 'b'}), (3, {'user': 'a'}),
+            (4, 'text')]
+
+    # round robin hash keys per bulk
+    part = KinesisPartitioner(None, 'wdfwd.tail', 4)
+    ehks = set()
+    for i in range(4):
+        groups = list(part.group(msgs))
+        assert len(groups) == 1
+        pk, ehk, gmsgs = groups[0]
+        assert pk == 'wdfwd.tail'
+        assert gmsgs == msgs
+        ehks.add(int(ehk))
+    assert sorted(ehks) == [2 ** 128 * k // 8 for k in (1, 3, 5, 7)]
+
+    part = KinesisPartitioner('tailer', 'wdfwd.tail')
+    assert list(part.group(msgs)) == [('wdfwd.tail', None, msgs)]
+
+    # grouped by field value in order
+    part = KinesisPartitioner('field:user', 'wdfwd.tail')
+    assert list(part.group(msgs)) == [
+        ('a', None, [msgs[0], msgs[2]]),
+        ('b', None, [msgs[1]]),
+        ('wdfwd.tail', None, [msgs[3]])]
@@ -2,14 +2,17 @@ import os
 import glob
 import time
 import shutil
+import copy
 
 import pytest
 
 from wdfwd.const import BASE_DIR
 from wdfwd.get_config import get_config
 from wdfwd.tail import FileTailer, NoTarget, TailThread, get_file_lineinfo,\
-    FluentCfg, KinesisCfg, MAX_READ_BUF
+    FluentCfg, KinesisCfg, MAX_READ_BUF, get_file_tailpos, Bulk, MAX_SEND_RETRY
 from wdfwd.util import InvalidLogFormat, KN_TEST_STREAM
+from wdfwd.sender import FLUENT_POOL_SIZE, KinesisPutError
+from wdfwd.tests import FakeKinesisClient
 
 # set config for this test
 cfg_path = os.path.join(BASE_DIR, 'tests', 'cfg_tail.yml')
@@ -191,6 +194,54 @@ def test_tail_file_kinesis(rmlogs, ktail):
         #assert 'ts_' in rec
 
 
+def test_tail_kinesis_sink(rmlogs, monkeypatch):
+    knc = FakeKinesisClient()
+    monkeypatch.setattr('wdfwd.tail.get_kinesis_client',
+                        lambda *args: knc)
+    ktail = _ktail()
+    path = os.path.join(ktail.bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        for i in xrange(1000):
+            f.write('{}\n'.format(i))
+    ktail.update_target()
+    assert ktail.may_send_newlines() == 1000
+    assert ktail.ksent_seqn == str(len(knc.records))
+    # aggregated records are put by batches
+    assert knc.calls < len(knc.records)
+
+
+def test_tail_kinesis_partial(rmlogs, monkeypatch):
+    knc = FakeKinesisClient(fail_pks=['b'])
+    monkeypatch.setattr('wdfwd.tail.get_kinesis_client',
+                        lambda *args: knc)
+    finfo = tcfg['from'][0]['file']
+    kcfg = KinesisCfg(KN_TEST_STREAM, 'ap-northeast-1', None, None)
+    ktail = FileTailer(finfo['dir'], finfo['pattern'], finfo['tag'], pos_dir,
+                       kcfg, send_term=0, update_term=0,
+                       format=r'(?P<dt_>\S+) (?P<k>\w+) (?P<_text_>.+)',
+                       kinesis_partition='field:k')
+    path = os.path.join(ktail.bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        for i in xrange(10):
+            f.write('2016-03-30 {} {}\n'.format('a' if i < 5 else 'b', i))
+    with open(path, 'rb') as f:
+        bpos = f.read().index('2016-03-30 b')
+    ktail.update_target()
+    ktail.ksink.max_retry = 0
+
+    # retry from the first message of the failed key
+    with pytest.raises(KinesisPutError) as e:
+        ktail.may_send_newlines()
+    assert e.value.nsent == 5
+    assert ktail.get_sent_pos() == bpos
+    assert [pk for pk, _ in knc.records] == ['a']
+
+    knc.fail_pks.clear()
+    ktail.circuit.success()
+    assert ktail.may_send_newlines() == 5
+    assert [pk for pk, _ in knc.records] == ['a', 'b']
+
+
 def test_tail_file_rotate(rmlogs, ftail):
     for i in range(1, 30):
         path = os.path.join(ftail.bdir,
@@ -532,7 +583,7 @@ def test_tail_file_elatest2(rmlogs):
         f.write('A\n')
 
     ptrn = "tailtest3_*-*-*.log"
-    ftail = FileTailer(bdir, ptrn, 'wdfwd.tail', pos_dir, fcfg, 0,
+    ftail = FileTailer(bdir, ptrn, 'wdfwd.tail', pos_dir, fcfg, 0, 0,
                        elatest=EXP_LATEST)
     ftail.update_target()
     rotated, psent_pos, sent_line = ftail.tmain()
@@ -593,7 +644,7 @@ def test_tail_file_elatest3(rmlogs):
         f.write('A\n')
 
     ptrn = "z*_action.*"
-    ftail = FileTailer(bdir, ptrn, 'wdfwd.tail', pos_dir, fcfg, 0,
+    ftail = FileTailer(bdir, ptrn, 'wdfwd.tail', pos_dir, fcfg, 0, 0,
                        elatest=EXP_LATEST, reverse_order=True)
     ftail.update_target()
     rotated, psent_pos, sent_line = ftail.tmain()
@@ -661,6 +712,8 @@ def test_tail_file_continue(rmlogs, ftail):
             f.write('{}\n'.format(i))
 
     # after reset, shall find target again and send previous data from sent pos
+    # (positions are flushed on close)
+    ftail.close()
     ftail = _ftail()
     ftail.update_target()
     assert ftail.may_send_newlines() == 100
@@ -695,6 +748,63 @@ def test_tail_file_del(rmlogs, ftail):
     assert ftail.may_send_newlines() == 10
 
 
+def test_tail_file_handle(rmlogs, ftail):
+    path = os.path.join(ftail.bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        f.write('1\n')
+
+    ftail.update_target()
+    # target handle is opened once and reused across sends
+    handle = ftail.get_target_handle()
+    assert ftail.may_send_newlines() == 1
+    with open(path, 'a') as f:
+        f.write('2\n')
+    assert ftail.get_file_pos() == 6
+    assert ftail.may_send_newlines() == 1
+    assert ftail.get_target_handle() is handle
+
+    # recreated file is detected after the old one is drained
+    os.remove(path)
+    with open(path, 'w') as f:
+        f.write('a\n')
+    assert ftail.handle_file_recreate(0) > 0
+    assert ftail.target_fh is None
+    ftail.update_target()
+    assert ftail.get_target_handle() is not handle
+    assert ftail.may_send_newlines() == 1
+
+    ftail.close()
+    assert ftail.target_fh is None
+
+
+def test_tail_path_check(rmlogs, monkeypatch):
+    finfo = tcfg['from'][0]['file']
+    path = os.path.join(finfo['dir'], 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        f.write('1\n')
+    tail = FileTailer(finfo['dir'], finfo['pattern'], finfo['tag'], pos_dir,
+                      fcfg, send_term=0, update_term=60)
+    tail.update_target()
+    tail.tmain()
+
+    checks = []
+    recreate = tail.handle_file_recreate
+    monkeypatch.setattr(tail, 'handle_file_recreate',
+                        lambda cur=None: checks.append(cur) or recreate(cur))
+    # idle tailer does not open the path every turn
+    for _ in range(3):
+        tail.tmain()
+    assert checks == []
+
+    # but after update term, or on change notification
+    tail.last_path_check = 0
+    tail.tmain()
+    tail.notified = True
+    tail.tmain()
+    assert len(checks) == 2
+    tail.close()
+
+
 def test_tail_file_startline(rmlogs):
     finfo = tcfg['from'][0]['file']
     bdir = finfo['dir']
@@ -748,6 +858,20 @@ def test_tail_file_lineinfo(rmlogs):
     assert lines == 0
     assert pos == 0
 
+    # lines across read buffers
+    assert get_file_lineinfo(path, 4) == (3, 9)
+    assert get_file_lineinfo(path, 4, 1) == (2, 6)
+
+    # backward scan for the last lines
+    assert get_file_tailpos(path, 1) == (1, 6)
+    assert get_file_tailpos(path, 2, 4) == (2, 3)
+    assert get_file_tailpos(path, 3, 4) == (3, 0)
+    assert get_file_tailpos(path, 4, 4) == (3, 0)
+    with open(path, 'a') as f:
+        f.write('3')
+    assert get_file_tailpos(path, 1) == (1, 9)
+    assert get_file_tailpos(path, 2, 4) == (2, 6)
+
 
 def test_tail_file_format(rmlogs):
     finfo = tcfg['from'][0]['file']
@@ -762,7 +886,7 @@ def test_tail_file_format(rmlogs):
     tail = FileTailer(bdir, "tailtest4_*-*-*.log", "wdfwd.tail4", pos_dir,
                       fcfg, echo=True, format=fmt)
     tail.saddr = tail.sname = None
-    data="""2016-03-30 16:10:50.5503 INFO: {"dt_": "to-be-overwritten", "obj":[{"Delegate":{},"target0":{"returnObj":{"FirstItems":[{"ProductDisplaySeq":388}],"ProductDisplaySeq":389,"SecondItems":[{"ParentSeq":388,"ProductDisplaySeq":389},{"ParentSeq":388,"ProductDisplaySeq":461}],"ThirdItems":[],"Message":null,"Return":true,"ReturnCode":0,"TraceId":"6c8b7c6c-6c6a-4fcc-b879-72a64a4e57e5"},"parentSeq":0,"salesZone":421,"userSeq":0,"accountID":"","clientIp":"10.1.18.22"}}]}"""
+    data="""2016-03-30 16:10:50.5503 INFO: {"dt_": "to-be-overwritten", "obj":[{"Delegate":{},"target0":{"returnObj":{"FirstItems":[{"ProductDisplaySeq":388}],"ProductDisplaySeq":389,"SecondItems":[{"ParentSeq":388,"ProductDisplaySeq":389},{"ParentSeq":388,"ProductDisplaySeq":461}],"ThirdItems":[],"Message":null,"Return":true,"ReturnCode":0,"TraceId":"6c8b7c6c-6c6a-4fcc-b879-72a64a4e57e5"},"parentSeq":0,"salesZone":421,"userSeq":0,"accountID":"","clientIp":"10.1.18.22"}}]}\n"""
     path = os.path.join(bdir, 'tailtest4_2016-03-30.log')
     with open(path, 'w') as f:
         f.write(data)
@@ -780,7 +904,7 @@ def test_tail_file_format(rmlogs):
     fmt = r'(?P<dt_>\d+-\d+-\d+ \d+:\d+:\S+)\s(?P<lvl>\S+):\s(?P<_text_>.+)'
     tail = FileTailer(bdir, "tailtest5_*-*-*.log", "wdfwd.tail4", pos_dir,
                       fcfg, echo=True, format=fmt)
-    data="""2016-03-30 16:10:50.5503 INFO: Plain Text Message"""
+    data="""2016-03-30 16:10:50.5503 INFO: Plain Text Message\n"""
     path = os.path.join(bdir, 'tailtest5_2016-03-30.log')
     with open(path, 'w') as f:
         f.write(data)
@@ -822,7 +946,6 @@ def test_tail_iislog():
         print match.groupdict()
 
 
-@pytest.mark.skip(reason="not implemented. remove skip mark to develop")
 def test_tail_uncompleted(rmlogs, ftail_fmt):
     path = os.path.join(ftail_fmt.bdir, 'tailtest_2016-03-30.log')
     with open(path, 'w') as f:
@@ -841,7 +964,7 @@ def test_tail_uncompleted(rmlogs, ftail_fmt):
     assert ftail_fmt.get_sent_pos() == 21
 
     with open(path, 'a') as f:
-        f.write('11:22:33\n')
+        f.write(' 11:22:33\n')
         f.flush()
 
     # send new line
@@ -850,6 +973,1304 @@ def test_tail_uncompleted(rmlogs, ftail_fmt):
     assert ftail_fmt.get_sent_pos() == 42
 
 
+def test_tail_partial_line_wait(rmlogs):
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, echo=True, partial_line_wait=0)
+
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        f.write('A\n')
+        f.write('B')
+
+    # unterminated last line is sent when it is not completed in time
+    tail.update_target()
+    assert tail.may_send_newlines() == 2
+    assert tail.get_sent_pos() == 4
+
+
+def test_tail_drain(rmlogs):
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        for i in range(100):
+            f.write('{:02d}\n'.format(i))
+
+    # one buffer per turn without drain
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, echo=True, max_read_buffer=40,
+                      drain_time=0)
+    tail.update_target()
+    assert tail.may_send_newlines() == 10
+    assert tail.get_sent_pos() == 40
+
+    # drain remaining backlog in a turn
+    tail.drain_time = 60
+    assert tail.may_send_newlines() == 90
+    assert tail.get_sent_pos() == 400
+
+    # byte budget stops draining
+    with open(path, 'a') as f:
+        for i in range(100):
+            f.write('{:02d}\n'.format(i))
+    tail.drain_bytes = 80
+    assert tail.may_send_newlines() == 20
+    assert tail.get_sent_pos() == 480
+
+
+def test_tail_mmap(rmlogs):
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        for i in range(100):
+            f.write('{:02d}\n'.format(i))
+        f.write('1')
+
+    # backlog larger than read buffer is read by memory map
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, echo=True, max_read_buffer=40,
+                      use_mmap=True)
+    tail.update_target()
+    assert tail.may_send_newlines() == 100
+    assert tail.get_sent_pos() == 400
+    echo = tail.echo_file.getvalue().splitlines()
+    assert echo[0] == '00'
+    assert echo[-1] == '99'
+
+    # partial line is held back
+    with open(path, 'a') as f:
+        f.write('0\n')
+    assert tail.may_send_newlines() == 1
+    assert tail.echo_file.getvalue().splitlines()[-1] == '10'
+
+
+def test_tail_watch(rmlogs):
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, update_term=0,
+                      echo=True, watch_changes=True, watch_poll_term=10)
+    assert tail.watcher is not None
+
+    # woken up by change of the target, not by poll timeout
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    st = time.time()
+    with open(path, 'w') as f:
+        f.write('A\n')
+    assert tail.wait(1)
+    assert time.time() - st < 1
+
+    # sent without waiting for send term
+    tail.update_target()
+    tail.last_send_try = time.time()
+    tail.tmain()
+    assert tail.get_sent_pos() == 3
+
+    # idle tailer still polls within the watch poll term
+    tail.watch_poll_term = 0.1
+    st = time.time()
+    assert not tail.wait(60)
+    assert time.time() - st < 5
+
+    # woken up by exit request
+    assert not tail.wait(0)
+    tail.wakeup()
+    assert tail.wait(10)
+
+    tail.close()
+    assert tail.watcher is None
+
+    # process-wide watcher stops with its thread and descriptors
+    from wdfwd.watcher import get_watcher, stop_watcher, InotifyWatcher
+    watcher = get_watcher()
+    stop_watcher()
+    assert not watcher.thread.is_alive()
+    if isinstance(watcher, InotifyWatcher):
+        for fd in (watcher.fd, watcher.rpipe, watcher.wpipe):
+            with pytest.raises(OSError):
+                os.fstat(fd)
+    assert get_watcher() is not watcher
+    stop_watcher()
+
+
+def test_tail_poll_schedule(rmlogs):
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, update_term=0,
+                      echo=True, poll_min=0.5, poll_max=4)
+    assert tail.send_term == 0.5
+
+    # idle tailer backs off up to max
+    tail.tmain()
+    assert tail.next_poll_term() == 1
+    assert tail.next_poll_term() == 2
+    assert tail.next_poll_term() == 4
+    assert tail.next_poll_term() == 4
+
+    # new data snaps back to min
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        f.write('A\n')
+    tail.update_target()
+    tail.last_send_try = 0
+    tail.tmain()
+    assert tail.next_poll_term() == 0.5
+
+    # max no less than min
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, poll_min=20)
+    assert tail.poll_max == 20
+
+    # no backoff unless max is given
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg)
+    tail.tmain()
+    assert tail.next_poll_term() == tail.poll_min
+
+
+def test_tail_line_index(rmlogs, monkeypatch):
+    from wdfwd.lineindex import LineIndex, get_index_path
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        for i in range(95):
+            f.write('{:02d}\n'.format(i))
+
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, echo=True, max_read_buffer=100,
+                      line_index=10)
+    tail.update_target()
+    assert tail.may_send_newlines() == 95
+    # offsets indexed while sending
+    assert tail.line_index.offsets == [i * 40 for i in range(10)]
+
+    # line found by a seek
+    fh = tail.get_target_handle()
+    assert tail.line_index.line_pos(fh, 25) == 100
+    assert tail.line_index.line_pos(fh, 200) == 380
+
+    # count lines by index
+    assert get_file_lineinfo(path, MAX_READ_BUF,
+                             line_index=tail.line_index) == (95, 380)
+    assert get_file_lineinfo(path, MAX_READ_BUF, 5,
+                             line_index=tail.line_index) == (90, 360)
+
+    # index is loaded from pos dir
+    lidx = LineIndex(pos_dir, bdir, tail.target_fid, 10)
+    assert lidx.offsets == tail.line_index.offsets
+    # and rebuilt when interval changed
+    lidx = LineIndex(pos_dir, bdir, tail.target_fid, 20)
+    assert lidx.offsets == [0]
+
+    # tailer restarted from a saved position indexes lines before it
+    ipath = get_index_path(pos_dir, bdir, tail.target_fid)
+    tail.close()
+    os.remove(ipath)
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, echo=True, max_read_buffer=100,
+                      line_index=10)
+    tail.update_target()
+    tail.save_sent_pos(200)
+    with open(path, 'a') as f:
+        f.write('95\n')
+    # by bounded bytes at a read
+    monkeypatch.setattr('wdfwd.tail.LINE_INDEX_GAP_BYTES', 80)
+    assert tail.may_send_newlines() == 46
+    assert tail.line_index.offsets == [i * 40 for i in range(5)]
+    for i in range(96, 100):
+        with open(path, 'a') as f:
+            f.write('{}\n'.format(i))
+        assert tail.may_send_newlines() == 1
+    assert tail.line_index.offsets == [i * 40 for i in range(11)]
+
+    # stale index is removed with its file by sweep
+    assert os.path.isfile(ipath)
+    tail.close()
+    os.remove(path)
+    path = os.path.join(bdir, 'tailtest_2016-03-31.log')
+    with open(path, 'w') as f:
+        f.write('A\n')
+    tail.update_target()
+    assert os.path.isfile(ipath)
+    tail.last_sweep = 0
+    tail.tmain()
+    assert not os.path.isfile(ipath)
+
+
+def test_tail_checkpoint(rmlogs):
+    from wdfwd.util import escape_path
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        f.write('A\n')
+
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, pos_flush_term=60, pos_flush_bytes=5)
+    tail.update_target()
+    ppath = os.path.join(pos_dir, escape_path(path) + '.pos')
+
+    def read_pos():
+        with open(ppath, 'r') as f:
+            return int(f.readline())
+
+    # position is kept in memory until flush
+    assert tail.may_send_newlines() == 1
+    assert read_pos() == 0
+    assert tail.get_sent_pos() == 3
+    assert tail.read_sent_pos(path, None) == 3
+
+    # flushed by bytes
+    with open(path, 'a') as f:
+        f.write('B\n')
+    assert tail.may_send_newlines() == 1
+    assert read_pos() == 6
+
+    # flushed by term
+    with open(path, 'a') as f:
+        f.write('C\n')
+    assert tail.may_send_newlines() == 1
+    assert read_pos() == 6
+    tail.checkpoint.flush_term = 0
+    tail.tmain()
+    assert read_pos() == 9
+
+    # flushed on shutdown
+    with open(path, 'a') as f:
+        f.write('D\n')
+    tail.checkpoint.flush_term = 60
+    assert tail.may_send_newlines() == 1
+    assert read_pos() == 9
+    tail.close()
+    assert read_pos() == 12
+    assert not os.path.isfile(ppath + '.tmp')
+
+
+def test_tail_thread_exit_on_fail(rmlogs):
+    from wdfwd.util import escape_path
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        f.write('A\n')
+
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, pos_flush_term=60)
+    ppath = os.path.join(pos_dir, escape_path(path) + '.pos')
+
+    def fail():
+        tail.may_send_newlines()
+        raise IOError("send fail")
+
+    # thread exits during a failure streak, and flushes positions
+    tail.tmain = fail
+    trd = TailThread('trd', tail)
+    trd.start()
+    time.sleep(0.5)
+    trd.exit()
+    trd.join(5)
+    assert not trd.is_alive()
+    with open(ppath, 'r') as f:
+        assert int(f.readline()) == 3
+
+
+def test_tail_pos_store_db(rmlogs):
+    from wdfwd.util import escape_path
+    from wdfwd.posstore import POS_DB_NAME, close_pos_stores, get_pos_store
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    close_pos_stores()
+    dbpath = os.path.join(pos_dir, POS_DB_NAME)
+    if os.path.isfile(dbpath):
+        os.remove(dbpath)
+
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        f.write('A\nB\n')
+    # pos files of previous run
+    ppath = os.path.join(pos_dir, escape_path(path) + '.pos')
+    with open(ppath, 'w') as f:
+        f.write('3\n')
+    opath = os.path.join(pos_dir, 'old.pos')
+    with open(opath, 'w') as f:
+        f.write('10\n')
+    os.utime(opath, (0, 0))
+
+    # pos files are migrated, and unknown one is kept however old it is
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, echo=True, pos_store='db',
+                      pos_flush_term=0)
+    store = get_pos_store(pos_dir, 'db')
+    assert not os.path.isfile(ppath)
+    assert not os.path.isfile(opath)
+    assert store.cache == {escape_path(path): '3', 'old': '10'}
+    assert store.con.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+    tail.update_target()
+    assert tail.may_send_newlines() == 1
+    assert tail.echo_file.getvalue() == 'B\n'
+    assert store.read(path) == '6'
+
+    # loaded once from the file
+    close_pos_stores()
+    store = get_pos_store(pos_dir, 'db')
+    assert store.read(path) == '6'
+
+    # positions of deleted files are collected
+    os.remove(path)
+    store.last_gc = 0
+    store.may_gc()
+    assert store.read(path) is None
+    close_pos_stores()
+    os.remove(dbpath)
+
+
+def test_tail_pos_sweep(rmlogs):
+    from wdfwd.util import escape_path
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+
+    paths = []
+    for i in range(3):
+        path = os.path.join(bdir, 'tailtest_2016-03-3{}.log'.format(i))
+        with open(path, 'w') as f:
+            f.write('A\n')
+        paths.append(path)
+    # pos file of other tailer in the same directory
+    opath = os.path.join(pos_dir, escape_path(os.path.join(bdir, 'other.log'))
+                         + '.pos')
+    with open(opath, 'w') as f:
+        f.write('0\n')
+
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, pos_flush_term=0, pos_cache_size=2)
+    for path in paths:
+        tail.get_sent_pos(path)
+    # least recently used one is evicted
+    assert len(tail.cache_sent_pos) == 2
+    assert paths[0] not in tail.cache_sent_pos
+    assert tail.get_sent_pos(paths[0]) == 0
+
+    # positions of deleted targets are swept
+    tail.update_target()
+    assert tail.target_path == paths[2]
+    os.remove(paths[0])
+    os.remove(paths[1])
+    assert sorted(tail.sweep_sent_pos()) == paths[:2]
+    assert paths[0] not in tail.cache_sent_pos
+    ppaths = glob.glob(os.path.join(pos_dir, '*.pos'))
+    assert sorted(ppaths) == sorted([opath, os.path.join(
+        pos_dir, escape_path(paths[2]) + '.pos')])
+
+
+def test_tail_fluent_mode():
+    import zlib
+    import msgpack
+
+    finfo = tcfg['from'][0]['file']
+    msgs = [(1, {'message': 'a'}), (2, {'message': 'b'})]
+
+    def make_bulk(mode):
+        tail = FileTailer(finfo['dir'], finfo['pattern'], 'wdfwd.tail',
+                          pos_dir, fcfg, fluent_mode=mode)
+        return tail.fluent_tag, tail._make_fluent_bulk(msgs)
+
+    def events(unpacked):
+        return [(ts, rec) for ts, rec in unpacked]
+
+    tag, bulk = make_bulk('message')
+    unp = msgpack.Unpacker()
+    unp.feed(bulk)
+    assert [(t, ts, rec) for t, ts, rec in unp] ==\
+        [(tag, 1, {'message': 'a'}), (tag, 2, {'message': 'b'})]
+
+    # default is forward mode, tag once per chunk
+    tag, bulk = make_bulk(None)
+    rtag, entries = msgpack.unpackb(bulk)
+    assert rtag == tag
+    assert events(entries) == msgs
+
+    tag, bulk = make_bulk('packed')
+    rtag, entries, option = msgpack.unpackb(bulk)
+    assert rtag == tag
+    assert option == {'size': 2}
+    unp = msgpack.Unpacker()
+    unp.feed(entries)
+    assert events(unp) == msgs
+
+    tag, bulk = make_bulk('compressed')
+    rtag, entries, option = msgpack.unpackb(bulk)
+    assert option == {'size': 2, 'compressed': 'gzip'}
+    unp = msgpack.Unpacker()
+    unp.feed(zlib.decompress(entries, 16 + zlib.MAX_WBITS))
+    assert events(unp) == msgs
+
+
+def test_tail_bulk(rmlogs):
+    import msgpack
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+
+    def make_tail(**kwargs):
+        tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                          update_term=0, **kwargs)
+        bulks = []
+        send_bulk = tail._send_bulk
+
+        def _send_bulk(msgs):
+            bulks.append([m for _, m in msgs])
+            send_bulk(msgs)
+
+        tail._send_bulk = _send_bulk
+        tail.update_target()
+        return tail, bulks
+
+    with open(path, 'w') as f:
+        for i in range(25):
+            f.write('{:03d}\n'.format(i))
+
+    # by events
+    tail, bulks = make_tail(bulk_events=10)
+    assert tail.may_send_newlines() == 25
+    assert [len(b) for b in bulks] == [10, 10, 5]
+    tail.close()
+
+    # by packed bytes, payload is made of packed entries
+    tail, bulks = make_tail(bulk_bytes=60)
+    tail.save_sent_pos(0)
+    assert tail.may_send_newlines() == 25
+    entry = len(msgpack.packb((int(time.time()), '000')))
+    assert [len(b) for b in bulks][0] == -(-60 // entry)
+    assert sum(len(b) for b in bulks) == 25
+    msgs = [(1, 'a'), (2, 'b')]
+    bulk = Bulk()
+    for msg in msgs:
+        bulk.add(msg, tail._pack_msg(*msg))
+    assert tail._make_fluent_bulk(bulk) == msgpack.packb((tail.fluent_tag,
+                                                          msgs))
+    tail.close()
+
+    # partial bulk lingers, and its position is held
+    tail, bulks = make_tail(bulk_linger=10)
+    tail.save_sent_pos(0)
+    assert tail.may_send_newlines() == 25
+    assert bulks == []
+    assert tail.get_sent_pos() == 0
+    assert tail.next_poll_term() <= 10
+    with open(path, 'a') as f:
+        f.write('025\n')
+    assert tail.may_send_newlines() == 1
+    assert bulks == []
+
+    tail.bulk.since -= 10
+    assert tail.may_send_newlines() == 0
+    assert len(bulks) == 1 and len(bulks[0]) == 26
+    assert tail.get_sent_pos() == 26 * 5
+
+    # flushed on close
+    with open(path, 'a') as f:
+        f.write('026\n')
+    assert tail.may_send_newlines() == 1
+    tail.close()
+    assert bulks[-1] == ['026']
+    assert tail.get_sent_pos() == 27 * 5
+
+
+def test_tail_bulk_progress(rmlogs):
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+
+    with open(path, 'w') as f:
+        for i in range(25):
+            f.write('{:03d}\n'.format(i))
+
+    for async_send in (False, True):
+        tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                          update_term=0, bulk_events=10,
+                          async_send=async_send)
+        sent = []
+        send_bulk = tail._send_bulk
+        fails = [1]
+
+        def _send_bulk(msgs):
+            if len(sent) == 10 and fails:
+                fails.pop()
+                raise IOError("send fail")
+            sent.extend(m for _, m in msgs)
+            send_bulk(msgs)
+
+        tail._send_bulk = _send_bulk
+        tail.update_target()
+        tail.save_sent_pos(0)
+
+        # progress of the first bulk is kept on failure of the second
+        with pytest.raises(IOError):
+            tail.may_send_newlines()
+            tail.flush_sender()
+        tail.flush_sender()
+        assert tail.get_sent_pos() == 10 * 5
+
+        # retry resends only the rest
+        tail.may_send_newlines()
+        tail.flush_sender()
+        assert sent == ['{:03d}'.format(i) for i in range(25)]
+        assert tail.get_sent_pos() == 25 * 5
+        tail.close()
+
+
+def test_tail_rate_limit(rmlogs, monkeypatch):
+    import msgpack
+    import wdfwd.ratelimit
+    from wdfwd.ratelimit import set_global_limiter
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    for spath in glob.glob(os.path.join(pos_dir, '*.spool*')):
+        os.remove(spath)
+
+    with open(path, 'w') as f:
+        for i in range(250):
+            f.write('{:03d}\n'.format(i))
+
+    # limiters run on a clock which pauses advance
+    class Clock(object):
+        now = 0.0
+
+        @classmethod
+        def time(cls):
+            return cls.now
+
+    monkeypatch.setattr(wdfwd.ratelimit, 'time', Clock)
+
+    def make_tail(**kwargs):
+        tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                          update_term=0, bulk_events=10, **kwargs)
+
+        def wait(secs):
+            Clock.now += secs
+
+        monkeypatch.setattr(tail.exit_event, 'wait', wait)
+        tail.update_target()
+        tail.save_sent_pos(0)
+        return tail
+
+    # 100 events of burst, then 150 events at 100 events/sec
+    tail = make_tail(rate_events=100)
+    assert tail.may_send_newlines() == 250
+    stats = tail.limiter.stats()
+    assert stats['nevents'] == 250 and stats['npause'] == 15
+    assert abs(stats['throttled'] - 1.5) < 1e-6
+    assert abs(Clock.now - 1.5) < 1e-6
+    tail.close()
+
+    # spooled events are counted on replay
+    down = [True]
+
+    def send(bytes_):
+        if down[0]:
+            raise IOError("fake send fail")
+
+    tail = make_tail(rate_events=100, spool=True)
+    tail.fsender = copy.copy(tail.fsender)
+    tail.fsender.send = send
+    assert tail.may_send_newlines() == 250
+    assert tail.spool.size > 0
+    assert tail.limiter.stats()['nevents'] == 10
+    down[0] = False
+    tail.spool_retry_at = tail.circuit.retry_at = 0
+    tail.may_replay_spool()
+    assert tail.spool.size == 0
+    stats = tail.limiter.stats()
+    assert stats['nevents'] == 260 and stats['npause'] == 16
+    tail.close()
+
+    # process wide limit
+    glmt = set_global_limiter(events_rate=100)
+    try:
+        tail = make_tail()
+        assert tail.limiter is None
+        assert tail.may_send_newlines() == 250
+        stats = glmt.stats()
+        assert stats['nevents'] == 250 and stats['npause'] == 15
+
+        # pause ends on exit request
+        tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                          update_term=0, bulk_events=10)
+        waits = []
+        ev_wait = tail.exit_event.wait
+
+        def wait(secs):
+            waits.append(ev_wait(secs))
+
+        monkeypatch.setattr(tail.exit_event, 'wait', wait)
+        tail.update_target()
+        tail.save_sent_pos(0)
+        tail.exit_event.set()
+        assert tail.may_send_newlines() == 250
+        assert len(waits) == 25 and all(waits)
+        tail.close()
+    finally:
+        set_global_limiter()
+
+
+def test_tail_circuit(rmlogs, monkeypatch):
+    from wdfwd.sender import CircuitBreaker, CircuitOpen
+
+    # backoff is doubled with jitter up to max
+    cb = CircuitBreaker('test', 1, 4)
+    assert cb.ready() and not cb.is_open
+    for backoff in (1, 2, 4, 4):
+        cb.retry_at = 0
+        cb.failure()
+        assert backoff * 0.5 - 0.1 <= cb.wait_left() <= backoff
+    assert not cb.ready()
+    cb.success()
+    assert cb.ready() and not cb.is_open
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        for i in range(25):
+            f.write('{:03d}\n'.format(i))
+
+    tails = [FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                        update_term=0) for _ in range(2)]
+    tail, tail2 = tails
+    # tailers of a destination share its circuit
+    assert tail.circuit is tail2.circuit
+    cb = tail.circuit
+    send = tail.fsender.send
+
+    def _send(payload):
+        raise IOError("connection refused")
+
+    try:
+        for t in tails:
+            t.update_target()
+            t.save_sent_pos(0)
+        tail.fsender.send = _send
+        with pytest.raises(IOError):
+            tail.may_send_newlines()
+        assert cb.is_open and tail.sink_down() and tail2.sink_down()
+        assert tail.next_poll_term() == pytest.approx(cb.wait_left(), abs=0.1)
+
+        # logs are not sent to the down destination
+        emitted = []
+        monkeypatch.setattr(tail2.fsender, 'emit_with_time',
+                            lambda *args: emitted.append(args))
+        tail2.lwarning(0, "down")
+        assert emitted == []
+
+        # the other tailer skips reading, and fails fast not to give up
+        assert tail2._tmain_may_send_newlines(time.time(), 0, True) ==\
+            (0, False)
+        assert tail2.get_sent_pos() == 0
+        with pytest.raises(CircuitOpen):
+            tail2.may_send_newlines()
+        with pytest.raises(CircuitOpen):
+            for _ in range(MAX_SEND_RETRY):
+                try:
+                    tail2.may_send_newlines()
+                except CircuitOpen:
+                    pass
+            tail2.may_send_newlines()
+
+        # back after backoff
+        tail.fsender.send = send
+        cb.retry_at = 0
+        assert tail2.may_send_newlines() == 25
+        assert not cb.is_open and not tail.sink_down()
+        assert tail.may_send_newlines() == 25
+    finally:
+        cb.success()
+        for t in tails:
+            t.close()
+
+
+def test_tail_spool(rmlogs):
+    import msgpack
+    from wdfwd.spool import SpoolFull
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    for spath in glob.glob(os.path.join(pos_dir, '*.spool*')):
+        os.remove(spath)
+
+    sent = []
+    down = [True]
+
+    def send(bytes_):
+        if down[0]:
+            raise IOError("fake send fail")
+        sent.extend(m for _, m in msgpack.unpackb(bytes_)[1])
+
+    def make_tail(**kwargs):
+        tail = FileTailer(bdir, ptrn, 'wdfwd.spool', pos_dir, fcfg,
+                          send_term=0, update_term=0, bulk_events=10,
+                          spool=True, spool_segment_bytes=100, **kwargs)
+        tail.fsender = copy.copy(tail.fsender)
+        tail.fsender.send = send
+        tail.update_target()
+        return tail
+
+    with open(path, 'w') as f:
+        for i in range(25):
+            f.write('{:03d}\n'.format(i))
+
+    # keep reading into spool while the destination is down
+    tail = make_tail()
+    tail.save_sent_pos(0)
+    assert tail.may_send_newlines() == 25
+    assert tail.get_sent_pos() == 125
+    assert tail.spool.size > 0
+    assert len(glob.glob(os.path.join(pos_dir, '*.spool'))) > 1
+    with open(path, 'a') as f:
+        f.write('025\n')
+    assert tail.may_send_newlines() == 1
+    tail.close()
+
+    # replayed in order after restart
+    down[0] = False
+    tail = make_tail()
+    tail.circuit.retry_at = 0
+    assert tail.spool.size > 0
+    with open(path, 'a') as f:
+        f.write('026\n')
+    assert tail.may_send_newlines() == 1
+    assert sent == ['{:03d}'.format(i) for i in range(27)]
+    assert tail.spool.size == 0
+    tail.close()
+    assert glob.glob(os.path.join(pos_dir, '*.spool')) == []
+
+    # never give up reading when spool is full
+    down[0] = True
+    tail = make_tail(spool_max_bytes=100)
+    with open(path, 'a') as f:
+        for i in range(27, 50):
+            f.write('{:03d}\n'.format(i))
+    for i in range(MAX_SEND_RETRY + 1):
+        with pytest.raises(SpoolFull):
+            tail.may_send_newlines()
+    assert tail.get_sent_pos() < 50 * 5
+    down[0] = False
+    tail.spool_retry_at = tail.circuit.retry_at = 0
+    tail.may_send_newlines()
+    assert sent[-1] == '049'
+    assert sorted(set(sent)) == sent
+    tail.close()
+
+
+@pytest.mark.parametrize('pos_fsync', ['rotation', 'none'])
+def test_tail_spool_sync(rmlogs, monkeypatch, pos_fsync):
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    for spath in glob.glob(os.path.join(pos_dir, '*.spool*')):
+        os.remove(spath)
+
+    events = []
+    fsync = os.fsync
+
+    def _fsync(fd):
+        events.append(('fsync', fd))
+        fsync(fd)
+
+    def send(bytes_):
+        raise IOError("fake send fail")
+
+    monkeypatch.setattr(os, 'fsync', _fsync)
+    tail = FileTailer(bdir, ptrn, 'wdfwd.spool', pos_dir, fcfg,
+                      send_term=0, update_term=0, spool=True,
+                      pos_flush_term=0, pos_fsync=pos_fsync)
+    tail.fsender = copy.copy(tail.fsender)
+    tail.fsender.send = send
+    write = tail.checkpoint.store.write
+
+    def _write(pending, fsync):
+        events.append(('write', fsync))
+        return write(pending, fsync)
+
+    monkeypatch.setattr(tail.checkpoint.store, 'write', _write)
+    with open(path, 'w') as f:
+        for i in range(5):
+            f.write('{:03d}\n'.format(i))
+    tail.update_target()
+    tail.save_sent_pos(0)
+    del events[:]
+    assert tail.may_send_newlines() == 5
+    assert tail.spool.size > 0
+
+    # spooled payloads reach disk before the position past them
+    spool_fd = tail.spool.wfile.fileno()
+    wrote = events.index(('write', False))
+    if pos_fsync == 'none':
+        assert ('fsync', spool_fd) not in events
+    else:
+        assert events[:wrote] == [('fsync', spool_fd)]
+    tail.circuit.success()
+    tail.close()
+
+
+def test_tail_spool_format(rmlogs):
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    for spath in glob.glob(os.path.join(pos_dir, '*.spool*')):
+        os.remove(spath)
+
+    def send(bytes_):
+        raise IOError("fake send fail")
+
+    def make_tail(fluent_mode):
+        tail = FileTailer(bdir, ptrn, 'wdfwd.spool', pos_dir, fcfg,
+                          send_term=0, update_term=0, spool=True,
+                          fluent_mode=fluent_mode)
+        tail.fsender = copy.copy(tail.fsender)
+        tail.fsender.send = send
+        return tail
+
+    with open(path, 'w') as f:
+        for i in range(5):
+            f.write('{:03d}\n'.format(i))
+    tail = make_tail('forward')
+    tail.update_target()
+    tail.save_sent_pos(0)
+    assert tail.may_send_newlines() == 5
+    size = tail.spool.size
+    assert size > 0
+    tail.close()
+
+    # a spool of the same format is replayed
+    tail = make_tail('forward')
+    assert tail.spool.size == size
+    tail.close()
+
+    # but not one of another format
+    tail = make_tail('message')
+    assert tail.spool.size == 0
+    asides = glob.glob(os.path.join(pos_dir, '*.aside'))
+    assert len(asides) == 1
+    tail.circuit.success()
+    tail.close()
+    os.remove(asides[0])
+
+
+def test_tail_shared_sender(ftail, ftail2):
+    import msgpack
+
+    # tailers to the same fluentd share pooled connections
+    assert ftail.fsender.pool is ftail2.fsender.pool
+    assert ftail.fsender.tag != ftail2.fsender.tag
+    assert len(ftail.fsender.pool.senders) == FLUENT_POOL_SIZE
+
+    # messages are tagged by handle
+    sent = []
+    pool = ftail.fsender.pool
+    for sender in pool.senders:
+        sender._send = sent.append
+    try:
+        ftail.fsender.emit_with_time('info', 1, {'message': 'a'})
+    finally:
+        for sender in pool.senders:
+            del sender._send
+    assert msgpack.unpackb(sent[0]) ==\
+        [ftail.tag + '.info', 1, {'message': 'a'}]
+    assert pool.idle.qsize() == FLUENT_POOL_SIZE
+
+
+def test_tail_fluent_cluster(rmlogs):
+    from wdfwd.tail import FluentClusterCfg
+    from wdfwd.sender import CircuitOpen
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    host, port = fcfg
+    ccfg = FluentClusterCfg(((host, port + 1, 1), (host, port + 2, 3)))
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, ccfg, send_term=0,
+                      update_term=0)
+    # tailer logs are sent through the balancer too, send directly
+    balancer = tail.fsender.pool
+    eps = balancer.endpoints
+    sent = [[], []]
+    down = [False, False]
+
+    def make_send(i):
+        def _send(bytes_):
+            if down[i]:
+                raise IOError("fake send fail")
+            sent[i].append(bytes_)
+        return _send
+
+    for i, ep in enumerate(eps):
+        for sender in ep.pool.senders:
+            sender._send = make_send(i)
+    try:
+        # spread by weights
+        for _ in range(8):
+            balancer.send('x' * 10)
+        assert [len(s) for s in sent] == [2, 6]
+
+        # fail over, and a failed endpoint is dropped until back
+        down[1] = True
+        for _ in range(4):
+            balancer.send('x' * 10)
+        assert [len(s) for s in sent] == [6, 6]
+        assert eps[1].circuit.is_open and not tail.circuit.is_open
+        down[1] = False
+        eps[1].circuit.retry_at = 0
+        balancer.send('x' * 10)
+        assert [len(s) for s in sent] == [6, 7]
+        assert not eps[1].circuit.is_open
+        # the endpoint back gets its share, not the sends it missed
+        for _ in range(8):
+            balancer.send('x' * 10)
+        assert [len(s) for s in sent] == [8, 13]
+
+        # the tailer backs off only when all are down
+        down[:] = [True, True]
+        with pytest.raises(IOError):
+            tail._send_payload('x' * 10)
+        assert tail.circuit.is_open and tail.sink_down()
+        tail.circuit.retry_at = 0
+        with pytest.raises(CircuitOpen):
+            tail._send_payload('x' * 10)
+    finally:
+        for ep in eps:
+            ep.circuit.success()
+            for sender in ep.pool.senders:
+                del sender._send
+        tail.circuit.success()
+        tail.close()
+
+
+def test_tail_fanout(rmlogs, monkeypatch):
+    import threading
+
+    knc = FakeKinesisClient()
+    monkeypatch.setattr('wdfwd.tail.get_kinesis_client',
+                        lambda *args: knc)
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    for spath in glob.glob(os.path.join(pos_dir, '*.spool*')):
+        os.remove(spath)
+
+    kcfg = KinesisCfg(KN_TEST_STREAM, 'ap-northeast-1', None, None)
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, [fcfg, kcfg], send_term=0,
+                      update_term=0, bulk_events=10, spool=True)
+    sink = tail.fanout[0]
+    assert tail.fsender is not None and sink.kclient is knc
+    assert sink.tag == tail.tag
+    # only the sending part of a tailer
+    assert not hasattr(sink, 'checkpoint')
+    assert sink.exit_event is tail.exit_event
+    # a queue per destination
+    assert len(tail.senders) == 2 and sink.sender in tail.senders
+    # a down destination is spooled not to hold back the others, in a spool
+    # named after it
+    assert tail.spool.prefix.endswith('fluent__{}__{}'.format(*fluent))
+    assert sink.spool.prefix.endswith('kinesis__ap-northeast-1__' +
+                                      KN_TEST_STREAM)
+
+    sent = [[], []]
+    fails = []
+    resume = threading.Event()
+
+    def count_send(t, i):
+        send_bulk = t._send_bulk
+
+        def _send_bulk(msgs):
+            if i in fails:
+                fails.remove(i)
+                resume.wait()
+                raise IOError("send fail")
+            sent[i].extend(m for _, m in msgs)
+            send_bulk(msgs)
+        t._send_bulk = _send_bulk
+
+    count_send(tail, 0)
+    count_send(sink, 1)
+    lines = ['{:03d}'.format(i) for i in range(35)]
+    with open(path, 'w') as f:
+        for line in lines[:25]:
+            f.write(line + '\n')
+
+    # read and parsed once, sent to both
+    tail.update_target()
+    tail.save_sent_pos(0)
+    assert tail.may_send_newlines() == 25
+    tail.flush_sender()
+    assert sent == [lines[:25], lines[:25]]
+    assert len(knc.records) > 0
+    assert tail.get_sent_pos() == 25 * 5
+
+    # position is the least sent by destinations
+    fails.append(1)
+    with open(path, 'a') as f:
+        for line in lines[25:]:
+            f.write(line + '\n')
+    assert tail.may_send_newlines() == 10
+    resume.set()
+    with pytest.raises(IOError):
+        tail.flush_sender()
+    assert sent[0] == lines
+    assert sent[1] == lines[:25]
+    assert tail.get_sent_pos() == 25 * 5
+
+    # retried only to the failed one
+    assert tail.may_send_newlines() == 10
+    tail.flush_sender()
+    assert sent == [lines, lines]
+    assert tail.get_sent_pos() == 35 * 5
+    assert tail.sent_to is None and sink.sent_to is None
+    tail.close()
+    assert sink.sender is None
+
+
+def test_tail_fanout_table(monkeypatch):
+    from datetime import datetime
+    from wdfwd.tail import TableTailer
+
+    knc = FakeKinesisClient()
+    monkeypatch.setattr('wdfwd.tail.get_kinesis_client',
+                        lambda *args: knc)
+    for spath in glob.glob(os.path.join(pos_dir, '*.spool*')):
+        os.remove(spath)
+    kcfg = KinesisCfg(KN_TEST_STREAM, 'ap-northeast-1', None, None)
+    tail = TableTailer(None, 'LogTable', 'wdfwd.table', pos_dir, [fcfg, kcfg],
+                       '%Y-%m-%d %H:%M:%S', ['dt', 'msg'], 0, send_term=0,
+                       bulk_events=10, spool=True)
+    sink = tail.fanout[0]
+    sent = [[], []]
+    fails = []
+
+    def count_send(t, i):
+        send_bulk = t._send_bulk
+
+        def _send_bulk(msgs):
+            if i in fails:
+                fails.remove(i)
+                raise IOError("send fail")
+            sent[i].extend(m['msg'] for _, m in msgs)
+            send_bulk(msgs)
+        t._send_bulk = _send_bulk
+
+    count_send(tail, 0)
+    count_send(sink, 1)
+    rows = [(datetime(2016, 3, 30, 12, 0, i), '{:03d}'.format(i)) for i in
+            range(25)]
+    # rows of the last key value are sent on next select
+    lines = [msg for _, msg in rows[:-1]]
+
+    # the failed destination does not stop the others
+    fails.append(1)
+    with pytest.raises(IOError):
+        tail.send_new_lines(None, rows)
+    assert sent == [lines[:10], []]
+
+    # retried only to the failed one
+    assert tail.send_new_lines(None, rows) == (24, '2016-03-30 12:00:23')
+    assert sent == [lines, lines]
+    tail.save_sent_pos('2016-03-30 12:00:23')
+    assert tail.sent_to is None and sink.sent_to is None
+    tail.close()
+
+
+def test_tail_log_lazy(rmlogs):
+    import logging
+    from wdfwd.parser import Parser
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    formatted = []
+
+    class Line(str):
+        def __format__(self, spec):
+            formatted.append(self)
+            return str.__format__(self, spec)
+
+    lines = [(Line('2016-03-30 12:00:{:02d} message {}'.format(i % 60, i)),
+              None) for i in range(100)]
+
+    psr = Parser()
+    psr.Token('dt', r'\S+ \S+')
+    psr.Token('text', r'.+')
+    psr.Format(r'%{dt} %{text}')
+    ftail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                       update_term=0,
+                       format=r'(?P<dt_>\S+ \S+) (?P<_text_>.+)')
+    ptail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                       update_term=0, parser=psr)
+
+    root = logging.getLogger()
+    level = root.level
+    try:
+        # lines are not formatted for disabled debug logs
+        root.setLevel(logging.INFO)
+        for tail in (ftail, ptail):
+            assert len(list(tail._iterate_lines(lines, path))) == 100
+        ftail.ldebug(1, "line {}", lines[0][0])
+        assert formatted == []
+
+        # but are for enabled ones
+        root.setLevel(logging.DEBUG)
+        assert len(list(ftail._iterate_lines(lines[:1], path))) == 1
+        assert formatted == [lines[0][0]]
+    finally:
+        root.setLevel(level)
+        ftail.close()
+        ptail.close()
+
+
+def test_tail_log_speed(rmlogs, monkeypatch):
+    import logging
+    from wdfwd.parser import Parser
+
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    n_lines = 20000
+    lines = [('2016-03-30 12:00:{:02d} message {}'.format(i % 60, i), None)
+             for i in range(n_lines)]
+
+    psr = Parser()
+    psr.Token('dt', r'\S+ \S+')
+    psr.Token('text', r'.+')
+    psr.Format(r'%{dt} %{text}')
+    ftail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                       update_term=0,
+                       format=r'(?P<dt_>\S+ \S+) (?P<_text_>.+)')
+    ptail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                       update_term=0, parser=psr)
+
+    def speed(tail):
+        elapsed = []
+        for _ in range(3):
+            st = time.time()
+            assert len(list(tail._iterate_lines(lines, path))) == n_lines
+            elapsed.append(time.time() - st)
+        return n_lines / min(elapsed)
+
+    root = logging.getLogger()
+    level = root.level
+    root.setLevel(logging.INFO)
+    try:
+        speeds = [speed(ftail), speed(ptail)]
+        # as if logging is removed
+        monkeypatch.setattr('wdfwd.tail._log', lambda *args: None)
+        monkeypatch.setattr('wdfwd.util._log', lambda *args: None)
+        nolog_speeds = [speed(ftail), speed(ptail)]
+    finally:
+        root.setLevel(level)
+        ftail.close()
+        ptail.close()
+    print("---------------- INFO level: format {:.0f}, parser {:.0f} lines/sec,"
+          " no logging: format {:.0f}, parser {:.0f} lines/sec "
+          "----------------".format(*(speeds + nolog_speeds)))
+
+
+def test_tail_async_send(rmlogs):
+    finfo = tcfg['from'][0]['file']
+    bdir = finfo['dir']
+    ptrn = finfo['pattern']
+    tag = finfo['tag']
+
+    path = os.path.join(bdir, 'tailtest_2016-03-30.log')
+    with open(path, 'w') as f:
+        for i in range(1000):
+            f.write('{:03d}\n'.format(i))
+
+    tail = FileTailer(bdir, ptrn, tag, pos_dir, fcfg, send_term=0,
+                      update_term=0, echo=True, max_read_buffer=1000,
+                      async_send=True, send_queue_size=2)
+    tail.update_target()
+
+    # sent position is saved only when acknowledged
+    sent = []
+    send_bulk = tail._send_bulk
+
+    def fail_bulk(msgs):
+        raise IOError("send fail")
+
+    tail._send_bulk = fail_bulk
+    with pytest.raises(IOError):
+        tail.may_send_newlines()
+        tail.flush_sender()
+    assert tail.get_sent_pos() == 0
+
+    # resend from acknowledged position
+    def _send_bulk(msgs):
+        sent.extend([m for _, m in msgs])
+        send_bulk(msgs)
+
+    tail._send_bulk = _send_bulk
+    assert tail.may_send_newlines() == 1000
+    tail.flush_sender()
+    assert tail.get_sent_pos() == 5000
+    assert len(sent) == 1000
+    assert sent[0] == '000'
+    assert sent[-1] == '999'
+    tail.close()
+    assert tail.sender is None
+
+
 #def test_tail_mulog(rmlogs):  # FIXME : delete this test
     #finfo = tcfg['from'][-1]['file']
     #bdir = finfo['dir']
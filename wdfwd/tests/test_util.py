@@ -20,7 +20,7 @@ def test_util_ravel_dict():
 
 def test_util_tail_info():
     from wdfwd.util import iter_tail_info
-    from wdfwd.tail import FluentCfg
+    from wdfwd.tail import FluentCfg, FluentClusterCfg, KinesisCfg
 
     # no global & local parser
     cfg = """
@@ -225,3 +225,90 @@ tailing:
     assert i2.max_between_data == 1000000
     assert i2.format is not None
     assert i2.parser is None
+
+    # fluentds to balance
+    cfg = """
+tailing:
+    pos_dir: D:\\UTIL\\temp
+    format: '(?P<dt_>\S+) (?P<_text_>.+)'
+    from:
+        - file:
+    to:
+        fluent: [[111.22.33.222, 24224], [111.22.33.223, 24224, 2]]
+    """
+    cfg = yaml.load(StringIO(cfg))
+    tinfos = list(iter_tail_info(cfg['tailing']))
+    assert tinfos[0].scfg == FluentClusterCfg((('111.22.33.222', 24224, 1),
+                                               ('111.22.33.223', 24224, 2)))
+
+    # fan-out to destinations
+    cfg = """
+tailing:
+    pos_dir: D:\\UTIL\\temp
+    format: '(?P<dt_>\S+) (?P<_text_>.+)'
+    from:
+        - file:
+    to:
+        - fluent: [111.22.33.222, 24224]
+        - kinesis:
+            stream_name: test
+            region: ap-northeast-2
+    """
+    cfg = yaml.load(StringIO(cfg))
+    tinfos = list(iter_tail_info(cfg['tailing']))
+    assert tinfos[0].scfg == [FluentCfg('111.22.33.222', 24224),
+                              KinesisCfg('test', 'ap-northeast-2', None,
+                                         None)]
+    # spool is used by default
+    assert tinfos[0].spool
+
+    # and can not be turned off
+    cfg['tailing']['spool'] = False
+    assert list(iter_tail_info(cfg['tailing'])) == []
+
+
+def test_util_iter_lines():
+    from wdfwd.util import iter_lines, count_lines
+    data = "a\r\nbb\n\nccc"
+    assert list(iter_lines(data)) == ['a', 'bb', '', 'ccc']
+    assert list(iter_lines(data, 3, 6)) == ['bb']
+    assert list(iter_lines('')) == []
+    assert list(iter_lines(data, ends=True)) == [('a', 3), ('bb', 6),
+                                                 ('', 7), ('ccc', 10)]
+
+    assert count_lines(data) == 4
+    assert count_lines(data, partial=False) == 3
+    assert count_lines(data, 0, 3) == 1
+    assert count_lines('') == 0
+
+
+def test_util_lru_cache():
+    from wdfwd.util import LRUCache
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache['a'] == 1
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert cache.keys() == ['a', 'c']
+    assert cache.get('b') is None
+    assert cache.pop('a') == 1
+    assert len(cache) == 1
+
+
+def test_util_rate_limit():
+    from wdfwd.ratelimit import TokenBucket, make_rate_limiter
+    bucket = TokenBucket(100)
+    # burst is allowed, then debt shall be waited
+    assert bucket.reserve(100) == 0
+    assert 0.9 < bucket.reserve(100) <= 1
+    assert 1.9 < bucket.reserve(100) <= 2
+
+    assert make_rate_limiter() is None
+    lmt = make_rate_limiter(1000, 10)
+    assert lmt.reserve(500, 10) == 0
+    # the tighter limit decides
+    assert 0.9 < lmt.reserve(100, 10) <= 1
+    stats = lmt.stats()
+    assert stats['nbytes'] == 600 and stats['nevents'] == 20
+    assert stats['npause'] == 1 and 0.9 < stats['throttled'] <= 1
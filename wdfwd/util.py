@@ -4,17 +4,24 @@ import tempfile
 import time
 import re
 import stat
-from collections import namedtuple
+import mmap
+import msvcrt
+from collections import namedtuple, OrderedDict
 from subprocess import check_call as _check_call, CalledProcessError
 import codecs
 
 import win32file
+import win32api
+import win32con
 import boto3
 from botocore.exceptions import ClientError
 
 
 fsender = None
 KN_TEST_STREAM = 'wdfwd-test'
+LOG_LEVELS = dict(debug=logging.DEBUG, info=logging.INFO,
+                  warning=logging.WARNING, error=logging.ERROR,
+                  critical=logging.CRITICAL)
 
 
 def decode(msg, encoding):
@@ -98,6 +105,42 @@ class ChangeDir(object):
         os.chdir(self.cwd)
 
 
+class LRUCache(object):
+    """Dict-like cache which keeps recently used items up to a size."""
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        val = self.data.pop(key)
+        self.data[key] = val
+        return val
+
+    def __setitem__(self, key, val):
+        self.data.pop(key, None)
+        self.data[key] = val
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def get(self, key, default=None):
+        if key in self.data:
+            return self[key]
+        return default
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def keys(self):
+        return self.data.keys()
+
+
 def get_fileid(fh):
     info = win32file.GetFileInformationByHandle(fh)
     return sum(info[8:])
@@ -135,6 +178,95 @@ class OpenNoLock(object):
             self.fid = None
 
 
+def map_file_region(fh, pos, size):
+    """Memory map a region of a file for read.
+
+    The mapping starts at the allocation granularity boundary before `pos`.
+
+    Args:
+        fh: File handle opened by OpenNoLock.
+        pos: Start position of the region.
+        size: Size of the region in bytes.
+
+    Returns:
+        mmap: Read only mapped object.
+        int: Offset of `pos` in the mapped object.
+    """
+    offset = pos - pos % mmap.ALLOCATIONGRANULARITY
+    proc = win32api.GetCurrentProcess()
+    # mmap needs a file descriptor, make one from a duplicated handle not
+    # to lose share-delete mode of the original.
+    dup = win32api.DuplicateHandle(proc, fh, proc, 0, 0,
+                                   win32con.DUPLICATE_SAME_ACCESS)
+    fd = msvcrt.open_osfhandle(dup.Detach(), os.O_RDONLY)
+    try:
+        mm = mmap.mmap(fd, size + pos - offset, access=mmap.ACCESS_READ,
+                       offset=offset)
+    finally:
+        os.close(fd)
+    return mm, pos - offset
+
+
+def iter_lines(data, start=0, end=None, ends=False):
+    """Iterate lines in a region of data one by one.
+
+    Unlike `splitlines`, line ends are found incrementally and no list of
+    the whole lines is made.
+
+    Args:
+        data: `str` or `mmap` object.
+        start(optional): Start offset of the region.
+        end(optional): End offset of the region. Default is end of data.
+        ends(optional): Yield offset of the next line with a line.
+
+    Yields:
+        str: A line without line end. (line, offset of the next line) if
+            `ends` is True.
+    """
+    end = len(data) if end is None else end
+    while start < end:
+        nl = data.find('\n', start, end)
+        if nl < 0:
+            nl = nxt = end
+        else:
+            nxt = nl + 1
+        if nl > start and data[nl - 1] == '\r':
+            nl -= 1
+        if ends:
+            yield data[start:nl], nxt
+        else:
+            yield data[start:nl]
+        start = nxt
+
+
+def count_lines(data, start=0, end=None, partial=True):
+    """Count lines in a region of data without making line strings.
+
+    Args:
+        data: `str` or `mmap` object.
+        start(optional): Start offset of the region.
+        end(optional): End offset of the region. Default is end of data.
+        partial(optional): Count unterminated last line too.
+
+    Returns:
+        int: Number of lines.
+    """
+    end = len(data) if end is None else end
+    if start >= end:
+        return 0
+    if isinstance(data, basestring):
+        cnt = data.count('\n', start, end)
+    else:
+        cnt = 0
+        nl = data.find('\n', start, end)
+        while nl >= 0:
+            cnt += 1
+            nl = data.find('\n', nl + 1, end)
+    if partial and data[end - 1] != '\n':
+        cnt += 1
+    return cnt
+
+
 def get_dump_fname(_tbname, _date=None):
     tbname = _tbname.split('.')[-1]
     if _date is None:
@@ -169,11 +301,13 @@ def init_global_fsender(tag, host, port):
         linfo("init_global_fsender")
 
 
-def _log(level, msg):
-    if logging.getLogger().getEffectiveLevel() > getattr(logging,
-                                                         level.upper()):
+def _log(level, msg, args=()):
+    if not logging.root.isEnabledFor(LOG_LEVELS[level]):
         return
 
+    if args:
+        # formatted lazily only if the level is enabled
+        msg = msg.format(*args)
     lfun = getattr(logging, level)
     lfun(msg)
     if fsender:
@@ -185,24 +319,24 @@ def _log(level, msg):
                           "'{}'".format(e))
 
 
-def ldebug(msg):
-    _log('debug', msg)
+def ldebug(msg, *args):
+    _log('debug', msg, args)
 
 
-def lerror(msg):
-    _log('error', msg)
+def lerror(msg, *args):
+    _log('error', msg, args)
 
 
-def linfo(msg):
-    _log('info', msg)
+def linfo(msg, *args):
+    _log('info', msg, args)
 
 
-def lwarning(msg):
-    _log('warning', msg)
+def lwarning(msg, *args):
+    _log('warning', msg, args)
 
 
-def lcritical(msg):
-    _log('critical', msg)
+def lcritical(msg, *args):
+    _log('critical', msg, args)
 
 
 def lheader(msg):
@@ -372,7 +506,14 @@ def _ravel_dict(results, data, sep, _prefix, root):
 FileTailInfo = namedtuple('FileTailInfo', [
     'bdir', 'ptrn', 'tag', 'pos_dir', 'scfg', 'send_term', 'update_term',
     'latest', 'file_enc', 'lines_on_start', 'max_between_data', 'format',
-    'parser', 'order_ptrn', 'reverse_order', 'max_read_buffer'
+    'parser', 'order_ptrn', 'reverse_order', 'max_read_buffer',
+    'partial_line_wait', 'drain_time', 'drain_bytes', 'use_mmap',
+    'mmap_window', 'watch_changes', 'watch_poll_term', 'poll_min',
+    'poll_max', 'line_index', 'pos_flush_term', 'pos_flush_bytes',
+    'pos_fsync', 'pos_store', 'pos_cache_size', 'fluent_mode',
+    'kinesis_encoder', 'kinesis_partition', 'async_send', 'send_queue_size',
+    'bulk_events', 'bulk_bytes', 'bulk_linger', 'spool', 'spool_max_bytes',
+    'spool_segment_bytes', 'rate_bytes', 'rate_events'
 ])
 
 
@@ -380,30 +521,34 @@ TableTailInfo = namedtuple('TableTailInfo', [
     'table', 'tag', 'pos_dir', 'scfg', 'datefmt', 'send_term',
     'encoding', 'lines_on_start', 'max_between_data', 'col_names',
     'millisec_ndigit', 'key_idx', 'start_key_sp',
-    'latest_rows_sp'])
-
+    'latest_rows_sp', 'poll_min', 'poll_max', 'pos_flush_term',
+    'pos_flush_bytes', 'pos_fsync', 'pos_store', 'pos_cache_size',
+    'fluent_mode', 'kinesis_encoder', 'kinesis_partition', 'bulk_events',
+    'bulk_bytes', 'spool', 'spool_max_bytes', 'spool_segment_bytes',
+    'rate_bytes', 'rate_events'])
 
-def iter_tail_info(tailc):
-    from wdfwd.tail import FluentCfg, KinesisCfg, DB_SEND_TERM,\
-        FILE_UPDATE_TERM, FILE_SEND_TERM
 
-    pos_dir = tailc.get('pos_dir')
-    if not pos_dir:
-        lerror("no position dir info. return")
-        return
-    ldebug("pos_dir {}".format(pos_dir))
+def make_stream_cfg(toc):
+    """Make stream config from a destination config.
 
-    lines_on_start = tailc.get('lines_on_start')
-    max_between_data = tailc.get('max_between_data')
+    Args:
+        toc: dict with 'fluent' or 'kinesis' config.
 
-    afrom = tailc['from']
-    fl_cfg = tailc['to'].get('fluent')
-    kn_cfg = tailc['to'].get('kinesis')
+    Returns:
+        Stream config, or None if not exists.
+    """
+    from wdfwd.tail import FluentCfg, FluentClusterCfg, KinesisCfg
 
-    # make stream cfg
+    fl_cfg = toc.get('fluent')
+    kn_cfg = toc.get('kinesis')
     if not fl_cfg and not kn_cfg:
-        lerror("no fluent / kinesis server info. return")
-        return
+        return None
+    elif fl_cfg and isinstance(fl_cfg[0], (list, tuple)):
+        # [ip, port] or [ip, port, weight] of fluentds
+        endpoints = tuple((ep[0], int(ep[1]), int(ep[2]) if len(ep) > 2 else
+                           1) for ep in fl_cfg)
+        scfg = FluentClusterCfg(endpoints)
+        ldebug("fluent: endpoints {}".format(endpoints))
     elif fl_cfg:
         ip = fl_cfg[0]
         port = int(fl_cfg[1])
@@ -415,6 +560,40 @@ def iter_tail_info(tailc):
         access_key = kn_cfg.get('access_key')
         secret_key = kn_cfg.get('secret_key')
         scfg = KinesisCfg(stream_name, region, access_key, secret_key)
+    return scfg
+
+
+def iter_tail_info(tailc):
+    from wdfwd.tail import DB_SEND_TERM, FILE_UPDATE_TERM, FILE_SEND_TERM
+
+    pos_dir = tailc.get('pos_dir')
+    if not pos_dir:
+        lerror("no position dir info. return")
+        return
+    ldebug("pos_dir {}".format(pos_dir))
+
+    lines_on_start = tailc.get('lines_on_start')
+    max_between_data = tailc.get('max_between_data')
+
+    afrom = tailc['from']
+    toc = tailc['to']
+    if isinstance(toc, list):
+        # fan-out to destinations from a single read and parse
+        scfg = [make_stream_cfg(dest) for dest in toc]
+        if not scfg or None in scfg:
+            lerror("no fluent / kinesis server info. return")
+            return
+        if len(scfg) == 1:
+            scfg = scfg[0]
+        elif tailc.get('spool') is False:
+            # a down destination would stop sending to the others
+            lerror("spool is required for several destinations. return")
+            return
+    else:
+        scfg = make_stream_cfg(toc)
+        if scfg is None:
+            lerror("no fluent / kinesis server info. return")
+            return
 
     if len(afrom) == 0:
         ldebug("no source info. return")
@@ -451,6 +630,25 @@ def make_table_tail_info(tailc, tablec, pos_dir, scfg, lines_on_start,
     latest_rows_sp = tablec.get('latest_rows_sp')
     col_names = tablec['col_names']
     key_idx = tablec['key_idx']
+    poll_min = tablec.get('poll_min', tailc.get('poll_min'))
+    poll_max = tablec.get('poll_max', tailc.get('poll_max'))
+    kinesis_partition = tablec.get('kinesis_partition',
+                                   tailc.get('kinesis_partition'))
+    bulk_events = tablec.get('bulk_events', tailc.get('bulk_events'))
+    bulk_bytes = tablec.get('bulk_bytes', tailc.get('bulk_bytes'))
+    rate_bytes = tablec.get('rate_bytes', tailc.get('rate_bytes'))
+    rate_events = tablec.get('rate_events', tailc.get('rate_events'))
+    pos_flush_term = tailc.get('pos_flush_term')
+    pos_flush_bytes = tailc.get('pos_flush_bytes')
+    pos_fsync = tailc.get('pos_fsync')
+    pos_store = tailc.get('pos_store')
+    pos_cache_size = tailc.get('pos_cache_size')
+    fluent_mode = tailc.get('fluent_mode')
+    kinesis_encoder = tailc.get('kinesis_encoder')
+    # always with several destinations
+    spool = tailc.get('spool', type(scfg) is list)
+    spool_max_bytes = tailc.get('spool_max_bytes')
+    spool_segment_bytes = tailc.get('spool_segment_bytes')
 
     tinfo = TableTailInfo(
         table=table,
@@ -466,7 +664,24 @@ def make_table_tail_info(tailc, tablec, pos_dir, scfg, lines_on_start,
         start_key_sp=start_key_sp,
         latest_rows_sp=latest_rows_sp,
         col_names=col_names,
-        key_idx=key_idx
+        key_idx=key_idx,
+        poll_min=poll_min,
+        poll_max=poll_max,
+        pos_flush_term=pos_flush_term,
+        pos_flush_bytes=pos_flush_bytes,
+        pos_fsync=pos_fsync,
+        pos_store=pos_store,
+        pos_cache_size=pos_cache_size,
+        fluent_mode=fluent_mode,
+        kinesis_encoder=kinesis_encoder,
+        kinesis_partition=kinesis_partition,
+        bulk_events=bulk_events,
+        bulk_bytes=bulk_bytes,
+        spool=spool,
+        spool_max_bytes=spool_max_bytes,
+        spool_segment_bytes=spool_segment_bytes,
+        rate_bytes=rate_bytes,
+        rate_events=rate_events
     )
     return tinfo
 
@@ -537,6 +752,27 @@ def resolve_parser(tailc, filec):
 def make_file_tail_info(tailc, filec, pos_dir, scfg, lines_on_start,
                         max_between_data, send_term, update_term):
     max_read_buffer = tailc.get('max_read_buffer')
+    partial_line_wait = tailc.get('partial_line_wait')
+    drain_time = tailc.get('drain_time')
+    drain_bytes = tailc.get('drain_bytes')
+    use_mmap = tailc.get('use_mmap', False)
+    mmap_window = tailc.get('mmap_window')
+    watch_changes = tailc.get('watch_changes', False)
+    watch_poll_term = tailc.get('watch_poll_term')
+    line_index = tailc.get('line_index')
+    async_send = tailc.get('async_send', False)
+    send_queue_size = tailc.get('send_queue_size')
+    pos_flush_term = tailc.get('pos_flush_term')
+    pos_flush_bytes = tailc.get('pos_flush_bytes')
+    pos_fsync = tailc.get('pos_fsync')
+    pos_store = tailc.get('pos_store')
+    pos_cache_size = tailc.get('pos_cache_size')
+    fluent_mode = tailc.get('fluent_mode')
+    kinesis_encoder = tailc.get('kinesis_encoder')
+    # always with several destinations
+    spool = tailc.get('spool', type(scfg) is list)
+    spool_max_bytes = tailc.get('spool_max_bytes')
+    spool_segment_bytes = tailc.get('spool_segment_bytes')
 
     file_enc = tailc.get('file_encoding')
 
@@ -560,9 +796,20 @@ def make_file_tail_info(tailc, filec, pos_dir, scfg, lines_on_start,
         order_ptrn = filec.get('order_ptrn')
         reverse_order = filec.get('reverse_order')
         tag = filec.get('tag')
+        poll_min = filec.get('poll_min', tailc.get('poll_min'))
+        poll_max = filec.get('poll_max', tailc.get('poll_max'))
+        kinesis_partition = filec.get('kinesis_partition',
+                                      tailc.get('kinesis_partition'))
+        bulk_events = filec.get('bulk_events', tailc.get('bulk_events'))
+        bulk_bytes = filec.get('bulk_bytes', tailc.get('bulk_bytes'))
+        bulk_linger = filec.get('bulk_linger', tailc.get('bulk_linger'))
+        rate_bytes = filec.get('rate_bytes', tailc.get('rate_bytes'))
+        rate_events = filec.get('rate_events', tailc.get('rate_events'))
     else:
         bdir = ptrn = latest = order_ptrn = tag =\
-            send_term = update_term = reverse_order = None
+            send_term = update_term = reverse_order = poll_min = poll_max =\
+            kinesis_partition = bulk_events = bulk_bytes = bulk_linger =\
+            rate_bytes = rate_events = None
 
     if not format and not parser:
         lerror("Need format or parser. return")
@@ -603,6 +850,34 @@ def make_file_tail_info(tailc, filec, pos_dir, scfg, lines_on_start,
         lines_on_start=lines_on_start,
         max_between_data=max_between_data,
         max_read_buffer=max_read_buffer,
+        partial_line_wait=partial_line_wait,
+        drain_time=drain_time,
+        drain_bytes=drain_bytes,
+        use_mmap=use_mmap,
+        mmap_window=mmap_window,
+        watch_changes=watch_changes,
+        watch_poll_term=watch_poll_term,
+        poll_min=poll_min,
+        poll_max=poll_max,
+        line_index=line_index,
+        pos_flush_term=pos_flush_term,
+        pos_flush_bytes=pos_flush_bytes,
+        pos_fsync=pos_fsync,
+        pos_store=pos_store,
+        pos_cache_size=pos_cache_size,
+        fluent_mode=fluent_mode,
+        kinesis_encoder=kinesis_encoder,
+        kinesis_partition=kinesis_partition,
+        async_send=async_send,
+        send_queue_size=send_queue_size,
+        bulk_events=bulk_events,
+        bulk_bytes=bulk_bytes,
+        bulk_linger=bulk_linger,
+        spool=spool,
+        spool_max_bytes=spool_max_bytes,
+        spool_segment_bytes=spool_segment_bytes,
+        rate_bytes=rate_bytes,
+        rate_events=rate_events,
         format=format,
         parser=parser,
         order_ptrn=order_ptrn,
@@ -0,0 +1,436 @@
+"""Change notification for tailed directories.
+
+Tailers subscribe to the directory of their target files with an event, and
+the watcher sets the event when something has changed in the directory.
+A tailer waits on its event with a timeout, so it still polls when
+notifications are missing or delayed.
+"""
+import os
+import sys
+import errno
+import select
+import struct
+import logging
+import threading
+from fnmatch import fnmatch
+
+
+class BaseWatcher(object):
+    """Directory watcher which wakes subscribed events.
+
+    Subclasses watch directories of the subscriptions in their own thread,
+    and call `_notify` for changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # directory -> list of (event, name patterns)
+        self.subs = {}
+        self.thread = None
+        self._exit = False
+
+    def subscribe(self, bdir, event, ptrns=None):
+        """Subscribe changes in a directory.
+
+        Args:
+            bdir: Directory to watch.
+            event(threading.Event): Event to set on changes.
+            ptrns(optional): File name patterns to filter changes. Changes of
+                any file wake the event if not given.
+        """
+        bdir = os.path.normpath(bdir)
+        logging.info("watcher subscribe '{}' {}".format(bdir, ptrns))
+        with self.lock:
+            new = bdir not in self.subs
+            self.subs.setdefault(bdir, []).append((event, ptrns))
+        if new:
+            self._add_dir(bdir)
+        self._may_start()
+
+    def unsubscribe(self, bdir, event):
+        bdir = os.path.normpath(bdir)
+        logging.info("watcher unsubscribe '{}'".format(bdir))
+        with self.lock:
+            subs = [s for s in self.subs.get(bdir, []) if s[0] is not event]
+            if subs:
+                self.subs[bdir] = subs
+                return
+            self.subs.pop(bdir, None)
+        self._remove_dir(bdir)
+
+    def _notify(self, bdir, name=None):
+        """Wake subscribers of a directory.
+
+        Args:
+            bdir: Changed directory.
+            name(optional): Changed file name, if known.
+        """
+        with self.lock:
+            subs = list(self.subs.get(bdir, []))
+        for event, ptrns in subs:
+            if name is None or not ptrns or\
+                    any(fnmatch(name, p) for p in ptrns if p):
+                event.set()
+
+    def _notify_all(self):
+        with self.lock:
+            bdirs = list(self.subs.keys())
+        for bdir in bdirs:
+            self._notify(bdir)
+
+    def _may_start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name='watcher')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self._exit = True
+
+    def _add_dir(self, bdir):
+        raise NotImplementedError()
+
+    def _remove_dir(self, bdir):
+        raise NotImplementedError()
+
+    def _run(self):
+        raise NotImplementedError()
+
+
+class PollWatcher(BaseWatcher):
+    """Watcher without notification. Subscribers fall back to polling."""
+
+    def _add_dir(self, bdir):
+        logging.warning("no change notification for '{}'. "
+                        "poll it".format(bdir))
+
+    def _remove_dir(self, bdir):
+        pass
+
+    def _may_start(self):
+        pass
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |\
+    IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher(BaseWatcher):
+    """Linux inotify watcher."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        super(InotifyWatcher, self).__init__()
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.wds = {}  # watch descriptor -> directory
+        self.rpipe, self.wpipe = os.pipe()
+
+    def _add_dir(self, bdir):
+        import ctypes
+
+        wd = self.libc.inotify_add_watch(self.fd, bdir, INOTIFY_MASK)
+        if wd < 0:
+            logging.warning("inotify_add_watch error {} for '{}'. poll "
+                            "it".format(ctypes.get_errno(), bdir))
+            return
+        with self.lock:
+            self.wds[wd] = bdir
+
+    def _remove_dir(self, bdir):
+        with self.lock:
+            wds = [wd for wd, d in self.wds.items() if d == bdir]
+            for wd in wds:
+                del self.wds[wd]
+        for wd in wds:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def stop(self):
+        # descriptors are closed by the watcher thread after this
+        with self.lock:
+            self._exit = True
+            if self.thread is None:
+                self._close()
+            else:
+                os.write(self.wpipe, 'x')
+
+    def _close(self):
+        for fd in (self.fd, self.rpipe, self.wpipe):
+            os.close(fd)
+
+    def _run(self):
+        logging.info("InotifyWatcher start")
+        while not self._exit:
+            try:
+                rfds, _, _ = select.select([self.fd, self.rpipe], [], [])
+            except select.error as e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            if self.fd not in rfds:
+                continue
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+            self._handle_events(buf)
+        with self.lock:
+            self._close()
+        logging.info("InotifyWatcher exit")
+
+    def _handle_events(self, buf):
+        off = 0
+        while off < len(buf):
+            wd, mask, _, nlen = INOTIFY_EVENT.unpack_from(buf, off)
+            off += INOTIFY_EVENT.size
+            name = buf[off:off + nlen].rstrip('\0')
+            off += nlen
+            if mask & IN_Q_OVERFLOW:
+                # events lost, wake all
+                self._notify_all()
+                continue
+            if mask & IN_IGNORED:
+                continue
+            with self.lock:
+                bdir = self.wds.get(wd)
+            if bdir is not None:
+                self._notify(bdir, name or None)
+
+
+FILE_LIST_DIRECTORY = 0x0001
+WIN_NOTIFY_BUF = 1024 * 64  # 64KB
+
+
+class _DirChanges(object):
+    """Overlapped read of changed file names in a directory."""
+
+    def __init__(self, bdir):
+        import win32con
+        import win32file
+        import win32event
+        import pywintypes
+
+        self.bdir = bdir
+        self.handle = win32file.CreateFile(
+            bdir, FILE_LIST_DIRECTORY, win32con.FILE_SHARE_READ |
+            win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE, None,
+            win32con.OPEN_EXISTING, win32con.FILE_FLAG_BACKUP_SEMANTICS |
+            win32con.FILE_FLAG_OVERLAPPED, None)
+        self.overlapped = pywintypes.OVERLAPPED()
+        self.overlapped.hEvent = win32event.CreateEvent(None, 0, 0, None)
+        self.buf = win32file.AllocateReadBuffer(WIN_NOTIFY_BUF)
+        self.reading = False
+
+    def read(self):
+        """Start reading changes. `overlapped.hEvent` is set on changes."""
+        import win32con
+        import win32file
+
+        flt = win32con.FILE_NOTIFY_CHANGE_FILE_NAME |\
+            win32con.FILE_NOTIFY_CHANGE_SIZE |\
+            win32con.FILE_NOTIFY_CHANGE_LAST_WRITE
+        win32file.ReadDirectoryChangesW(self.handle, self.buf, False, flt,
+                                        self.overlapped)
+        self.reading = True
+
+    def result(self):
+        """Return changed file names, or None if changes have been lost."""
+        import win32file
+
+        self.reading = False
+        nbytes = win32file.GetOverlappedResult(self.handle, self.overlapped,
+                                               True)
+        if not nbytes:
+            # buffer overflow
+            return None
+        return set(name for _, name in
+                   win32file.FILE_NOTIFY_INFORMATION(self.buf, nbytes))
+
+    def close(self):
+        import win32file
+
+        if self.reading:
+            win32file.CancelIo(self.handle)
+            try:
+                win32file.GetOverlappedResult(self.handle, self.overlapped,
+                                              True)
+            except Exception:
+                pass
+        self.handle.Close()
+
+
+class WinWatcher(BaseWatcher):
+    """Windows change notification watcher.
+
+    Changed file names are read by `ReadDirectoryChangesW`, so only
+    subscribers of matching names are woken.
+
+    Note:
+        NTFS may defer size notification of a file opened by its writer.
+        Subscribers shall keep polling with a timeout.
+    """
+
+    def __init__(self):
+        import win32event
+
+        super(WinWatcher, self).__init__()
+        # wakes the watcher thread to reload directories
+        self.ctl = win32event.CreateEvent(None, 0, 0, None)
+        self.dirs = {}  # directory -> _DirChanges
+        self.removed = []
+
+    def _add_dir(self, bdir):
+        import win32event
+
+        try:
+            dch = _DirChanges(bdir)
+        except Exception as e:
+            logging.warning("can't watch changes '{}' for '{}'. poll "
+                            "it".format(e, bdir))
+            return
+        with self.lock:
+            self.dirs[bdir] = dch
+        win32event.SetEvent(self.ctl)
+
+    def _remove_dir(self, bdir):
+        import win32event
+
+        # reading is started in watcher thread, and shall be cancelled there
+        with self.lock:
+            dch = self.dirs.pop(bdir, None)
+            if dch is not None:
+                self.removed.append(dch)
+        win32event.SetEvent(self.ctl)
+
+    def stop(self):
+        import win32event
+
+        # the event is closed by the watcher thread after this
+        with self.lock:
+            self._exit = True
+            if self.thread is None:
+                self.ctl.Close()
+            else:
+                win32event.SetEvent(self.ctl)
+
+    def _start_reads(self, items):
+        """Start reading changes of directories not being read.
+
+        Returns:
+            list: (directory, _DirChanges) being read.
+        """
+        reading = []
+        for bdir, dch in items:
+            if not dch.reading:
+                try:
+                    dch.read()
+                except Exception as e:
+                    logging.warning("ReadDirectoryChangesW error '{}' for "
+                                    "'{}'. poll it".format(e, bdir))
+                    self._remove_dir(bdir)
+                    continue
+            reading.append((bdir, dch))
+        return reading
+
+    def _run(self):
+        import win32event
+
+        logging.info("WinWatcher start")
+        nmax = win32event.MAXIMUM_WAIT_OBJECTS - 1
+        while not self._exit:
+            with self.lock:
+                removed, self.removed = self.removed, []
+                items = list(self.dirs.items())
+            for dch in removed:
+                dch.close()
+            if len(items) > nmax:
+                logging.warning("too many directories to watch. poll {} "
+                                "of them".format(len(items) - nmax))
+                items = items[:nmax]
+            items = self._start_reads(items)
+            handles = [self.ctl] + [dch.overlapped.hEvent for _, dch in
+                                    items]
+            rc = win32event.WaitForMultipleObjects(handles, 0,
+                                                   win32event.INFINITE)
+            idx = rc - win32event.WAIT_OBJECT_0
+            if idx <= 0 or idx > len(items):
+                continue
+            bdir, dch = items[idx - 1]
+            try:
+                names = dch.result()
+            except Exception as e:
+                logging.warning("change notification error '{}' for "
+                                "'{}'".format(e, bdir))
+                names = None
+            if names is None:
+                self._notify(bdir)
+                continue
+            for name in names:
+                self._notify(bdir, name)
+        with self.lock:
+            removed = self.removed + list(self.dirs.values())
+            self.removed = []
+            self.dirs = {}
+            self.ctl.Close()
+        for dch in removed:
+            dch.close()
+        logging.info("WinWatcher exit")
+
+
+WATCHER_EXIT_TIMEOUT = 5
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def create_watcher():
+    """Create a watcher for current platform."""
+    try:
+        if sys.platform == 'win32':
+            return WinWatcher()
+        elif sys.platform.startswith('linux'):
+            return InotifyWatcher()
+    except Exception as e:
+        logging.warning("can't create watcher '{}'. poll instead".format(e))
+    return PollWatcher()
+
+
+def get_watcher():
+    """Return the process-wide watcher."""
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = create_watcher()
+        return _watcher
+
+
+def stop_watcher():
+    """Stop the process-wide watcher. Next `get_watcher` creates new one."""
+    global _watcher
+    with _watcher_lock:
+        watcher, _watcher = _watcher, None
+    if watcher is None:
+        return
+    watcher.stop()
+    if watcher.thread is not None:
+        watcher.thread.join(WATCHER_EXIT_TIMEOUT)